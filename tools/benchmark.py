@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+"""Benchmarks of the PcP - P processing chain
+
+   Times the slow steps of the chain on synthetic catalogues of 10**3
+   to 10**6 rows (made by write_synthetic_isc, so the benchmarks need
+   no data and give the same rows every time), and checks that each
+   fast path agrees with the reference implementation it replaced:
+
+       case               fast path                 reference
+       read               read_pick_table           read_picks
+       pair               pair_pick_table           pair_picks
+       vincenty           vincenty_array            vincenty
+       ellip_corrections  ellip_corrections         ellip_correct
+       elcor              ElcorTable.corrections    ellip_correct
+       ray_paths          get_ray_paths_geo         get_travel_times
+       tomography         calculate_many            calculate
+
+   Reference implementations are slow, so they are run on at most
+   reference_rows rows (the fast path is run on those too, for the
+   comparison). Ray tracing is slow whichever way it is done, so the
+   cases that trace rays are only run up to max_rows rows. Each case
+   runs in a new process, so its peak memory can be measured.
+
+   Results are added to a JSON history file, a list with an entry for
+   each run, and compared with the last run on the same host: a case
+   that is more than slowdown slower than it was, or whose fast path
+   and reference differ by more than its tolerance, is a regression.
+   When run as a script,
+
+       python benchmark.py history.json [sizes [cases]]
+
+   (sizes and cases separated by commas) prints the results and any
+   regressions, and exits with status 1 if there are any.
+"""
+
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas
+import geographiclib.geodesic as geod
+
+import geographical
+import pcp_pipeline
+import read_ISC
+
+# pcp_pipeline puts these on the path
+import elcor
+import ellippy
+import tomocorr2
+
+SIZES = (1000, 10000, 100000, 1000000)
+
+# Phases of the picks in a synthetic catalogue, and the fraction of
+# paths that also have an S pick (which is not read)
+PHASES = pcp_pipeline.PHASES
+S_FRACTION = 0.2
+
+# Fraction of paths reported by a second agency
+SECOND_REPORTER = 0.3
+
+# Distance (degrees) beyond which vincenty may not converge (and so
+# is not a reference)
+ANTIPODAL = 179.0
+
+# An ISC line, as in tests/test_pcp_pipeline.py
+ISC_LINE = ("  {0:9d},{1:<9s},{2:<5s},{3:8.4f},{4:9.4f}, 250.0,???,"
+            "{5:7.2f}, 153.4,{6:<8s},{6:<8s},2012-01-01,{7},  0.0,T__,"
+            "     ,    ,ISC      ,2012-01-01,{8},{9:8.4f},{10:9.4f},"
+            "{11:6.1f},ISC,mb, 6.1\n")
+
+
+def synthetic_paths(npaths, seed=0):
+    """Event-station paths of a synthetic catalogue, as a DataFrame with
+       a row for each, sorted by event. Events and stations are spread
+       evenly over the sphere; there are about 50 paths to each event,
+       and each station is used by many events. Distances (degrees) are
+       on a sphere. Some paths are reported by two agencies (and so
+       appear twice)."""
+    rng = np.random.RandomState(seed)
+    nevents = max(1, npaths//50)
+    nstations = max(1, min(9999, 4*int(np.sqrt(npaths))))
+    event_lat = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, nevents)))
+    event_lon = rng.uniform(-180.0, 180.0, nevents)
+    event_depth = np.round(rng.uniform(0.0, 700.0, nevents), 1)
+    origin = rng.uniform(0.0, 20.0*3600.0, nevents)
+    station_lat = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, nstations)))
+    station_lon = rng.uniform(-180.0, 180.0, nstations)
+
+    event = np.sort(rng.randint(nevents, size=npaths))
+    station = rng.randint(nstations, size=npaths)
+    # Each path is one of the first npaths rows, and a second report
+    # of the one before it if that is drawn
+    second = rng.uniform(size=npaths) < SECOND_REPORTER
+    second[0] = False
+    first = np.cumsum(~second) - 1
+    event, station = event[first], station[first]
+    paths = pandas.DataFrame({
+        'eventid': 600000000 + event,
+        'reporter': np.where(second, 'NEIC', 'ISC'),
+        'station': ['S{:04d}'.format(s) for s in station],
+        'station_lat': np.round(station_lat[station], 4),
+        'station_lon': np.round(station_lon[station], 4),
+        'event_lat': np.round(event_lat[event], 4),
+        'event_lon': np.round(event_lon[event], 4),
+        'event_depth': event_depth[event],
+        'origin': origin[event]})
+    cos = np.sum(geographical_unit(paths['event_lat'], paths['event_lon']) *
+                 geographical_unit(paths['station_lat'],
+                                   paths['station_lon']), axis=0)
+    paths['distance'] = np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+    paths['has_s'] = rng.uniform(size=npaths) < S_FRACTION
+    return paths
+
+
+def geographical_unit(lat, lon):
+    """Unit vectors (one column each) of points at lat and lon"""
+    lat, lon = np.radians(np.asarray(lat)), np.radians(np.asarray(lon))
+    return np.array([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon),
+                     np.sin(lat)])
+
+
+def _clock(seconds):
+    """ISC time (HH:MM:SS.ss) of seconds after midnight"""
+    centiseconds = int(round(seconds*100.0))
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    hours, minutes = divmod(minutes, 60)
+    return '{:02d}:{:02d}:{:05.2f}'.format(hours, minutes,
+                                           centiseconds/100.0)
+
+
+def write_synthetic_isc(filename, nrows, seed=0):
+    """Write the first nrows lines of the ISC csv file of the picks on
+       synthetic_paths: P and PcP on every path, and S on some. Travel
+       times only roughly follow distance."""
+    paths = synthetic_paths(nrows//2 + 1, seed)
+    lines = 0
+    with open(filename, 'w') as fh:
+        for row in paths.itertuples():
+            picks = [('P', 60.0 + 8.0*row.distance),
+                     ('PcP', 560.0 + 2.0*row.distance)]
+            if row.has_s:
+                picks.append(('S', 100.0 + 14.0*row.distance))
+            for phase, ttime in picks:
+                if lines == nrows:
+                    return
+                fh.write(ISC_LINE.format(row.eventid, row.reporter,
+                    row.station, row.station_lat, row.station_lon,
+                    row.distance, phase, _clock(row.origin + ttime),
+                    _clock(row.origin), row.event_lat, row.event_lon,
+                    row.event_depth))
+                lines += 1
+
+
+def ray_paths(rows, seed=0):
+    """rows paths of a synthetic catalogue between 30 and 80 degrees
+       (where there is PcP)"""
+    paths = synthetic_paths(4*rows + 100, seed)
+    paths = paths[(paths['distance'] > 30.0) & (paths['distance'] < 80.0)]
+    return paths.iloc[:rows].reset_index(drop=True)
+
+
+def catalogue(workdir, rows):
+    """Name of a synthetic catalogue of rows lines in workdir, written
+       the first time it is needed"""
+    filename = os.path.join(workdir, 'isc_{}.csv'.format(rows))
+    if not os.path.exists(filename):
+        write_synthetic_isc(filename, rows)
+    return filename
+
+
+def _timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def _azimuth_difference(a, b):
+    d = np.abs(np.asarray(a) - np.asarray(b)) % 360.0
+    return np.minimum(d, 360.0 - d)
+
+
+def _pick_frame(picks, phase):
+    """Picks of phase read by read_picks as a DataFrame, indexed by key"""
+    frame = pandas.DataFrame.from_dict(picks[phase], orient='index')
+    frame['ttime'] = [d.total_seconds() for d in
+                      frame['pick_datetime'] - frame['event_datetime']]
+    return frame.sort_index()
+
+
+def bench_read(workdir, rows, reference_rows):
+    table, seconds = _timed(read_ISC.read_pick_table, catalogue(workdir, rows),
+                            PHASES)
+    filename = catalogue(workdir, min(rows, reference_rows))
+    picks, reference_seconds = _timed(read_ISC.read_picks, filename, PHASES)
+    table = read_ISC.read_pick_table(filename, PHASES)
+    table['key'] = table['eventid'].astype(str) + \
+        table['station'].astype(str) + table['reporter'].astype(str)
+    error = 0.0
+    for phase in PHASES:
+        expected = _pick_frame(picks, phase)
+        fast = table[table['phase'] == phase].drop_duplicates(
+            'key', keep='last').set_index('key').sort_index()
+        if list(fast.index) != list(expected.index):
+            return seconds, reference_seconds, np.inf
+        ttime = read_ISC.travel_times(fast['pick_time'].values,
+                                      fast['event_time'].values)
+        error = max(error, np.abs(ttime - expected['ttime'].values).max(),
+                    np.abs(fast['station_lat'].values -
+                           expected['station_lat'].values).max())
+    return seconds, reference_seconds, error
+
+
+def bench_pair(workdir, rows, reference_rows):
+    table = read_ISC.read_pick_table(catalogue(workdir, rows), PHASES)
+    _, seconds = _timed(read_ISC.pair_pick_table, table, PHASES)
+    filename = catalogue(workdir, min(rows, reference_rows))
+    picks = read_ISC.read_picks(filename, PHASES)
+    pairs, reference_seconds = _timed(read_ISC.pair_picks, picks, PHASES[0],
+                                      PHASES[1])
+    expected = pandas.DataFrame.from_dict(pairs, orient='index').sort_index()
+    fast = read_ISC.pair_pick_table(read_ISC.read_pick_table(filename,
+                                                             PHASES), PHASES)
+    fast.index = fast['eventid'].astype(str) + fast['station'].astype(str) + \
+        fast['reporter'].astype(str)
+    fast = fast.sort_index()
+    if list(fast.index) != list(expected.index):
+        return seconds, reference_seconds, np.inf
+    dtime = [d.total_seconds() for d in expected[PHASES[0] + '_datetime'] -
+             expected[PHASES[1] + '_datetime']]
+    error = np.abs(fast[PHASES[0] + '_ttime'] - fast[PHASES[1] + '_ttime'] -
+                   dtime).max()
+    return seconds, reference_seconds, error
+
+
+def bench_vincenty(workdir, rows, reference_rows):
+    paths = synthetic_paths(rows)
+    args = [paths[name].values for name in ('event_lat', 'event_lon',
+                                            'station_lat', 'station_lon')]
+    fast, seconds = _timed(geographical.vincenty_array, *args)
+    n = min(rows, reference_rows)
+    start = time.time()
+    expected = np.array([geographical.vincenty(*[a[i] for a in args])
+                         for i in range(n)])
+    reference_seconds = time.time() - start
+    # Nearly antipodal points are checked against geographiclib
+    for i in np.flatnonzero(paths['distance'].values[:n] > ANTIPODAL):
+        line = geod.Geodesic.WGS84.Inverse(*[a[i] for a in args])
+        expected[i] = line['s12']/1000.0, line['azi1'], line['azi2']
+    error = max(np.abs(fast[0][:n] - expected[:, 0]).max(),
+                _azimuth_difference(fast[1][:n], expected[:, 1]).max(),
+                _azimuth_difference(fast[2][:n], expected[:, 2]).max())
+    return seconds, reference_seconds, error
+
+
+def _ellipticity_args(rows):
+    paths = synthetic_paths(rows)
+    azimuth = geographical.vincenty_array(paths['event_lat'].values,
+        paths['event_lon'].values, paths['station_lat'].values,
+        paths['station_lon'].values)[1]
+    phase = np.where(np.arange(rows) % 2 == 0, PHASES[0], PHASES[1])
+    return (paths['event_lat'].values, paths['event_depth'].values, azimuth,
+            paths['distance'].values, phase)
+
+
+def _ellip_reference(args, n):
+    ellippy.ensure_table()
+    start = time.time()
+    expected = np.array([ellippy.ellip_correct(*[a[i] for a in args])
+                         for i in range(n)])
+    return expected, time.time() - start
+
+
+def bench_ellip_corrections(workdir, rows, reference_rows):
+    args = _ellipticity_args(rows)
+    n = min(rows, reference_rows)
+    expected, reference_seconds = _ellip_reference(args, n)
+    fast, seconds = _timed(ellippy.ellip_corrections, *args)
+    return seconds, reference_seconds, np.abs(fast[:n] - expected).max()
+
+
+def bench_elcor(workdir, rows, reference_rows):
+    args = _ellipticity_args(rows)
+    n = min(rows, reference_rows)
+    expected, reference_seconds = _ellip_reference(args, n)
+    table = elcor.default_table()
+    fast, seconds = _timed(table.corrections, *args)
+    return seconds, reference_seconds, np.abs(fast[:n] - expected).max()
+
+
+def _taup_model():
+    return tomocorr2.TauPyModelGeo(model='iasp91')
+
+
+def bench_ray_paths(workdir, rows, reference_rows):
+    paths = ray_paths(rows)
+    model = _taup_model()
+    start = time.time()
+    arrivals = [model.get_ray_paths_geo(row.event_depth, row.event_lat,
+                                        row.event_lon, row.station_lat,
+                                        row.station_lon, list(PHASES))
+                for row in paths.itertuples()]
+    seconds = time.time() - start
+    n = min(rows, reference_rows)
+    ellipsoid = geod.Geodesic.WGS84
+    start = time.time()
+    expected = []
+    for row in paths.iloc[:n].itertuples():
+        distance = ellipsoid.Inverse(row.event_lat, row.event_lon,
+                                     row.station_lat, row.station_lon)['a12']
+        expected.append(model.get_travel_times(row.event_depth, distance,
+                                               list(PHASES)))
+    reference_seconds = time.time() - start
+    error = 0.0
+    for row, found, reference in zip(paths.itertuples(), arrivals[:n],
+                                     expected):
+        if [a.name for a in found] != [a.name for a in reference]:
+            return seconds, reference_seconds, np.inf
+        for arrival, other in zip(found, reference):
+            # The path must end at the station
+            if abs(arrival.path['lat'][-1] - row.station_lat) > 0.01 or \
+                    _azimuth_difference(arrival.path['lon'][-1],
+                                        row.station_lon) > 0.01:
+                return seconds, reference_seconds, np.inf
+            error = max(error, abs(arrival.time - other.time))
+    return seconds, reference_seconds, error
+
+
+def bench_tomography(workdir, rows, reference_rows):
+    paths = ray_paths(rows)
+    corrector = tomocorr2.TomographicCorrection(pcp_pipeline.FILE_1D,
+                                                pcp_pipeline.FILE_3D)
+    args = [paths[name].values for name in ('event_lat', 'event_lon',
+                                            'event_depth', 'station_lat',
+                                            'station_lon')]
+    fast, seconds = _timed(corrector.calculate_many, *(args + [PHASES]))
+    n = min(rows, reference_rows)
+    start = time.time()
+    expected = np.array([[corrector.calculate(*([a[i] for a in args] +
+                                                [[phase]]))[0]
+                          for phase in PHASES] for i in range(n)])
+    reference_seconds = time.time() - start
+    return seconds, reference_seconds, np.abs(fast[:n] - expected).max()
+
+
+# name: (function, tolerance of the agreement, default reference_rows,
+# max_rows)
+CASES = collections.OrderedDict([
+    ('read', (bench_read, 1e-6, 100000, None)),
+    ('pair', (bench_pair, 1e-6, 100000, None)),
+    ('vincenty', (bench_vincenty, 1e-6, 100000, None)),
+    ('ellip_corrections', (bench_ellip_corrections, 1e-6, 10000, None)),
+    ('elcor', (bench_elcor, 2e-5, 10000, None)),
+    ('ray_paths', (bench_ray_paths, 1e-6, 100, 1000)),
+    ('tomography', (bench_tomography, 1e-5, 100, 1000))])
+
+
+def _peak_memory():
+    """Peak resident memory of this process (MB)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kB, and macOS bytes
+    return peak/1024.0**2 if sys.platform == 'darwin' else peak/1024.0
+
+
+def run_case(name, workdir, rows, reference_rows=None):
+    """Run case name on rows rows, with catalogues in workdir, and
+       return the result as a dictionary"""
+    function, tolerance, default_reference_rows, _ = CASES[name]
+    if reference_rows is None:
+        reference_rows = default_reference_rows
+    start_memory = _peak_memory()
+    seconds, reference_seconds, error = function(workdir, rows,
+                                                 reference_rows)
+    n = min(rows, reference_rows)
+    result = collections.OrderedDict([
+        ('case', name), ('rows', rows), ('seconds', seconds),
+        ('rows_per_second', rows/seconds if seconds > 0 else None),
+        ('reference_rows', n), ('reference_seconds', reference_seconds),
+        ('speedup', (reference_seconds/n)/(seconds/rows)
+         if seconds > 0 and n > 0 else None),
+        ('error', float(error)), ('tolerance', tolerance),
+        ('agrees', bool(error <= tolerance)),
+        ('start_memory_mb', start_memory),
+        ('peak_memory_mb', _peak_memory())])
+    return result
+
+
+def _run_case(args):
+    return run_case(*args)
+
+
+def run(sizes=SIZES, cases=None, workdir=None, reference_rows=None,
+        isolate=True, log=None):
+    """Run cases (names in CASES, by default all of them) at each of
+       sizes rows, with catalogues written to workdir (by default a
+       temporary directory, removed afterwards), in a new process for
+       each if isolate. Returns a list of the results (see run_case)."""
+    if cases is None:
+        cases = list(CASES)
+    for name in cases:
+        if name not in CASES:
+            raise ValueError("Unknown benchmark " + name)
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for rows in sizes:
+            for name in cases:
+                max_rows = CASES[name][3]
+                if max_rows is not None and rows > max_rows:
+                    continue
+                args = (name, workdir, rows, reference_rows)
+                if isolate:
+                    # A new process for each, so its peak memory is
+                    # its own
+                    pool = multiprocessing.Pool(1)
+                    try:
+                        result = pool.apply(_run_case, (args,))
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    result = run_case(*args)
+                results.append(result)
+                if log is not None:
+                    log.write(format_results([result], header=False) + '\n')
+                    log.flush()
+    finally:
+        if temporary:
+            shutil.rmtree(workdir)
+    return results
+
+
+def environment():
+    """Where and on what the benchmarks were run"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return collections.OrderedDict([
+        ('time', datetime.datetime.utcnow().isoformat()),
+        ('host', platform.node()), ('python', platform.python_version()),
+        ('numpy', np.__version__), ('pandas', pandas.__version__),
+        ('commit', commit)])
+
+
+def load_history(filename):
+    """The runs in a history file (an empty list if there is none)"""
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as fh:
+        return json.load(fh)
+
+
+def save_run(filename, results, env=None):
+    """Add a run (its results and environment) to a history file"""
+    history = load_history(filename)
+    history.append({'environment': environment() if env is None else env,
+                    'results': results})
+    with open(filename, 'w') as fh:
+        json.dump(history, fh, indent=1)
+
+
+def regressions(history, results, host=None, slowdown=0.5):
+    """Descriptions of the results that disagree with their reference,
+       or are more than slowdown (a fraction) slower than the last run
+       in history on host (by default this one) of the same case and
+       rows"""
+    if host is None:
+        host = platform.node()
+    last = {}
+    for run in history:
+        if run['environment'].get('host') != host:
+            continue
+        for result in run['results']:
+            last[(result['case'], result['rows'])] = result
+    problems = []
+    for result in results:
+        label = '{} at {} rows'.format(result['case'], result['rows'])
+        if not result['agrees']:
+            problems.append('{}: error {:g} is more than {:g}'.format(
+                label, result['error'], result['tolerance']))
+        previous = last.get((result['case'], result['rows']))
+        if previous is not None and previous['rows_per_second'] and \
+                result['rows_per_second'] is not None and \
+                result['rows_per_second'] < \
+                (1.0 - slowdown)*previous['rows_per_second']:
+            problems.append('{}: {:.1f} rows/s, was {:.1f}'.format(
+                label, result['rows_per_second'],
+                previous['rows_per_second']))
+    return problems
+
+
+def format_results(results, header=True):
+    """A table of results"""
+    lines = []
+    if header:
+        lines.append('{:<18s}{:>9s}{:>10s}{:>13s}{:>10s}{:>11s}{:>9s}'.format(
+            'case', 'rows', 'seconds', 'rows/s', 'speedup', 'error',
+            'peak MB'))
+    for r in results:
+        lines.append('{:<18s}{:9d}{:10.3f}{:13.1f}{:10.1f}{:11.2e}'
+                     '{:9.1f}{}'.format(r['case'], r['rows'], r['seconds'],
+                                        r['rows_per_second'] or np.nan,
+                                        r['speedup'] or np.nan, r['error'],
+                                        r['peak_memory_mb'],
+                                        '' if r['agrees'] else ' DISAGREES'))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: benchmark.py history.json [sizes [cases]]\n")
+        sys.exit(2)
+    history_file = sys.argv[1]
+    sizes = SIZES
+    if len(sys.argv) > 2:
+        sizes = [int(float(s)) for s in sys.argv[2].split(',')]
+    cases = sys.argv[3].split(',') if len(sys.argv) > 3 else None
+    sys.stdout.write(format_results([]) + '\n')
+    results = run(sizes, cases, log=sys.stdout)
+    problems = regressions(load_history(history_file), results)
+    save_run(history_file, results)
+    for problem in problems:
+        sys.stdout.write('REGRESSION ' + problem + '\n')
+    sys.exit(1 if problems else 0)
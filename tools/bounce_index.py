@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Spatial index of CMB bounce points
+
+   Looking at the residuals in one region of the CMB means scanning
+   every row of the table for bounce points nearby. A BounceIndex puts
+   the bounce points in a k-d tree (of unit vectors, so there is no
+   trouble at the poles or the dateline) and gives each an equal-area
+   cell, so that caps, nearest neighbours and stacks by cell are found
+   without a scan:
+
+       index = bounce_index.BounceIndex.from_table(paired_picks_df)
+       rows = index.cap(10.0, 150.0, 50.0)       # within 50 km
+       distance, rows = index.nearest(10.0, 150.0, k=20)
+       stacks = index.cell_statistics(
+           paired_picks_df['PcP_P_dtime_corrected_resid'])
+       caps = index.cap_statistics(resid, lats, lons, 100.0)
+
+   Distances are in km along the CMB (radius CMB_RADIUS), and the
+   statistics of each cell or cap are the count, mean, median and
+   robust spread (the normalised median absolute deviation) of the
+   values, found for all cells or caps at once.
+
+   Cells are made by cutting the sphere into bands of latitude of
+   width cell_size degrees, and each band into as many cells of equal
+   longitude as make them closest to cell_size square, so all cells
+   in a band have the same area and the areas of cells in different
+   bands differ by a few percent at most (except in the polar caps).
+"""
+
+import numpy as np
+import pandas
+import scipy.spatial
+
+# Radius of the core mantle boundary (km)
+CMB_RADIUS = 3480.0
+
+# Normalises the median absolute deviation to a standard deviation
+MAD_SCALE = 1.4826
+
+
+def unit_vectors(lat, lon):
+    """Cartesian unit vectors of points at lat and lon (degrees, arrays
+       broadcast together), with shape lat.shape + (3,)"""
+    lat, lon = np.broadcast_arrays(np.radians(np.asarray(lat, float)),
+                                   np.radians(np.asarray(lon, float)))
+    return np.stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon),
+                     np.sin(lat)), axis=-1)
+
+
+class EqualAreaCells(object):
+    """Division of the sphere into cells of about cell_size degrees (see
+       the module docstring). Cells are numbered from the south pole,
+       by band and then eastwards from longitude zero."""
+
+    def __init__(self, cell_size=2.0):
+        self.cell_size = float(cell_size)
+        self.nbands = max(1, int(round(180.0/self.cell_size)))
+        self.edges = np.linspace(-90.0, 90.0, self.nbands + 1)
+        band_area = 2.0*np.pi*np.diff(np.sin(np.radians(self.edges)))
+        target = np.radians(180.0/self.nbands)**2
+        self.counts = np.maximum(1, np.round(band_area/target)).astype(int)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        self.ncells = self.offsets[-1]
+
+    def cell(self, lat, lon):
+        """Cell of each point at lat and lon (degrees, arrays broadcast
+           together), or -1 where they are not finite"""
+        lat, lon = np.broadcast_arrays(np.asarray(lat, float),
+                                       np.asarray(lon, float))
+        ok = np.isfinite(lat) & np.isfinite(lon)
+        band = np.clip(np.searchsorted(self.edges, np.where(ok, lat, 0.0),
+                                       side='right') - 1, 0, self.nbands - 1)
+        fraction = np.mod(np.where(ok, lon, 0.0), 360.0)/360.0
+        column = np.minimum((fraction*self.counts[band]).astype(int),
+                            self.counts[band] - 1)
+        return np.where(ok, self.offsets[band] + column, -1)
+
+    def centre(self, cell):
+        """Latitude and longitude (degrees) of the centre of each cell"""
+        cell = np.asarray(cell, dtype=int)
+        band = np.searchsorted(self.offsets, cell, side='right') - 1
+        column = cell - self.offsets[band]
+        lat = 0.5*(self.edges[band] + self.edges[band + 1])
+        lon = (column + 0.5)*360.0/self.counts[band]
+        return lat, lon
+
+    def area(self, cell, radius=CMB_RADIUS):
+        """Area of each cell on a sphere of radius (km**2)"""
+        band = np.searchsorted(self.offsets, np.asarray(cell, dtype=int),
+                               side='right') - 1
+        sines = np.sin(np.radians(self.edges))
+        return 2.0*np.pi*radius**2*(sines[band + 1] - sines[band]) / \
+            self.counts[band]
+
+
+def _group_order(groups, values):
+    """Order sorting by groups and then values (as numpy.lexsort, but
+       faster, by sorting one key made of the group and rank of value)"""
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[np.argsort(values)] = np.arange(len(values))
+    return np.argsort(groups.astype(np.int64)*len(values) + rank)
+
+
+def grouped_statistics(groups, values):
+    """Count, mean, median and robust spread of values in each group
+       (given by an integer for each value, negative to leave it out),
+       as a DataFrame indexed by group. NaN values are left out."""
+    groups = np.asarray(groups, dtype=int).ravel()
+    values = np.asarray(values, dtype=float).ravel()
+    ok = (groups >= 0) & np.isfinite(values)
+    groups, values = groups[ok], values[ok]
+    # Sorting by group and then value puts each group in one run, in
+    # order, so medians are at the middle of each run
+    order = _group_order(groups, values)
+    groups, values = groups[order], values[order]
+    starts = np.flatnonzero(np.concatenate(([True],
+                                            groups[1:] != groups[:-1])))
+    if len(groups) == 0:
+        starts = starts[:0]
+    count = np.diff(np.append(starts, len(groups)))
+    low, high = starts + (count - 1)//2, starts + count//2
+    mean = np.add.reduceat(values, starts)/count if len(starts) else \
+        np.zeros(0)
+    median = 0.5*(values[low] + values[high])
+    deviation = np.abs(values - np.repeat(median, count))
+    deviation = deviation[_group_order(groups, deviation)]
+    spread = MAD_SCALE*0.5*(deviation[low] + deviation[high])
+    return pandas.DataFrame({'count': count, 'mean': mean, 'median': median,
+                             'spread': spread},
+                            index=pandas.Index(groups[starts], name='group'),
+                            columns=['count', 'mean', 'median', 'spread'])
+
+
+class BounceIndex(object):
+    """Index of points at lat and lon (degrees, e.g. CMB bounce points)
+       on a sphere of radius (km), with cells of about cell_size degrees.
+       Points with a coordinate that is not finite are never found."""
+
+    def __init__(self, lat, lon, cell_size=2.0, radius=CMB_RADIUS):
+        lat, lon = [a.ravel() for a in np.broadcast_arrays(
+            np.asarray(lat, float), np.asarray(lon, float))]
+        self.lat, self.lon = lat, lon
+        self.radius = radius
+        self.cells = EqualAreaCells(cell_size)
+        self.cell = self.cells.cell(lat, lon)
+        self._rows = np.flatnonzero(self.cell >= 0)
+        self._tree = scipy.spatial.cKDTree(
+            unit_vectors(lat[self._rows], lon[self._rows]))
+        # Rows sorted by cell, for finding the points in a cell
+        self._by_cell = np.argsort(self.cell, kind='mergesort')
+        self._sorted_cells = self.cell[self._by_cell]
+
+    @classmethod
+    def from_table(cls, table, lat='CMB_bounce_lat', lon='CMB_bounce_lon',
+                   cell_size=2.0, radius=CMB_RADIUS):
+        """Index of the bounce points in columns lat and lon of table"""
+        return cls(table[lat].values, table[lon].values, cell_size, radius)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def _chord(self, distance):
+        """Chord of the unit sphere for a distance (km) along the sphere"""
+        angle = np.minimum(np.asarray(distance, float)/self.radius, np.pi)
+        return 2.0*np.sin(0.5*angle)
+
+    def cap(self, lat, lon, distance):
+        """Rows of the points within distance (km) of lat and lon. For
+           scalars, a sorted array of rows; for arrays of centres (and
+           distances, broadcast together), a list of them."""
+        scalar = np.ndim(lat) == 0 and np.ndim(lon) == 0 and \
+            np.ndim(distance) == 0
+        lat, lon, distance = [a.ravel() for a in np.broadcast_arrays(
+            np.asarray(lat, float), np.asarray(lon, float),
+            np.asarray(distance, float))]
+        xyz = unit_vectors(lat, lon)
+        rows = [np.zeros(0, dtype=int)]*len(lat)
+        # One query for all the caps of each size (the chord is slightly
+        # larger, so rounding does not lose points on the edge)
+        for value in np.unique(distance):
+            caps = np.flatnonzero(distance == value)
+            found = self._tree.query_ball_point(
+                xyz[caps], float(self._chord(value))*(1 + 1e-12))
+            for cap, f in zip(caps, found):
+                rows[cap] = np.sort(self._rows[np.asarray(f, dtype=int)])
+        return rows[0] if scalar else rows
+
+    def nearest(self, lat, lon, k=1):
+        """Distance (km) to, and rows of, the k nearest points to each
+           point at lat and lon, nearest first, with shapes lat.shape +
+           (k,) (or lat.shape for k of one). Where there are fewer than k
+           points the distance is inf and the row -1."""
+        xyz = unit_vectors(lat, lon)
+        chord, found = self._tree.query(xyz, k=k)
+        missing = found >= len(self._rows)
+        rows = np.where(missing, -1,
+                        self._rows[np.minimum(found, len(self._rows) - 1)])
+        with np.errstate(invalid='ignore'):
+            distance = 2.0*np.arcsin(np.minimum(np.asarray(chord)/2.0, 1.0)) \
+                * self.radius
+        return np.where(missing, np.inf, distance), rows
+
+    def cell_rows(self, cell):
+        """Rows of the points in a cell"""
+        start, stop = np.searchsorted(self._sorted_cells, [cell, cell + 1])
+        return np.sort(self._by_cell[start:stop])
+
+    def cell_statistics(self, values):
+        """Count, mean, median and robust spread of values (one for each
+           point) in each cell with any points, as a DataFrame indexed by
+           cell, with the latitude and longitude of the centre and the
+           area (km**2) of each cell"""
+        stats = grouped_statistics(self.cell, values)
+        stats.index.name = 'cell'
+        stats['lat'], stats['lon'] = self.cells.centre(stats.index.values)
+        stats['area'] = self.cells.area(stats.index.values, self.radius)
+        return stats
+
+    def cap_statistics(self, values, lat, lon, distance):
+        """Statistics, as for cell_statistics, of values (one for each
+           point) within distance (km) of each of the centres at lat and
+           lon (arrays broadcast together), with a row for each centre
+           (all NaN but count for caps with no points)"""
+        lat, lon, distance = [a.ravel() for a in np.broadcast_arrays(
+            np.asarray(lat, float), np.asarray(lon, float),
+            np.asarray(distance, float))]
+        rows = self.cap(lat, lon, distance)
+        counts = np.array([len(r) for r in rows], dtype=int)
+        members = np.concatenate(rows + [np.zeros(0, dtype=int)])
+        stats = grouped_statistics(np.repeat(np.arange(len(rows)), counts),
+                                   np.asarray(values, float).ravel()[members])
+        stats = stats.reindex(np.arange(len(rows)))
+        stats['count'] = stats['count'].fillna(0).astype(int)
+        stats.index.name = 'cap'
+        stats['lat'], stats['lon'], stats['distance'] = lat, lon, distance
+        return stats
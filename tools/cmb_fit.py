@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Convert PcP - P residuals to deflections of the CMB
+
+   FitCMB.ipynb fits a polynomial surface dt(distance, dc) to the
+   change in PcP - P time with deflection of the CMB, and then finds
+   the deflection for each residual by minimising |dt(distance, dc) -
+   residual| with scipy.optimize.fmin, one row at a time. This module
+   does the same fit and finds the deflections for all the residuals
+   at once, by solving the polynomial in dc directly:
+
+       sens = cmb_sensitivity.cached_sensitivity('iasp91_dcmb.npz')
+       fit = cmb_fit.CMBFit.from_sensitivity(sens, depth=100.0)
+       dcmb = fit.deflection(resid, distance)
+       error = fit.deflection_error(resid, distance, dt_error=0.5)
+
+   The coefficients are in the order used by the notebook (and by
+   numpy.polynomial.polynomial.polyvander2d), so a fit m made there
+   can be used as CMBFit(m). Fits can be saved as json.
+
+   For fits of order two or less the deflection is the root of a
+   quadratic nearest zero (which is what fmin, starting from zero,
+   finds); for higher orders it is found by Newton iterations on all
+   values at once. Where there is no such deflection it is NaN.
+"""
+
+import json
+
+import numpy as np
+import numpy.polynomial.polynomial as poly
+
+
+def design_matrix(distance, dc, order):
+    """Least squares design matrix for a polynomial of the given order
+       in distance and in dc, with one row per point"""
+    distance, dc = np.broadcast_arrays(np.asarray(distance, float),
+                                       np.asarray(dc, float))
+    return poly.polyvander2d(distance.ravel(), dc.ravel(), [order, order])
+
+
+class CMBFit(object):
+    """Polynomial fit of the change in PcP - P time, dt (s), to distance
+       (degrees) and deflection of the CMB, dc (km, positive upwards)
+
+       coefficients are those of distance**i * dc**j, ordered by i then
+       j, for i and j from 0 to the order of the fit. covariance is
+       their covariance matrix (if known), rms the root mean square
+       misfit of the fit to the n points it was made from, and domain
+       the range of distance and dc of those points.
+    """
+
+    def __init__(self, coefficients, covariance=None, rms=None, n=None,
+                 domain=None):
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.order = int(round(np.sqrt(self.coefficients.size))) - 1
+        if (self.order + 1)**2 != self.coefficients.size:
+            raise ValueError("Need (order + 1)**2 coefficients")
+        self.covariance = covariance
+        if covariance is not None:
+            self.covariance = np.asarray(covariance, dtype=float)
+            if self.covariance.shape != (self.coefficients.size,)*2:
+                raise ValueError("Covariance must be square, with a row "
+                                 "for each coefficient")
+        self.rms = rms
+        self.n = n
+        self.domain = domain
+
+    @classmethod
+    def fit(cls, distance, dc, dt, order=2):
+        """Least squares fit to arrays of dt at distance and dc. The
+           covariance of the coefficients is estimated from the misfit."""
+        distance, dc, dt = [np.asarray(a, float).ravel() for a in
+                            np.broadcast_arrays(distance, dc, dt)]
+        ok = ~(np.isnan(distance) | np.isnan(dc) | np.isnan(dt))
+        distance, dc, dt = distance[ok], dc[ok], dt[ok]
+        g = design_matrix(distance, dc, order)
+        if len(dt) < g.shape[1]:
+            raise ValueError("Need at least {} points for a fit of order "
+                             "{}".format(g.shape[1], order))
+        coefficients, _, rank, _ = np.linalg.lstsq(g, dt, rcond=None)
+        if rank < g.shape[1]:
+            raise ValueError("Too few distinct distances or deflections for "
+                             "a fit of order {}".format(order))
+        residuals = dt - g.dot(coefficients)
+        dof = len(dt) - g.shape[1]
+        variance = residuals.dot(residuals)/dof if dof > 0 else 0.0
+        covariance = variance*np.linalg.inv(g.T.dot(g))
+        domain = ((distance.min(), distance.max()), (dc.min(), dc.max()))
+        return cls(coefficients, covariance, np.sqrt(np.mean(residuals**2)),
+                   len(dt), domain)
+
+    @classmethod
+    def from_sensitivity(cls, sens, depth=100.0, order=2,
+                         distance_range=None):
+        """Fit to a cmb_sensitivity.CMBSensitivity table at one source
+           depth (km), for all its distances and deflections or those
+           distances within distance_range (min, max)"""
+        distances = sens.distances
+        if distance_range is not None:
+            distances = distances[(distances >= distance_range[0]) &
+                                  (distances <= distance_range[1])]
+        distance, dc = np.meshgrid(distances, sens.dcs, indexing='ij')
+        return cls.fit(distance, dc, sens(distance, depth, dc), order)
+
+    def _matrix(self):
+        return self.coefficients.reshape(self.order + 1, self.order + 1)
+
+    def dt(self, distance, dc):
+        """Change in PcP - P time (s) at distance for deflection dc, for
+           arrays (broadcast together) or scalars"""
+        distance, dc = np.broadcast_arrays(np.asarray(distance, float),
+                                           np.asarray(dc, float))
+        return poly.polyval2d(distance, dc, self._matrix())
+
+    def slope(self, distance, dc):
+        """Derivative of dt with dc (s/km), as for dt"""
+        distance, dc = np.broadcast_arrays(np.asarray(distance, float),
+                                           np.asarray(dc, float))
+        return poly.polyval2d(distance, dc, poly.polyder(self._matrix(),
+                                                         axis=1))
+
+    def deflection(self, dt, distance, iterations=50, tol=1e-9):
+        """Deflection of the CMB (km) giving each change dt (s) in PcP - P
+           time at distance (degrees), for arrays (broadcast together) or
+           scalars. NaN where no deflection gives dt. For fits of order
+           greater than two, Newton's method is used, and values that
+           have not converged to within tol km after iterations steps are
+           also NaN."""
+        dt, distance = np.broadcast_arrays(np.asarray(dt, float),
+                                           np.asarray(distance, float))
+        shape = dt.shape
+        dt, distance = dt.ravel(), distance.ravel()
+        # Coefficients of dc**j at each distance, shape (order + 1, n)
+        a = poly.polyval(distance, self._matrix())
+        a[0] = a[0] - dt
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.order == 0:
+                dc = np.where(a[0] == 0.0, 0.0, np.nan)
+            elif self.order <= 2:
+                dc = self._quadratic_root(a)
+            else:
+                dc = self._newton(a, iterations, tol)
+        return dc.reshape(shape)
+
+    @staticmethod
+    def _quadratic_root(a):
+        """Root nearest zero of a[0] + a[1]*x + a[2]*x**2 (a[2] may be
+           missing or zero), in the numerically stable form"""
+        c, b = a[0], a[1]
+        quadratic = a[2] if len(a) > 2 else np.zeros_like(c)
+        discriminant = b**2 - 4.0*quadratic*c
+        q = -0.5*(b + np.where(b >= 0.0, 1.0, -1.0)*np.sqrt(discriminant))
+        root = c/q
+        # If b and c are both zero, so is the root; if only b is zero
+        # (and there is no quadratic term) there is none
+        root[(q == 0.0) & (c == 0.0)] = 0.0
+        root[(q == 0.0) & (c != 0.0)] = np.nan
+        root[discriminant < 0.0] = np.nan
+        return root
+
+    @staticmethod
+    def _newton(a, iterations, tol):
+        """Root of the polynomials with coefficients a (one column each)
+           by Newton's method from the root of their linear part"""
+        derivative = poly.polyder(a, axis=0)
+        x = -a[0]/a[1]
+        converged = np.zeros(x.shape, dtype=bool)
+        for iteration in range(iterations):
+            step = poly.polyval(x, a, tensor=False) / \
+                poly.polyval(x, derivative, tensor=False)
+            x = np.where(converged, x, x - step)
+            converged |= np.abs(step) < tol
+            if converged.all():
+                break
+        x[~converged | ~np.isfinite(x)] = np.nan
+        return x
+
+    def deflection_error(self, dt, distance, dt_error=0.0):
+        """Standard error of the deflection for dt at distance, from the
+           covariance of the coefficients and an error dt_error (s) in dt
+           (arrays or scalars), to first order"""
+        if self.covariance is None:
+            raise ValueError("Fit has no covariance")
+        dt, distance, dt_error = np.broadcast_arrays(
+            np.asarray(dt, float), np.asarray(distance, float),
+            np.asarray(dt_error, float))
+        dc = self.deflection(dt, distance)
+        g = design_matrix(distance, dc, self.order)
+        fit_variance = np.einsum('ij,jk,ik->i', g, self.covariance, g)
+        variance = fit_variance.reshape(dc.shape) + dt_error**2
+        return np.sqrt(variance)/np.abs(self.slope(distance, dc))
+
+    def to_dict(self):
+        """The fit as a dictionary of lists and numbers, for json"""
+        result = {'order': self.order,
+                  'coefficients': self.coefficients.tolist()}
+        if self.covariance is not None:
+            result['covariance'] = self.covariance.tolist()
+        for name in ('rms', 'n', 'domain'):
+            value = getattr(self, name)
+            if value is not None:
+                result[name] = np.asarray(value).tolist()
+        return result
+
+    @classmethod
+    def from_dict(cls, values):
+        """Fit from a dictionary made by to_dict"""
+        return cls(values['coefficients'], values.get('covariance'),
+                   values.get('rms'), values.get('n'), values.get('domain'))
+
+    def save(self, filename):
+        """Write the fit to a json file"""
+        with open(filename, 'w') as fh:
+            json.dump(self.to_dict(), fh, indent=1)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a fit written by save"""
+        with open(filename, 'r') as fh:
+            return cls.from_dict(json.load(fh))
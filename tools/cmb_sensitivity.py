@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""Sensitivity of PcP - P times to the depth of the core-mantle boundary
+
+   The notebooks (dt_from_dCMB.ipynb, FitCMB.ipynb) find how much a
+   deflection of the CMB changes the PcP - P time by building a new
+   TauModel with the CMB moved (get_iasp91_cmb_perturbed_model) for
+   each deflection, every time, and asking TauP for the times at a few
+   distances. This module does that once for a range of deflections,
+   keeping each built model in a cache directory (so a model is only
+   ever built once for a base model and deflection), and tabulates the
+   change in PcP - P time on a grid of distance, source depth and
+   deflection. The table interpolates to any point in the grid, so
+   inversions need not call TauP at all:
+
+       sens = cmb_sensitivity.cached_sensitivity('iasp91_dcmb.npz')
+       dt = sens(distances, depths, dc)
+
+   A deflection dc (km) is positive upwards: the CMB is at a depth of
+   (the depth in the base model - dc), so a positive dc makes PcP, and
+   PcP - P, earlier. The top of the core and the bottom of the mantle
+   are stretched or squashed to fit, keeping the velocities at the
+   boundary the same, as in the notebooks. dt is the PcP - P time in
+   the perturbed model less that in the base model rebuilt in the same
+   way (with dc = 0), so it does not include any difference between
+   the model built here and the one packaged with obspy.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import scipy.interpolate
+import obspy.taup
+from obspy.taup import TauPyModel
+from obspy.taup.helper_classes import TauModelError
+from obspy.taup.seismic_phase import SeismicPhase
+from obspy.taup.taup_create import TauPCreate
+from obspy.taup.velocity_model import VelocityModel
+
+DEFAULT_CACHE_DIR = '.cmb_models'
+
+# PcP is only seen (before P is diffracted) out to about 95 degrees,
+# and dt changes smoothly with distance, depth and deflection
+DEFAULT_DISTANCES = np.arange(5.0, 96.0, 1.0)
+DEFAULT_DEPTHS = np.arange(0.0, 701.0, 50.0)
+DEFAULT_DCS = np.arange(-20.0, 20.1, 2.5)
+
+_TAUP_DATA_DIR = os.path.join(os.path.dirname(obspy.taup.__file__), 'data')
+
+
+def base_model_file(base):
+    """The velocity model file for base, which is either the name of a
+       file or of a model with a .tvel or .nd file in obspy's taup data
+       directory (e.g. 'iasp91', 'ak135' or 'prem')"""
+    if os.path.isfile(base):
+        return base
+    for extension in ('.tvel', '.nd'):
+        filename = os.path.join(_TAUP_DATA_DIR, base + extension)
+        if os.path.isfile(filename):
+            return filename
+    raise ValueError("No velocity model file for " + base)
+
+
+def perturbed_velocity_model(dc, base='iasp91'):
+    """The VelocityModel of base with the CMB moved up by dc km"""
+    model = VelocityModel.read_velocity_file(base_model_file(base))
+    above = model.layer_number_above(model.cmb_depth)[0]
+    if model.layers['bot_depth'][above] - dc <= \
+            model.layers['top_depth'][above] or \
+            model.layers['top_depth'][above + 1] - dc >= \
+            model.layers['bot_depth'][above + 1]:
+        raise ValueError("Deflection of {} km is more than the thickness "
+                         "of the layers at the CMB".format(dc))
+    model.layers['bot_depth'][above] -= dc
+    model.layers['top_depth'][above + 1] -= dc
+    model.cmb_depth -= dc
+    if not model.validate():
+        raise ValueError("Invalid model with a deflection of {} km".format(dc))
+    return model
+
+
+def model_filename(dc, base='iasp91', cache_dir=DEFAULT_CACHE_DIR):
+    """Where the TauModel of base with the CMB moved by dc is cached. The
+       name includes a hash of the base model file, so a changed file
+       gets new models."""
+    filename = base_model_file(base)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    with open(filename, 'rb') as fh:
+        digest = hashlib.sha1(fh.read()).hexdigest()[:12]
+    return os.path.join(cache_dir,
+                        '{}_{}_dc{:+.3f}.npz'.format(name, digest, dc))
+
+
+def _build_model(args):
+    """Build and cache one perturbed TauModel, unless already cached, and
+       return the name of the file"""
+    dc, base, cache_dir = args
+    filename = model_filename(dc, base, cache_dir)
+    if not os.path.exists(filename):
+        velocity_model = perturbed_velocity_model(dc, base)
+        tau_model = TauPCreate(base_model_file(base), None).create_tau_model(
+            velocity_model)
+        # Write to a temporary name first, so a half written file is
+        # never taken for a model
+        tmpfile = '{}.{}.tmp.npz'.format(filename[:-4], os.getpid())
+        tau_model.serialize(tmpfile)
+        os.rename(tmpfile, filename)
+    return filename
+
+
+def build_models(dcs, base='iasp91', cache_dir=DEFAULT_CACHE_DIR,
+                 processes=1):
+    """Build (or find in cache_dir) the TauModel of base for each
+       deflection in dcs, and return the names of their files, which
+       can be given to TauPyModel. Building a model takes a couple of
+       seconds, so processes > 1 builds that many at once."""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    jobs = [(float(dc), base, cache_dir) for dc in dcs]
+    return _map(_build_model, jobs, processes)
+
+
+def _map(function, jobs, processes):
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            return pool.map(function, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [function(job) for job in jobs]
+
+
+def _differential_times(args):
+    """PcP - P times (first arrivals) at each distance for a source at
+       depth in the model in a file, NaN where either phase does not
+       arrive"""
+    filename, distances, depth = args
+    tau_model = TauPyModel(model=filename).model.depth_correct(depth)
+    tau_model = tau_model.split_branch(0.0)
+    times = np.empty((2, len(distances)))
+    times.fill(np.nan)
+    for j, phase in enumerate(('P', 'PcP')):
+        try:
+            seismic_phase = SeismicPhase(phase, tau_model, 0.0)
+        except TauModelError:
+            continue
+        for i, distance in enumerate(distances):
+            arrivals = seismic_phase.calc_time(distance)
+            if len(arrivals) > 0:
+                times[j,i] = min(arrival.time for arrival in arrivals)
+    return times[1] - times[0]
+
+
+class CMBSensitivity(object):
+    """Change in PcP - P time with deflection of the CMB
+
+       dt is an array of shape (len(distances), len(depths), len(dcs))
+       giving the change in the PcP - P time (s) at each distance
+       (degrees) from a source at each depth (km) when the CMB of the
+       base model is moved up by each dc (km), or NaN where PcP or P does
+       not arrive. Usually this is made by build or read by load, and
+       called to interpolate dt.
+    """
+
+    def __init__(self, base, distances, depths, dcs, dt):
+        self.base = base
+        self.distances = np.asarray(distances, dtype=float)
+        self.depths = np.asarray(depths, dtype=float)
+        self.dcs = np.asarray(dcs, dtype=float)
+        self.dt = np.asarray(dt, dtype=float)
+        if self.dt.shape != (len(self.distances), len(self.depths),
+                             len(self.dcs)):
+            raise ValueError("dt must have one value for each distance, "
+                             "depth and dc")
+        self._interpolator = scipy.interpolate.RegularGridInterpolator(
+            (self.distances, self.depths, self.dcs), self.dt,
+            bounds_error=False, fill_value=np.nan)
+
+    @classmethod
+    def build(cls, base='iasp91', distances=DEFAULT_DISTANCES,
+              depths=DEFAULT_DEPTHS, dcs=DEFAULT_DCS,
+              cache_dir=DEFAULT_CACHE_DIR, processes=1):
+        """Make the table by building the perturbed models (see
+           build_models) and running TauP at every point of the grid,
+           using processes processes for both"""
+        dcs = np.asarray(dcs, dtype=float)
+        filenames = build_models(np.append(0.0, dcs), base, cache_dir,
+                                 processes)
+        jobs = [(filename, list(distances), depth)
+                for filename in filenames for depth in depths]
+        results = _map(_differential_times, jobs, processes)
+        times = np.array(results).reshape(len(filenames), len(depths),
+                                          len(distances))
+        dt = (times[1:] - times[0]).transpose(2, 1, 0)
+        return cls(base, distances, depths, dcs, dt)
+
+    def save(self, filename):
+        """Write the table to a numpy .npz file"""
+        with open(filename, 'wb') as fh:
+            np.savez(fh, base=np.array(self.base), distances=self.distances,
+                     depths=self.depths, dcs=self.dcs, dt=self.dt)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a table written by save"""
+        with np.load(filename) as data:
+            return cls(str(data['base']), data['distances'], data['depths'],
+                       data['dcs'], data['dt'])
+
+    def __call__(self, distance, depth, dc):
+        """Change in PcP - P time (s) at distance (degrees) from a source
+           at depth (km) for a deflection dc (km), interpolated linearly
+           from the table, for arrays (which are broadcast together) or
+           scalars. The result is NaN outside the grid."""
+        distance, depth, dc = np.broadcast_arrays(
+            np.asarray(distance, float), np.asarray(depth, float),
+            np.asarray(dc, float))
+        points = np.column_stack((distance.ravel(), depth.ravel(),
+                                  dc.ravel()))
+        return self._interpolator(points).reshape(distance.shape)
+
+
+def cached_sensitivity(filename, base='iasp91', distances=DEFAULT_DISTANCES,
+                       depths=DEFAULT_DEPTHS, dcs=DEFAULT_DCS,
+                       cache_dir=DEFAULT_CACHE_DIR, processes=1):
+    """Read a table from filename, or build it and save it there first if
+       the file does not exist or holds a different table"""
+    if os.path.exists(filename):
+        sens = CMBSensitivity.load(filename)
+        if sens.base == base and np.array_equal(sens.distances, distances) \
+                and np.array_equal(sens.depths, depths) and \
+                np.array_equal(sens.dcs, dcs):
+            return sens
+    sens = CMBSensitivity.build(base, distances, depths, dcs, cache_dir,
+                                processes)
+    sens.save(filename)
+    return sens
+
+
+if __name__ == "__main__":
+    # Build a table on the default grid, e.g.
+    # python cmb_sensitivity.py iasp91_dcmb.npz [base_model]
+    if len(sys.argv) not in (2, 3):
+        sys.exit("Usage: cmb_sensitivity.py table_file [base_model]")
+    base = sys.argv[2] if len(sys.argv) > 2 else 'iasp91'
+    sens = cached_sensitivity(sys.argv[1], base,
+                              processes=multiprocessing.cpu_count())
+    for distance in (30.0, 55.0, 80.0):
+        print("{:5.1f} deg, 100 km: dt = {:.3f} s for dc = +10 km".format(
+              distance, float(sens(distance, 100.0, 10.0))))
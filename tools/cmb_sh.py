@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""Spherical harmonic models of CMB topography
+
+   FitCMB.ipynb turns each PcP - P residual into a deflection of the
+   CMB under its bounce point (see cmb_fit), fits spherical harmonics
+   to the deflections with shtools.SHExpandLSQ, and then makes a map by
+   calling shtools.MakeGridPoint at each point of a one degree grid, in
+   a double loop. This module fits the coefficients to the residuals
+   themselves, given the sensitivity of each residual to a deflection
+   under its bounce point (s/km, e.g. the slope of a CMBFit at its
+   distance), so that
+
+       residual = sensitivity * deflection(bounce_lat, bounce_lon),
+
+   and evaluates the model at arrays of points, or on a whole grid, at
+   once:
+
+       fit = cmb_fit.CMBFit.from_sensitivity(sens, depth=100.0)
+       inversion = cmb_sh.SHInversion(bounce_lat, bounce_lon, 4,
+                                      fit.slope(distance, 0.0))
+       model = inversion.solve(resid, damping=0.1)
+       dcmb = model.grid()    # lat -90 to 90 by lon 0 to 360
+
+   The basis (the Legendre functions and the sines and cosines of
+   longitude at each point) is worked out when the SHInversion is made,
+   so the same points can be solved for many sets of residuals or
+   amounts of damping cheaply. With a sensitivity of one this is the
+   least squares expansion of values at points done by SHExpandLSQ.
+
+   Coefficients are kept as in SHTOOLS: an array cilm of shape (2, lmax
+   + 1, lmax + 1) holding the cosine (cilm[0,l,m]) and sine (cilm[1,l,m])
+   coefficients of 4-pi normalised real harmonics without the
+   Condon-Shortley phase, so they can be passed to and from pyshtools.
+"""
+
+import json
+
+import numpy as np
+import scipy.sparse.linalg
+
+# Points evaluated at a time by synthesize, to bound the memory used
+_CHUNK = 10000
+
+
+def legendre(lmax, z):
+    """4-pi normalised associated Legendre functions of z (an array or
+       scalar, cos(colatitude)) for degrees and orders up to lmax, without
+       the Condon-Shortley phase. The result has shape z.shape + (lmax +
+       1, lmax + 1), and element [..., l, m] is zero for m > l."""
+    z = np.asarray(z, dtype=float)
+    u = np.sqrt(np.clip(1.0 - z**2, 0.0, 1.0))
+    p = np.zeros(z.shape + (lmax + 1, lmax + 1))
+    p[..., 0, 0] = 1.0
+    for m in range(lmax + 1):
+        if m == 1:
+            p[..., 1, 1] = np.sqrt(3.0)*u
+        elif m > 1:
+            p[..., m, m] = np.sqrt((2.0*m + 1.0)/(2.0*m))*u * \
+                p[..., m - 1, m - 1]
+        if m < lmax:
+            p[..., m + 1, m] = np.sqrt(2.0*m + 3.0)*z*p[..., m, m]
+        for l in range(m + 2, lmax + 1):
+            a = np.sqrt((4.0*l**2 - 1.0)/(l**2 - m**2))
+            b = np.sqrt((2.0*l + 1.0)*((l - 1.0)**2 - m**2) /
+                        ((2.0*l - 3.0)*(l**2 - m**2)))
+            p[..., l, m] = a*z*p[..., l - 1, m] - b*p[..., l - 2, m]
+    return p
+
+
+def _trig(lmax, lon):
+    """cos(m*lon) and sin(m*lon) for lon in degrees, each of shape
+       lon.shape + (lmax + 1,)"""
+    angle = np.radians(np.asarray(lon, dtype=float))[..., np.newaxis] * \
+        np.arange(lmax + 1)
+    return np.cos(angle), np.sin(angle)
+
+
+def coefficient_index(lmax):
+    """Arrays (i, l, m) giving where in cilm each element of a vector of
+       coefficients goes: the cosine terms in order of degree then
+       order, followed by the sine terms of order greater than zero.
+       There are (lmax + 1)**2 of them."""
+    l, m = np.tril_indices(lmax + 1)
+    sine = m > 0
+    return (np.concatenate((np.zeros(len(l), dtype=int),
+                            np.ones(sine.sum(), dtype=int))),
+            np.concatenate((l, l[sine])), np.concatenate((m, m[sine])))
+
+
+def to_cilm(coefficients, lmax):
+    """cilm array from a vector of coefficients (see coefficient_index)"""
+    cilm = np.zeros((2, lmax + 1, lmax + 1))
+    cilm[coefficient_index(lmax)] = coefficients
+    return cilm
+
+
+def from_cilm(cilm):
+    """Vector of coefficients (see coefficient_index) from a cilm array"""
+    cilm = np.asarray(cilm, dtype=float)
+    return cilm[coefficient_index(cilm.shape[1] - 1)]
+
+
+def design_matrix(lat, lon, lmax):
+    """Value of each harmonic (columns, in the order of
+       coefficient_index) at each point (rows) at lat and lon (arrays,
+       broadcast together, in degrees)"""
+    lat, lon = [a.ravel() for a in np.broadcast_arrays(
+        np.asarray(lat, float), np.asarray(lon, float))]
+    p = legendre(lmax, np.sin(np.radians(lat)))
+    cos, sin = _trig(lmax, lon)
+    i, l, m = coefficient_index(lmax)
+    return p[:, l, m]*np.where(i == 0, cos[:, m], sin[:, m])
+
+
+def synthesize(cilm, lat, lon):
+    """Value of the model with coefficients cilm at lat and lon (arrays,
+       broadcast together, or scalars, in degrees), as MakeGridPoint
+       gives for each point"""
+    cilm = np.asarray(cilm, dtype=float)
+    lmax = cilm.shape[1] - 1
+    lat, lon = np.broadcast_arrays(np.asarray(lat, float),
+                                   np.asarray(lon, float))
+    shape = lat.shape
+    lat, lon = lat.ravel(), lon.ravel()
+    values = np.empty(len(lat))
+    for start in range(0, len(lat), _CHUNK):
+        chunk = slice(start, start + _CHUNK)
+        p = legendre(lmax, np.sin(np.radians(lat[chunk])))
+        cos, sin = _trig(lmax, lon[chunk])
+        values[chunk] = np.sum(np.einsum('klm,lm->km', p, cilm[0])*cos +
+                               np.einsum('klm,lm->km', p, cilm[1])*sin,
+                               axis=1)
+    return values.reshape(shape)
+
+
+def make_grid(cilm, lats=None, lons=None):
+    """Value of the model with coefficients cilm on the grid of points
+       at each of lats and each of lons (degrees), by default every
+       degree from -90 to 90 and from 0 to 360. The result has shape
+       (len(lats), len(lons))."""
+    cilm = np.asarray(cilm, dtype=float)
+    lmax = cilm.shape[1] - 1
+    if lats is None:
+        lats = np.arange(-90.0, 91.0)
+    if lons is None:
+        lons = np.arange(0.0, 361.0)
+    # The Legendre functions depend only on latitude, and the sines
+    # and cosines only on longitude, so each is only found once
+    p = legendre(lmax, np.sin(np.radians(np.asarray(lats, float))))
+    cos, sin = _trig(lmax, lons)
+    return np.einsum('klm,lm->km', p, cilm[0]).dot(cos.T) + \
+        np.einsum('klm,lm->km', p, cilm[1]).dot(sin.T)
+
+
+class SHModel(object):
+    """Spherical harmonic model of deflection of the CMB (km, positive
+       upwards) with coefficients cilm (see the module docstring)
+
+       If the model was made by an inversion, covariance is the
+       covariance matrix of its coefficients (in the order of
+       coefficient_index, if known), rms and chi2 the root mean square
+       and the sum of the squares of the misfit to the n residuals it
+       was made from (each divided by its error, if they had errors),
+       and damping and roughness the regularisation used.
+    """
+
+    def __init__(self, cilm, covariance=None, rms=None, chi2=None, n=None,
+                 damping=0.0, roughness=0.0):
+        self.cilm = np.asarray(cilm, dtype=float)
+        self.lmax = self.cilm.shape[1] - 1
+        if self.cilm.shape != (2, self.lmax + 1, self.lmax + 1):
+            raise ValueError("cilm must have shape (2, lmax + 1, lmax + 1)")
+        self.covariance = covariance
+        if covariance is not None:
+            self.covariance = np.asarray(covariance, dtype=float)
+            if self.covariance.shape != ((self.lmax + 1)**2,)*2:
+                raise ValueError("Covariance must be square, with a row "
+                                 "for each coefficient")
+        self.rms = rms
+        self.chi2 = chi2
+        self.n = n
+        self.damping = damping
+        self.roughness = roughness
+
+    @property
+    def coefficients(self):
+        """The coefficients as a vector (see coefficient_index)"""
+        return from_cilm(self.cilm)
+
+    def __call__(self, lat, lon):
+        """Deflection (km) at lat and lon, as for synthesize"""
+        return synthesize(self.cilm, lat, lon)
+
+    def grid(self, lats=None, lons=None):
+        """Deflection (km) on a grid, as for make_grid"""
+        return make_grid(self.cilm, lats, lons)
+
+    def power(self):
+        """Mean square deflection (km**2) over the sphere in each degree"""
+        return np.sum(self.cilm**2, axis=(0, 2))
+
+    def to_dict(self):
+        """The model as a dictionary of lists and numbers, for json"""
+        result = {'lmax': self.lmax, 'cilm': self.cilm.tolist(),
+                  'damping': self.damping, 'roughness': self.roughness}
+        if self.covariance is not None:
+            result['covariance'] = self.covariance.tolist()
+        for name in ('rms', 'chi2', 'n'):
+            value = getattr(self, name)
+            if value is not None:
+                result[name] = np.asarray(value).tolist()
+        return result
+
+    @classmethod
+    def from_dict(cls, values):
+        """Model from a dictionary made by to_dict"""
+        return cls(values['cilm'], values.get('covariance'),
+                   values.get('rms'), values.get('chi2'), values.get('n'),
+                   values.get('damping', 0.0), values.get('roughness', 0.0))
+
+    def save(self, filename):
+        """Write the model to a json file"""
+        with open(filename, 'w') as fh:
+            json.dump(self.to_dict(), fh, indent=1)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a model written by save"""
+        with open(filename, 'r') as fh:
+            return cls.from_dict(json.load(fh))
+
+
+class SHInversion(object):
+    """Least squares inversion of residuals at points at lat and lon
+       (degrees, e.g. the bounce points of PcP) for a spherical harmonic
+       model of degree lmax of the deflection of the CMB
+
+       sensitivity is the change in each residual with deflection under
+       its point (s/km), and error the standard error of each residual
+       (s), if known. These are arrays (broadcast with lat and lon) or
+       scalars. Points where any of them is not finite are left out.
+    """
+
+    def __init__(self, lat, lon, lmax, sensitivity=1.0, error=None):
+        lat, lon, sensitivity, error = [a.ravel() for a in
+            np.broadcast_arrays(np.asarray(lat, float),
+                                np.asarray(lon, float),
+                                np.asarray(sensitivity, float),
+                                np.asarray(1.0 if error is None else error,
+                                           float))]
+        self.lmax = lmax
+        self.n = len(lat)
+        self.ok = np.isfinite(lat) & np.isfinite(lon) & \
+            np.isfinite(sensitivity) & np.isfinite(error) & (error > 0.0)
+        self.lat, self.lon = lat, lon
+        self.sensitivity, self.error = sensitivity, error
+        self.degrees = coefficient_index(lmax)[1]
+        # The harmonics at each point and the residuals they make (each
+        # divided by its error), found once for all the solutions
+        self.basis = np.zeros((self.n, (lmax + 1)**2))
+        self.basis[self.ok] = design_matrix(lat[self.ok], lon[self.ok],
+                                            lmax)
+        self.kernel = self.basis * \
+            np.where(self.ok, sensitivity/error, 0.0)[:, np.newaxis]
+        self._normal = None
+
+    def penalty(self, damping=0.0, roughness=0.0):
+        """Diagonal of the regularisation added to the normal equations:
+           damping**2 times the mean square deflection plus roughness**2
+           times the mean square of its gradient (km/radian) over the
+           sphere"""
+        return damping**2 + roughness**2*self.degrees*(self.degrees + 1.0)
+
+    def normal_matrix(self):
+        """The normal matrix of the unregularised problem for all the
+           points (computed once)"""
+        if self._normal is None:
+            self._normal = self.kernel.T.dot(self.kernel)
+        return self._normal
+
+    def predict(self, model):
+        """Residual (s) at each point given by model (NaN at points that
+           are left out)"""
+        dt = self.basis.dot(model.coefficients)*self.sensitivity
+        return np.where(self.ok, dt, np.nan)
+
+    def solve(self, resid, damping=0.0, roughness=0.0, method='dense',
+              weights=None):
+        """Model minimising the sum of the squares of the misfits to
+           resid (s, one for each point, NaN to leave a point out) divided
+           by their errors plus the regularisation (see penalty). weights
+           (e.g. how many times each point is drawn in a bootstrap sample)
+           multiply the square of each misfit.
+
+           method 'dense' solves the normal equations, giving the
+           covariance of the coefficients (from the misfit). 'sparse'
+           uses scipy.sparse.linalg.lsqr on the points and regularisation
+           without forming them, which is better conditioned but gives no
+           covariance."""
+        resid = np.broadcast_to(np.asarray(resid, float).ravel(), (self.n,))
+        use = self.ok & np.isfinite(resid)
+        if weights is None:
+            scale = np.ones(self.n)
+        else:
+            weights = np.broadcast_to(np.asarray(weights, float).ravel(),
+                                      (self.n,))
+            use &= weights > 0.0
+            scale = np.sqrt(np.where(use, weights, 0.0))
+        # Each row of the problem is multiplied by the square root of its
+        # weight
+        scale = scale[use]
+        kernel = self.kernel[use]*scale[:, np.newaxis]
+        data = resid[use]/self.error[use]*scale
+        penalty = self.penalty(damping, roughness)
+        nparams = kernel.shape[1]
+        normal = None
+        if method == 'dense':
+            if use.all() and weights is None:
+                normal = self.normal_matrix()
+            else:
+                normal = kernel.T.dot(kernel)
+            coefficients, _, rank, _ = np.linalg.lstsq(
+                normal + np.diag(penalty), kernel.T.dot(data), rcond=None)
+            if rank < nparams:
+                raise ValueError("Too few points to find {} coefficients; "
+                                 "use some damping".format(nparams))
+        elif method == 'sparse':
+            root = np.sqrt(penalty)
+            operator = scipy.sparse.linalg.LinearOperator(
+                (len(data) + nparams, nparams),
+                matvec=lambda x: np.concatenate((kernel.dot(x.ravel()),
+                                                 root*x.ravel())),
+                rmatvec=lambda y: kernel.T.dot(y.ravel()[:len(data)]) +
+                root*y.ravel()[len(data):])
+            coefficients = scipy.sparse.linalg.lsqr(
+                operator, np.concatenate((data, np.zeros(nparams))),
+                atol=1e-12, btol=1e-12, iter_lim=10*nparams)[0]
+        else:
+            raise ValueError("Unknown method " + str(method))
+        misfit = data - kernel.dot(coefficients)
+        chi2 = float(misfit.dot(misfit))
+        count = float(np.sum(scale**2))
+        covariance = None
+        if normal is not None:
+            dof = count - nparams
+            variance = chi2/dof if dof > 0 else 0.0
+            inverse = np.linalg.inv(normal + np.diag(penalty))
+            covariance = variance*inverse.dot(normal).dot(inverse)
+        return SHModel(to_cilm(coefficients, self.lmax), covariance,
+                       np.sqrt(chi2/count) if count > 0 else None, chi2,
+                       int(use.sum()), damping, roughness)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""Persistent cache of travel time corrections
+
+   Finding the tomographic correction for a path means tracing the
+   ray with TauP, which is slow, and re-running a notebook (or the
+   pipeline on a catalogue with a few new months in it) does the same
+   paths again. A CorrectionCache keeps each correction in an sqlite
+   database, keyed by
+
+   * a fingerprint of the model: a hash of the content of its files
+     and of any other settings (TauP model name, ellipsoid...),
+   * the phase, and
+   * the geometry of the path (e.g. source latitude, longitude and
+     depth and station latitude and longitude), rounded to some
+     number of decimal places (by default 4, which is how the ISC
+     gives locations),
+
+   so a correction is only ever calculated once for a model. Code that
+   calculates corrections takes a cache as an optional argument and
+   uses it without the caller noticing, e.g.
+
+       cache = correction_cache.CorrectionCache('corrections.sqlite')
+       corrector = tomocorr2.TomographicCorrection('ak135.1D_vp',
+                                                   'vdh3D_1999', cache=cache)
+       dt = corrector.calculate_many(evtlat, evtlon, evtdep, stalat,
+                                     stalon, ['P', 'PcP'])
+
+   The database holds at most max_entries corrections; when it is
+   full the least recently used are removed. Several processes can
+   use the same database (sqlite does the locking). Lookups only read
+   the database: which corrections were used is remembered and written
+   with the next store (or on flush or close), so processes that
+   mostly read do not wait for each other.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+import pick_cache
+
+# Bump this if the layout of the database changes
+FORMAT_VERSION = 2
+
+try:
+    _STRING_TYPES = basestring
+except NameError:
+    _STRING_TYPES = str
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS corrections (
+    fingerprint TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    geometry TEXT NOT NULL,
+    value REAL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (fingerprint, phase, geometry));
+CREATE INDEX IF NOT EXISTS corrections_used ON corrections (used);
+CREATE TABLE IF NOT EXISTS version (version INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS size (entries INTEGER NOT NULL);
+CREATE TRIGGER IF NOT EXISTS corrections_insert AFTER INSERT ON corrections
+    BEGIN UPDATE size SET entries = entries + 1; END;
+CREATE TRIGGER IF NOT EXISTS corrections_delete AFTER DELETE ON corrections
+    BEGIN UPDATE size SET entries = entries - 1; END;
+"""
+
+
+def geometry_keys(geometry, decimals=4):
+    """Key of each path, from a sequence of arrays (broadcast together)
+       of coordinates rounded to decimals places. The key of any path
+       with a coordinate that is not finite is None."""
+    coordinates = np.broadcast_arrays(*[np.asarray(c, dtype=float)
+                                        for c in geometry])
+    coordinates = np.column_stack([c.ravel() for c in coordinates])
+    finite = np.all(np.isfinite(coordinates), axis=1)
+    rounded = np.zeros(coordinates.shape, dtype=np.int64)
+    rounded[finite] = np.round(coordinates[finite]*10**decimals)
+    keys = [','.join(str(c) for c in row) for row in rounded.tolist()]
+    return [key if ok else None for key, ok in zip(keys, finite)]
+
+
+class CorrectionCache(object):
+    """Corrections kept in the sqlite database filename, holding at most
+       max_entries of them, for path geometries rounded to decimals
+       places (see geometry_keys). The use of corrections found by
+       lookup is written to the database with the next store, or once
+       there are touch_batch of them."""
+
+    def __init__(self, filename, max_entries=10000000, decimals=4,
+                 touch_batch=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.decimals = decimals
+        self.touch_batch = touch_batch
+        self._connection = None
+        self._pid = None
+        self._fingerprints = {}
+        # Rows used since the last write of their use
+        self._touched = set()
+
+    def _connect(self):
+        """The connection to the database, opened the first time it is
+           needed in each process (connections cannot be shared by
+           forked processes)"""
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=60.0)
+            # So rows replaced by INSERT OR REPLACE are counted as deleted
+            connection.execute("PRAGMA recursive_triggers = ON")
+            with connection:
+                connection.executescript(_SCHEMA)
+                version = connection.execute(
+                    "SELECT version FROM version").fetchall()
+                if not version:
+                    connection.execute("INSERT INTO version VALUES (?)",
+                                       (FORMAT_VERSION,))
+                    connection.execute("INSERT INTO size VALUES (0)")
+                elif version[0][0] != FORMAT_VERSION:
+                    raise ValueError("Correction cache " + self.filename +
+                                     " has the wrong format version")
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS keys "
+                               "(row INTEGER, geometry TEXT)")
+            self._connection = connection
+            self._pid = os.getpid()
+            self._touched = set()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self.flush()
+            self._connection.close()
+        self._connection = None
+
+    def __getstate__(self):
+        # Other processes open their own connection
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_touched'] = set()
+        return state
+
+    def __len__(self):
+        # Kept up to date by triggers, as counting the rows means
+        # reading all of them
+        return self._connect().execute(
+            "SELECT entries FROM size").fetchone()[0]
+
+    def fingerprint(self, *parts):
+        """Hash identifying a model made from parts: each part that is
+           the name of a file stands for the content of the file, and
+           any other part for its str"""
+        sha = hashlib.sha1(str(FORMAT_VERSION).encode('utf-8'))
+        for part in parts:
+            if isinstance(part, _STRING_TYPES) and os.path.isfile(part):
+                stat = os.stat(part)
+                key = (os.path.abspath(part), stat.st_size, stat.st_mtime)
+                if key not in self._fingerprints:
+                    self._fingerprints[key] = pick_cache.file_hash(part)
+                part = 'file:' + self._fingerprints[key]
+            sha.update(repr(str(part)).encode('utf-8'))
+        return sha.hexdigest()[:16]
+
+    def _clock(self, connection):
+        """A number larger than the last use of any correction"""
+        used = connection.execute(
+            "SELECT MAX(used) FROM corrections").fetchone()[0]
+        return 1 if used is None else used + 1
+
+    def _touch(self, connection):
+        """Write the use of the rows used since this was last done"""
+        if self._touched:
+            used = self._clock(connection)
+            connection.executemany(
+                "UPDATE corrections SET used = ? WHERE rowid = ?",
+                [(used, rowid) for rowid in self._touched])
+            self._touched = set()
+
+    def flush(self):
+        """Write the use of the corrections found by lookup since the
+           last store (which does this too)"""
+        if self._touched:
+            connection = self._connect()
+            with connection:
+                self._touch(connection)
+
+    def lookup(self, fingerprint, phase, geometry):
+        """Cached corrections of phase for the paths with coordinates
+           geometry (a sequence of arrays, see geometry_keys) in the
+           model with fingerprint. Returns an array of the corrections
+           (NaN where not cached) and a boolean array of which are.
+           This only reads the database (see flush)."""
+        keys = geometry_keys(geometry, self.decimals)
+        values = np.empty(len(keys))
+        values.fill(np.nan)
+        found = np.zeros(len(keys), dtype=bool)
+        rows = [(i, key) for i, key in enumerate(keys) if key is not None]
+        if not rows:
+            return values, found
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM keys")
+            connection.executemany("INSERT INTO keys VALUES (?, ?)", rows)
+            for i, rowid, value in connection.execute(
+                    "SELECT keys.row, corrections.rowid, corrections.value "
+                    "FROM keys CROSS JOIN corrections ON "
+                    "corrections.fingerprint = ? AND corrections.phase = ? "
+                    "AND corrections.geometry = keys.geometry",
+                    (fingerprint, phase)):
+                found[i] = True
+                self._touched.add(rowid)
+                if value is not None:
+                    values[i] = value
+            connection.execute("DELETE FROM keys")
+        if len(self._touched) >= self.touch_batch:
+            self.flush()
+        return values, found
+
+    def store(self, fingerprint, phase, geometry, values):
+        """Add the corrections values of phase for the paths geometry
+           to the cache, as for lookup, then remove the least recently
+           used corrections if there are more than max_entries"""
+        keys = geometry_keys(geometry, self.decimals)
+        values = np.broadcast_to(np.asarray(values, dtype=float).ravel(),
+                                 (len(keys),))
+        connection = self._connect()
+        with connection:
+            self._touch(connection)
+            used = self._clock(connection)
+            connection.executemany(
+                "INSERT OR REPLACE INTO corrections VALUES (?, ?, ?, ?, ?)",
+                [(fingerprint, phase, key,
+                  float(value) if np.isfinite(value) else None, used)
+                 for key, value in zip(keys, values) if key is not None])
+            excess = connection.execute(
+                "SELECT entries FROM size").fetchone()[0] - self.max_entries
+            if excess > 0:
+                connection.execute(
+                    "DELETE FROM corrections WHERE rowid IN (SELECT rowid "
+                    "FROM corrections ORDER BY used LIMIT ?)", (excess,))
+
+    def cached(self, fingerprint, phase, geometry, function):
+        """Corrections of phase for the paths geometry, from the cache
+           where possible. function is called with an array of the
+           indices of the paths that are not cached, and returns their
+           corrections, which are then cached."""
+        coordinates = [c.ravel() for c in np.broadcast_arrays(
+            *[np.asarray(c, dtype=float) for c in geometry])]
+        values, found = self.lookup(fingerprint, phase, coordinates)
+        missing = np.flatnonzero(~found)
+        if len(missing) > 0:
+            values[missing] = function(missing)
+            self.store(fingerprint, phase, [c[missing] for c in coordinates],
+                       values[missing])
+        return values
+
+    def clear(self):
+        """Remove all the corrections"""
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM corrections")
+        self._touched = set()
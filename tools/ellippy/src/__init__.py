@@ -1,3 +1,5 @@
 from ellippy import ellip_setup 
+from ellippy import ensure_table
 from ellippy import ellip_correct
 from ellippy import ellip_src_sta
+from ellippy import ellip_corrections
@@ -1,8 +1,11 @@
-	subroutine direct()
+	subroutine direct(datfile,tblfile)
+c       Make the direct access table tblfile from the ellipticity
+c       coefficients in datfile (usually ELCOR.dat and elcordir.tbl)
+	character*(*) datfile,tblfile
 	real t1(6),t2(6),t3(6)
         character*8 phcod
-        open(15,file='ELCOR.dat',action='READ')
-        open(8,file='elcordir.tbl',access='direct',
+        open(15,file=datfile,action='READ')
+        open(8,file=tblfile,access='direct',
      ^       recl=80,form='formatted')
         nr=1
 10      read(15,*,end=11) phcod,n,d1,d2
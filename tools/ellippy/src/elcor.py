@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""Ellipticity corrections in numpy, without the Fortran
+
+   This reads the Dziewonski & Gilbert coefficients tau0, tau1 and
+   tau2 for the 57 phases in ELCOR.dat into arrays, and interpolates
+   them in the same way as ellcor in ellip.f, for any number of paths
+   at once. Parsing ELCOR.dat takes a little while, so the arrays are
+   cached in ELCOR.npz (next to it, if that can be written) and read
+   from there after the first time.
+
+       table = elcor.ElcorTable.load()
+       tcor = table.corrections(src_lat, src_depth, azim, delta, phase)
+
+   or just elcor.ellip_corrections(...), which uses a table loaded
+   the first time it is called. Results agree with the Fortran to
+   rounding error, and do not need the direct access file.
+"""
+
+import inspect
+import os
+import threading
+
+import numpy as np
+
+_DATA_DIR = os.path.dirname(os.path.abspath(inspect.getfile(
+              inspect.currentframe())))
+
+ELCOR_FILE = os.path.join(_DATA_DIR, 'ELCOR.dat')
+
+# Bump this if the arrays cached change
+CACHE_VERSION = 1
+
+# Source depths of the tables (km) and their spacing in distance (degrees)
+DEPTHS = np.array([0.0, 100.0, 200.0, 300.0, 500.0, 700.0])
+DISTANCE_STEP = 5.0
+
+# Other names for phases, from phase_alias in ellip.f (which misses
+# out sSb)
+ALIASES = {'Pg': 'P', 'Sg': 'S', 'pPg': 'pP', 'sPg': 'sP', 'pSg': 'pS',
+           'sSg': 'sS', 'Pb': 'P', 'Sb': 'S', 'pPb': 'pP', 'sPb': 'sP',
+           'pSb': 'pS', 'sSb': 'sS', 'Pn': 'P', 'Sn': 'S', 'pPn': 'pP',
+           'sPn': 'sP', 'pSn': 'pS', 'sSn': 'sS', 'SPn': 'SP', 'SPb': 'SP',
+           'SPg': 'SP', 'SnP': 'SP', 'PSn': 'PS', 'PnPn': 'PP', 'SnSn': 'SS',
+           'p': 'Pup', 's': 'Sup', 'pPdiff': 'pP', 'sPdiff': 'sP',
+           'pSdiff': 'pS', 'sSdiff': 'sS'}
+# ... those only used out to some distance (degrees)
+DISTANCE_ALIASES = {'PKPdiff': ('PKPbc', 165.0),
+                    'pPKPdiff': ('pPKPbc', 165.0),
+                    'sPKPdiff': ('sPKPbc', 165.0)}
+# ... and any phase starting with these is the same
+PREFIX_ALIASES = ("P'P'", "S'S'")
+
+# tan(geocentric latitude)/tan(geographic latitude), for WGS84
+_GEOCENTRIC_FACTOR = (1.0 - 1.0/298.257223563)**2
+
+
+def read_elcor_file(filename=ELCOR_FILE):
+    """Read the coefficients in an ELCOR.dat file
+
+       Returns the phase names, the number of distances for each, an
+       array of the distances (with shape (number of phases, greatest
+       number of distances), padded with NaN) and an array of tau0,
+       tau1 and tau2 (with shape (number of phases, 3, greatest number
+       of distances, number of depths), padded with zeros).
+    """
+    with open(filename, 'r') as fh:
+        words = fh.read().split()
+    phases = []
+    blocks = []
+    i = 0
+    while i < len(words):
+        phases.append(words[i])
+        n = int(words[i+1])
+        i += 4
+        size = n*(1 + 3*len(DEPTHS))
+        blocks.append(np.array(words[i:i+size], dtype=float).reshape(n, -1))
+        i += size
+    nmax = max(len(block) for block in blocks)
+    counts = np.array([len(block) for block in blocks])
+    distances = np.empty((len(phases), nmax))
+    distances.fill(np.nan)
+    tau = np.zeros((len(phases), 3, nmax, len(DEPTHS)))
+    for k, block in enumerate(blocks):
+        distances[k,:len(block)] = block[:,0]
+        tau[k,:,:len(block)] = block[:,1:].reshape(len(block), 3,
+            len(DEPTHS)).transpose(1, 0, 2)
+    return phases, counts, distances, tau
+
+
+class ElcorTable(object):
+    """Ellipticity correction coefficients for some phases
+
+       phases is a list of phase names, counts the number of distances
+       tabulated for each, distances those distances (degrees) and tau
+       the coefficients (s), as returned by read_elcor_file.
+    """
+
+    def __init__(self, phases, counts, distances, tau):
+        self.phases = [str(phase) for phase in phases]
+        self.counts = np.asarray(counts, dtype=int)
+        self.distances = np.asarray(distances, dtype=float)
+        self.tau = np.asarray(tau, dtype=float)
+        self._index = dict((phase, i) for i, phase in enumerate(self.phases))
+
+    @classmethod
+    def load(cls, filename=ELCOR_FILE, cache_file=None):
+        """Table from an ELCOR.dat file, using (and if need be making) a
+           cache of it in cache_file, by default the same file name with
+           .npz in place of .dat. If the cache cannot be written, the
+           table is just read."""
+        if cache_file is None:
+            cache_file = os.path.splitext(filename)[0] + '.npz'
+        stat = os.stat(filename)
+        key = np.array([CACHE_VERSION, stat.st_size, stat.st_mtime])
+        try:
+            with np.load(cache_file) as data:
+                if np.array_equal(data['key'], key):
+                    return cls(data['phases'], data['counts'],
+                               data['distances'], data['tau'])
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+        table = cls(*read_elcor_file(filename))
+        try:
+            table.save(cache_file, key)
+        except (IOError, OSError):
+            pass
+        return table
+
+    def save(self, filename, key=None):
+        """Write the table to a numpy .npz file, with a key saying what
+           file it was read from (see load)"""
+        # Write to a temporary name first, so another process never
+        # reads a half written file
+        tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmpfile, 'wb') as fh:
+            np.savez(fh, key=np.asarray(key), phases=np.array(self.phases),
+                     counts=self.counts, distances=self.distances,
+                     tau=self.tau)
+        os.rename(tmpfile, filename)
+
+    def phase_index(self, phase, delta):
+        """Index in the table of each phase (a name or array of names) at
+           distance delta (degrees), allowing for aliases, or -1 if there
+           is no table for the phase"""
+        phase, delta = np.broadcast_arrays(np.asarray(phase),
+                                           np.asarray(delta, dtype=float))
+        names, codes = np.unique(phase.ravel(), return_inverse=True)
+        delta = delta.ravel()
+        index = np.empty(len(codes), dtype=int)
+        for i, name in enumerate(names):
+            rows = codes == i
+            name = str(name).strip()[:8]
+            if name in DISTANCE_ALIASES:
+                alias, limit = DISTANCE_ALIASES[name]
+                index[rows] = np.where(delta[rows] <= limit,
+                                       self._index.get(alias, -1), -1)
+                continue
+            if name not in self._index:
+                name = ALIASES.get(name, name)
+                for prefix in PREFIX_ALIASES:
+                    if name.startswith(prefix):
+                        name = prefix
+            index[rows] = self._index.get(name, -1)
+        return index.reshape(phase.shape)
+
+    def corrections(self, src_lat, src_depth, azim, delta, phase):
+        """Ellipticity corrections (s) for arrays of paths
+
+           src_lat: source lattitude (in degrees)
+           src_depth: source depth (in km)
+           azim: azimuth from source (in degrees)
+           delta: epicentral distance (in degrees)
+           phase: phase name, or array of phase names
+
+           The arguments can be arrays or scalars, and are broadcast
+           together. Raises ValueError if a phase is not in the table.
+           Distances and depths outside the table are extrapolated
+           from the nearest interval.
+        """
+        src_lat, src_depth, azim, delta, phase = np.broadcast_arrays(
+            np.asarray(src_lat, dtype=float),
+            np.asarray(src_depth, dtype=float),
+            np.asarray(azim, dtype=float), np.asarray(delta, dtype=float),
+            np.asarray(phase))
+        ip = self.phase_index(phase, delta)
+        if np.any(ip < 0):
+            raise ValueError("Phase " + str(phase[ip < 0].flat[0]).strip() +
+                             " is not in the phase list")
+
+        # Distance and depth intervals, as in ellcor
+        first = self.distances[ip,0]
+        idist = np.floor((delta - first)/DISTANCE_STEP).astype(int)
+        idist = np.clip(idist, 0, self.counts[ip] - 2)
+        jdepth = np.clip(np.searchsorted(DEPTHS, src_depth) - 1, 0,
+                         len(DEPTHS) - 2)
+        d0 = self.distances[ip,idist]
+        fd = (delta - d0)/(self.distances[ip,idist+1] - d0)
+        fz = (src_depth - DEPTHS[jdepth])/(DEPTHS[jdepth+1] - DEPTHS[jdepth])
+
+        k = np.arange(3).reshape((3,) + (1,)*ip.ndim)
+        tau = self.tau[ip,k,idist,jdepth]*(1.0 - fd)*(1.0 - fz) + \
+            self.tau[ip,k,idist+1,jdepth]*fd*(1.0 - fz) + \
+            self.tau[ip,k,idist,jdepth+1]*(1.0 - fd)*fz + \
+            self.tau[ip,k,idist+1,jdepth+1]*fd*fz
+
+        co_lat = np.radians(90.0 - src_lat)
+        azim = np.radians(azim)
+        s3 = np.sqrt(3.0)/2.0
+        return 0.25*(1.0 + 3.0*np.cos(2.0*co_lat))*tau[0] + \
+            s3*np.sin(2.0*co_lat)*np.cos(azim)*tau[1] + \
+            s3*np.sin(co_lat)**2*np.cos(2.0*azim)*tau[2]
+
+    def src_sta_corrections(self, src_lat, src_lon, src_depth, sta_lat,
+                            sta_lon, phase):
+        """Ellipticity corrections (s) for sources and stations, as
+           ellippy.ellip_src_sta: latitudes are geographic, and the
+           distance, azimuth and source colatitude are geocentric. If
+           phase is a list (or tuple) this returns a dictionary of arrays
+           of corrections for each phase."""
+        src_gc_lat = geocentric_latitude(src_lat)
+        delta, azim = delta_azimuth(src_gc_lat, src_lon,
+                                    geocentric_latitude(sta_lat), sta_lon)
+        if not isinstance(phase, (list, tuple)):
+            return self.corrections(src_gc_lat, src_depth, azim, delta,
+                                    phase)
+        return dict((name, self.corrections(src_gc_lat, src_depth, azim,
+                                            delta, name))
+                    for name in phase)
+
+
+def geocentric_latitude(lat):
+    """Geocentric latitude (in degrees) of geographic latitude lat (in
+       degrees), on the WGS84 ellipsoid"""
+    return np.degrees(np.arctan(_GEOCENTRIC_FACTOR*np.tan(np.radians(lat))))
+
+
+def delta_azimuth(src_lat, src_lon, sta_lat, sta_lon):
+    """Distance (in degrees) and azimuth from the source (in degrees,
+       clockwise from north) between points on a sphere, for arrays
+       (broadcast together) or scalars of latitude and longitude (in
+       degrees)"""
+    lat1 = np.radians(src_lat)
+    lat2 = np.radians(sta_lat)
+    dlon = np.radians(np.asarray(sta_lon) - np.asarray(src_lon))
+    east = np.cos(lat2)*np.sin(dlon)
+    north = np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*np.cos(lat2)*np.cos(dlon)
+    delta = np.arctan2(np.hypot(east, north), np.sin(lat1)*np.sin(lat2) +
+                       np.cos(lat1)*np.cos(lat2)*np.cos(dlon))
+    return np.degrees(delta), np.degrees(np.arctan2(east, north)) % 360.0
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def default_table():
+    """The table from ELCOR.dat, loaded the first time it is needed"""
+    global _table
+    with _table_lock:
+        if _table is None:
+            _table = ElcorTable.load()
+    return _table
+
+
+def ellip_corrections(src_lat, src_depth, azim, delta, phase):
+    """Ellipticity corrections (s) for arrays of paths, from the default
+       table; see ElcorTable.corrections"""
+    return default_table().corrections(src_lat, src_depth, azim, delta,
+                                       phase)
@@ -238,6 +238,128 @@ c
 c
       return
 c<ec>
+      end
+      subroutine ellcorv(table,phase,n,edist,edepth,ecolat,azim,
+     ^                   tcor,abrt)
+C==========================================================================
+C
+C    Ellipticity corrections for n paths of one phase, as ellref and
+C    ellcor, but reading the direct access table from the file named
+C    table (instead of elcordir.tbl in the current directory).  The
+C    whole table is read on the first call and kept until a call
+C    names a different file.  The source dependent constants are
+C    only recalculated when ecolat changes, so paths are best sorted
+C    by source.  Distances and depths outside the table are
+C    extrapolated from the nearest interval.
+C
+C    abrt(i) is set to .TRUE. if there is no data for the phase at
+C    edist(i), and tcor(i) is then zero.
+C
+C==========================================================================
+      character*(*) table, phase
+      integer n
+      real edist(n),edepth(n),ecolat(n),azim(n),tcor(n)
+      logical abrt(n)
+      integer MAXPH,MAXD,Nd
+      parameter (MAXPH=57,MAXD=50,Nd=6)
+      character*8 tcod(MAXPH)
+      character*512 tname
+      integer nps(MAXPH)
+      real dels(MAXD,MAXPH),dpth(Nd)
+      real t0(MAXD,Nd,MAXPH),t1(MAXD,Nd,MAXPH),t2(MAXD,Nd,MAXPH)
+      real sc0,sc1,sc2,s3,lastcl,deldst,d1,d2
+      real tau0,tau1,tau2,xd,yd,xz,yz,a,b,d,h,bil
+      integer i,j,k,m,nr,ip,ipname,nc,idist,jdepth,lnblk
+      logical loaded
+      save tcod,tname,nps,dels,t0,t1,t2,loaded
+      data loaded/.FALSE./
+      data dpth/ 0.0, 100.0, 200.0, 300.0, 500.0, 700.0 /
+c                                  bilinear interpolation, in the same
+c                                  order of operations as ellcor
+      bil(a,b,d,h) = (a + (d-a)*xd/yd) +
+     ^    ((b + (h-b)*xd/yd) - (a + (d-a)*xd/yd))*xz/yz
+
+      deldst = 5.0
+      s3 = sqrt(3.0)/2.0
+c                                  read the table, if not already read
+      if (.not.loaded .or. tname.ne.table) then
+        open(21,file=table,access='direct',form='formatted',recl=80,
+     ^       status='old')
+        nr = 1
+        do 5 k=1,MAXPH
+          read(21,61,rec=nr) tcod(k),nps(k),d1,d2
+          nr = nr+1
+          do 4 i=1,nps(k)
+            read(21,62,rec=nr) dels(i,k)
+            read(21,63,rec=nr+1) (t0(i,m,k),m=1,Nd)
+            read(21,63,rec=nr+2) (t1(i,m,k),m=1,Nd)
+            read(21,63,rec=nr+3) (t2(i,m,k),m=1,Nd)
+            nr = nr+4
+ 4        continue
+ 5      continue
+        close(21)
+        tname = table
+        loaded = .TRUE.
+      endif
+ 61   format(a8,i10,2f10.0)
+ 62   format(f10.0)
+ 63   format(6f10.4)
+c                                  select phase
+      ipname = -1
+      nc = min(lnblk(phase),8)
+      do 10 k=1,MAXPH
+        if (nc.gt.0 .and. phase(1:nc).eq.tcod(k)) then
+          ipname = k
+          goto 11
+        endif
+ 10   continue
+ 11   continue
+
+      do 30 i=1,n
+        tcor(i) = 0.0
+        abrt(i) = .FALSE.
+        ip = ipname
+        if (ip.eq.-1) call phase_alias(phase,edist(i),ip)
+        if (ip.lt.0 .or. ip.gt.MAXPH) then
+          abrt(i) = .TRUE.
+          goto 30
+        endif
+c                                  source dependent constants
+        if (i.eq.1 .or. ecolat(i).ne.lastcl) then
+          sc0 = 0.25*(1.0+3.0*cos(2.0*ecolat(i)))
+          sc1 = s3*sin(2.0*ecolat(i))
+          sc2 = s3*sin(ecolat(i))*sin(ecolat(i))
+          lastcl = ecolat(i)
+        endif
+c                                  distance index
+        idist = 1 + int((edist(i)-dels(1,ip))/deldst)
+        if (edist(i).lt.dels(1,ip)) idist = 1
+        idist = min(idist,nps(ip)-1)
+c                                  depth index
+        jdepth = Nd-1
+        if (edepth(i).lt.dpth(1)) jdepth = 1
+        do 25 j=1,Nd-1
+          if ((dpth(j).le.edepth(i)).and.(dpth(j+1).ge.edepth(i))) then
+            jdepth = j
+            goto 26
+          endif
+ 25     continue
+ 26     continue
+
+        xd = edist(i)-dels(idist,ip)
+        yd = dels(idist+1,ip)-dels(idist,ip)
+        xz = edepth(i)-dpth(jdepth)
+        yz = dpth(jdepth+1)-dpth(jdepth)
+        tau0 = bil(t0(idist,jdepth,ip),t0(idist,jdepth+1,ip),
+     ^             t0(idist+1,jdepth,ip),t0(idist+1,jdepth+1,ip))
+        tau1 = bil(t1(idist,jdepth,ip),t1(idist,jdepth+1,ip),
+     ^             t1(idist+1,jdepth,ip),t1(idist+1,jdepth+1,ip))
+        tau2 = bil(t2(idist,jdepth,ip),t2(idist,jdepth+1,ip),
+     ^             t2(idist+1,jdepth,ip),t2(idist+1,jdepth+1,ip))
+        tcor(i) = sc0*tau0 + sc1*cos(azim(i))*tau1
+     ^            + sc2*cos(2.0*azim(i))*tau2
+ 30   continue
+      return
       end
       subroutine phase_alias(phase,delta,ip)
 
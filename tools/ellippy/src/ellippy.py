@@ -2,22 +2,49 @@
 
 import inspect
 import os
+import tempfile
+import threading
 
 import numpy as np
 
 __DATA_DIR = os.path.dirname(os.path.abspath(inspect.getfile(
               inspect.currentframe())))
 
+# The direct access file made by ellip_setup
+_TABLE_FILE = os.path.join(__DATA_DIR, 'elcordir.tbl')
+
+# ellip_fort keeps the table it has read, so calls must not overlap
+_FORT_LOCK = threading.Lock()
+
 import ellip_fort
 import direct_fort
+from elcor import geocentric_latitude, delta_azimuth
 
 def ellip_setup():
-
-    # Nasty nasty nasty Fortran, with no concept of a path
-    startdir = os.getcwd()
-    os.chdir(__DATA_DIR)
-    direct_fort.direct()
-    os.chdir(startdir)
+    """Make the direct access table from ELCOR.dat. The Fortran is
+       given the full paths of both, so this does not change directory
+       (which would move every other thread too). The table is written
+       to a temporary file first, so nobody reads half of it."""
+
+    fd, tmpfile = tempfile.mkstemp(dir=__DATA_DIR)
+    os.close(fd)
+    os.remove(tmpfile)
+    try:
+        direct_fort.direct(os.path.join(__DATA_DIR, 'ELCOR.dat'), tmpfile)
+        os.rename(tmpfile, _TABLE_FILE)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def ensure_table():
+    """Make the direct access table, with ellip_setup, if it is not
+       there (it is generated, so it is not kept in the repository),
+       and return the name of the file"""
+
+    with _FORT_LOCK:
+        if not os.path.exists(_TABLE_FILE):
+            ellip_setup()
+    return _TABLE_FILE
     
 
 def ellip_correct(src_lat, src_depth, bazim, delta, phase):
@@ -30,38 +57,109 @@ def ellip_correct(src_lat, src_depth, bazim, delta, phase):
       
    """
 
-   # Convert src_lat to co-lat
-   co_lat = (90.0 - src_lat)
-
-   # convert all angular values from degrees to rad
-   co_lat = np.radians(co_lat)
-   bazim = np.radians(bazim)
-   #delta = np.radians(delta)
-
-   # Phase must be 8 chars (at least)
-   if len(phase) < 8:
-      phase = phase + (' '*(8-len(phase)))
-
-   # call fortran
-   # Nasty nasty nasty Fortran, with no concept of a path
-   startdir = os.getcwd()
-   os.chdir(__DATA_DIR)
-   ellip_fort.ellref(co_lat)
-   tcor, abrt = ellip_fort.ellcor(phase, delta, src_depth,
-        co_lat, bazim)
-   os.chdir(startdir)
-
-   # Handle "phase not found" errors
-   if abrt:
-       raise ValueError("Phase " + phase.strip() + " is not in the phase list")
-
-   return tcor
-
-def ellip_src_sta(src_lat, src_lon, src_depth, sta_lat, sta_lon, phase):
-
-    # FIXME: implement this...
-
-    raise NotImplementedError
+   return float(ellip_corrections(src_lat, src_depth, bazim, delta, 
+                                  phase)[()])
+
+def ellip_corrections(src_lat, src_depth, azim, delta, phase, cache=None):
+    """Ellipticity corrections (s) for arrays of paths
+
+       src_lat: source lattitude (in degrees)
+       src_depth: source depth (in km)
+       azim: azimuth from source (in degrees)
+       delta: epicentral distance (in degrees)
+       phase: phase name, or array of phase names
+       cache: optional correction_cache.CorrectionCache to take the
+              corrections from (and to add new ones to)
+
+       The arguments can be arrays or scalars, and are broadcast 
+       together. The paths are sorted by phase and source, so the 
+       source dependent constants are only calculated once for each
+       source. This does not change directory, and can be used from 
+       several threads (but only one calls the Fortran at a time).
+    """
+
+    src_lat, src_depth, azim, delta, phase = np.broadcast_arrays(
+        np.asarray(src_lat, dtype=float), np.asarray(src_depth, dtype=float),
+        np.asarray(azim, dtype=float), np.asarray(delta, dtype=float),
+        np.asarray(phase))
+    shape = src_lat.shape
+    if cache is not None:
+        return _cached_corrections(src_lat.ravel(), src_depth.ravel(),
+                                   azim.ravel(), delta.ravel(), 
+                                   phase.ravel(), cache).reshape(shape)
+    co_lat = np.radians(90.0 - src_lat.ravel()).astype(np.float32)
+    azim = np.radians(azim.ravel()).astype(np.float32)
+    src_depth = src_depth.ravel().astype(np.float32)
+    delta = delta.ravel().astype(np.float32)
+    phase = phase.ravel()
+
+    ensure_table()
+
+    # Group by phase, then by source
+    phases, codes = np.unique(phase, return_inverse=True)
+    order = np.lexsort((co_lat, codes))
+    starts = np.searchsorted(codes[order], np.arange(len(phases) + 1))
+    tcor = np.zeros(len(phase))
+    for i, name in enumerate(phases):
+        rows = order[starts[i]:starts[i+1]]
+        # Phase must be 8 chars (at least)
+        name = str(name)
+        with _FORT_LOCK:
+            tcor[rows], abrt = ellip_fort.ellcorv(_TABLE_FILE, 
+                name.ljust(8), delta[rows], src_depth[rows], co_lat[rows], 
+                azim[rows])
+        # Handle "phase not found" errors
+        if np.any(abrt):
+            raise ValueError("Phase " + name.strip() + 
+                             " is not in the phase list")
+
+    return tcor.reshape(shape)
+
+def _cached_corrections(src_lat, src_depth, azim, delta, phase, cache):
+    """ellip_corrections for 1D arrays, using cache for each phase"""
+
+    ensure_table()
+    fingerprint = cache.fingerprint('ellipticity', _TABLE_FILE)
+    tcor = np.zeros(len(phase))
+    for name in np.unique(phase):
+        rows = np.flatnonzero(phase == name)
+        geometry = (src_lat[rows], src_depth[rows], azim[rows], delta[rows])
+        tcor[rows] = cache.cached(fingerprint, str(name), geometry,
+            lambda missing: ellip_corrections(*([g[missing] for g in
+                                                 geometry] + [name])))
+    return tcor
+
+def ellip_src_sta(src_lat, src_lon, src_depth, sta_lat, sta_lon, phase,
+                  cache=None):
+    """Ellipticity corrections (s) for sources and stations
+
+       src_lat: source lattitude (in degrees)
+       src_lon: source longitude (in degrees)
+       src_depth: source depth (in km)
+       sta_lat: station lattitude (in degrees)
+       sta_lon: station longitude (in degrees)
+       phase: phase name (or array of names), or list of phase names
+
+       Latitudes are geographic, and converted to geocentric for the
+       distance and azimuth from source to station, and for the source
+       colatitude, which the corrections are for. The arguments can be
+       arrays (e.g. one value per pick, or sources with shape (n, 1) and 
+       stations with shape (m,) for every pair), and are broadcast 
+       together. If phase is a list (or tuple) this returns a 
+       dictionary of arrays of corrections for each phase, and 
+       otherwise an array of corrections. See ellip_corrections
+       (and for cache).
+    """
+
+    src_gc_lat = geocentric_latitude(src_lat)
+    delta, azim = delta_azimuth(src_gc_lat, src_lon,
+                                geocentric_latitude(sta_lat), sta_lon)
+    if not isinstance(phase, (list, tuple)):
+        return ellip_corrections(src_gc_lat, src_depth, azim, delta, phase,
+                                 cache)
+    return dict((name, ellip_corrections(src_gc_lat, src_depth, azim, 
+                                         delta, name, cache)) 
+                for name in phase)
 
 if __name__ == "__main__":
     # TODO: add doc string and use command line parser
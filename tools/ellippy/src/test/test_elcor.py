@@ -0,0 +1,76 @@
+"""Tests of the numpy ellipticity corrections
+
+   These check elcor against the ttimel cases in test_ellip
+   and against the Fortran.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+
+import elcor
+import ellippy
+from test_ellip import parse_ttimel_data, TTIMEL_LAT_0_DEPTH_0_AZI_0_DELTA_45
+
+def test_elcor_ttimel_lat_0_depth_0_azi_0_delta_45():
+
+    phases, corrections = parse_ttimel_data(
+        TTIMEL_LAT_0_DEPTH_0_AZI_0_DELTA_45)
+    npt.assert_almost_equal(elcor.ellip_corrections(0.0, 0.0, 0.0, 45.0,
+                                                    phases),
+                            corrections, decimal=3)
+    npt.assert_raises(ValueError, elcor.ellip_corrections,
+                      10.0, 10.0, 10.0, 10.0, ["P", "Q"])
+
+def test_elcor_agrees_with_fortran():
+    rng = np.random.RandomState(3)
+    n = 2000
+    src_lat = rng.uniform(-90.0, 90.0, n)
+    src_depth = rng.uniform(0.0, 700.0, n)
+    azim = rng.uniform(0.0, 360.0, n)
+    delta = rng.uniform(0.0, 180.0, n)
+    table = elcor.default_table()
+    phases = rng.choice(table.phases + ["Pn", "sSg", "p", "P'P'df",
+                                        "pPdiff"], n)
+    npt.assert_allclose(table.corrections(src_lat, src_depth, azim, delta,
+                                          phases),
+                        ellippy.ellip_corrections(src_lat, src_depth, azim,
+                                                  delta, phases),
+                        atol=2e-5)
+    corrections = table.corrections(src_lat[:6].reshape(2, 3), 100.0,
+                                    azim[:6].reshape(2, 3), 50.0, "PcP")
+    assert corrections.shape == (2, 3)
+
+def test_elcor_aliases():
+    table = elcor.default_table()
+    npt.assert_array_equal(table.phase_index(["Pn", "P", "PKPdiff",
+        "PKPdiff", "P'P'bc", "X"], [10.0, 10.0, 150.0, 170.0, 0.0, 0.0]),
+        [1, 1, 4, -1, table.phases.index("P'P'"), -1])
+
+def test_elcor_cache():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'ELCOR.dat')
+        shutil.copy(elcor.ELCOR_FILE, filename)
+        table = elcor.ElcorTable.load(filename)
+        assert len(table.phases) == 57
+        cache_file = os.path.join(tmpdir, 'ELCOR.npz')
+        assert os.path.exists(cache_file)
+        mtime = os.stat(cache_file).st_mtime
+        # The second time the .dat file is not read
+        def read_elcor_file(filename):
+            raise AssertionError("Read " + filename)
+        parser = elcor.read_elcor_file
+        elcor.read_elcor_file = read_elcor_file
+        try:
+            cached = elcor.ElcorTable.load(filename)
+        finally:
+            elcor.read_elcor_file = parser
+        assert os.stat(cache_file).st_mtime == mtime
+        assert cached.phases == table.phases
+        npt.assert_array_equal(cached.tau, table.tau)
+        npt.assert_array_equal(cached.distances, table.distances)
+    finally:
+        shutil.rmtree(tmpdir)
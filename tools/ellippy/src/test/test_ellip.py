@@ -5,9 +5,27 @@
    azimuth. All for ak135. 'basic' phases 
    are tested.
 """
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 import numpy.testing as npt
 
 import ellippy
+import ellip_fort
+
+TTIMEL_LAT_0_DEPTH_0_AZI_0_DELTA_45 = \
+    """1  P          497.1021   497.1409     7.9602  -1.57E-01  -4.24E-03
+           2  PcP        598.2408   598.3131     3.4483  -1.70E-01   6.53E-03
+           3  PP         602.0785   602.2909    10.6359  -1.43E-01  -4.85E-03
+           4  PP         605.1327   605.3451     9.1824  -1.51E-01  -2.47E-02
+           5  ScP        831.9159   832.2742     4.1221  -2.87E-01   7.86E-03
+           6  S          896.6008   896.6761    14.4881  -2.58E-01  -3.01E-03
+           7  PKiKP     1016.9644  1017.2147     0.9614  -1.72E-01   1.57E-02
+           8  PKKPdf    1891.0547  1895.3062    -0.9828  -1.72E-01  -1.46E-02
+           9  SKKPdf    2104.2104  2108.3516    -0.9346  -2.89E-01  -1.51E-02
+          10  P'P'df    2396.2705  2394.2739    -1.2510  -1.72E-01  -1.24E-02
+          11  P'P'ab    2459.6294  2457.6328    -4.3179  -1.68E-01   3.53E-02"""
 
 def parse_ttimel_data(data):
     """ttimeel data into phase and correction"""
@@ -34,17 +52,7 @@ def test_ellippy_ttimel_lat_0_depth_0_azi_0_delta_45():
     delta = 45.0
 
     phases, corrections = parse_ttimel_data(
-        """1  P          497.1021   497.1409     7.9602  -1.57E-01  -4.24E-03
-           2  PcP        598.2408   598.3131     3.4483  -1.70E-01   6.53E-03
-           3  PP         602.0785   602.2909    10.6359  -1.43E-01  -4.85E-03
-           4  PP         605.1327   605.3451     9.1824  -1.51E-01  -2.47E-02
-           5  ScP        831.9159   832.2742     4.1221  -2.87E-01   7.86E-03
-           6  S          896.6008   896.6761    14.4881  -2.58E-01  -3.01E-03
-           7  PKiKP     1016.9644  1017.2147     0.9614  -1.72E-01   1.57E-02
-           8  PKKPdf    1891.0547  1895.3062    -0.9828  -1.72E-01  -1.46E-02
-           9  SKKPdf    2104.2104  2108.3516    -0.9346  -2.89E-01  -1.51E-02
-          10  P'P'df    2396.2705  2394.2739    -1.2510  -1.72E-01  -1.24E-02
-          11  P'P'ab    2459.6294  2457.6328    -4.3179  -1.68E-01   3.53E-02""")
+        TTIMEL_LAT_0_DEPTH_0_AZI_0_DELTA_45)
 
     for phase, correction in zip(phases, corrections):
         correction_calc = ellippy.ellip_correct(src_lat, src_depth, 
@@ -53,5 +61,99 @@ def test_ellippy_ttimel_lat_0_depth_0_azi_0_delta_45():
                                 err_msg="(phase is " + phase + ")")
 
 
+def test_ellippy_corrections_ttimel_lat_0_depth_0_azi_0_delta_45():
+
+    phases, corrections = parse_ttimel_data(
+        TTIMEL_LAT_0_DEPTH_0_AZI_0_DELTA_45)
+
+    startdir = os.getcwd()
+    corrections_calc = ellippy.ellip_corrections(0.0, 0.0, 0.0, 45.0, 
+                                                 phases)
+    assert os.getcwd() == startdir
+    npt.assert_almost_equal(corrections_calc, corrections, decimal=3)
+    npt.assert_raises(ValueError, ellippy.ellip_corrections,
+                      0.0, 0.0, 0.0, 45.0, ["P", "Q"])
+
+def test_ellippy_corrections_agree_with_ellcor():
+    # Random paths, with sources in no particular order
+    rng = np.random.RandomState(42)
+    n = 500
+    src_lat = rng.choice(rng.uniform(-90.0, 90.0, 20), n)
+    src_depth = rng.uniform(0.0, 700.0, n)
+    azim = rng.uniform(0.0, 360.0, n)
+    delta = rng.uniform(30.0, 90.0, n)
+    phases = rng.choice(["P", "PcP", "ScS", "Pn", "pP"], n)
+
+    expected = np.empty(n)
+    startdir = os.getcwd()
+    os.chdir(os.path.dirname(os.path.abspath(ellippy.__file__)))
+    try:
+        for i in range(n):
+            co_lat = np.radians(90.0 - src_lat[i])
+            ellip_fort.ellref(co_lat)
+            expected[i], abrt = ellip_fort.ellcor(phases[i].ljust(8), 
+                delta[i], src_depth[i], co_lat, np.radians(azim[i]))
+    finally:
+        os.chdir(startdir)
+
+    npt.assert_array_equal(ellippy.ellip_corrections(src_lat, src_depth,
+        azim, delta, phases), expected)
+
+    # ... and from several threads at once
+    pool = ThreadPool(4)
+    try:
+        results = pool.map(lambda i: ellippy.ellip_corrections(
+            src_lat[i::4], src_depth[i::4], azim[i::4], delta[i::4],
+            phases[i::4]), range(4))
+    finally:
+        pool.close()
+    for i, result in enumerate(results):
+        npt.assert_array_equal(result, expected[i::4])
+
+def test_ellippy_setup():
+    # The table is made from anywhere, without changing directory
+    table = ellippy.ensure_table()
+    os.remove(table)
+    startdir = os.getcwd()
+    expected = ellippy.ellip_correct(0.0, 0.0, 0.0, 45.0, "PcP")
+    assert os.getcwd() == startdir
+    assert os.path.exists(table)
+    assert ellippy.ensure_table() == table
+    assert ellippy.ellip_correct(0.0, 0.0, 0.0, 45.0, "PcP") == expected
+
+def test_ellippy_src_sta():
+    # On the equator, geocentric and geographic latitudes are the same
+    npt.assert_almost_equal(ellippy.ellip_src_sta(0.0, 10.0, 0.0, 0.0, 55.0,
+                                                  "PcP"),
+                            ellippy.ellip_corrections(0.0, 0.0, 90.0, 45.0,
+                                                      "PcP"))
+    # Due north, distance is the difference in geocentric latitude
+    src_lat = np.array([10.0, -30.0, 20.0])
+    sta_lat = np.array([50.0, 30.0, 75.0])
+    delta = ellippy.geocentric_latitude(sta_lat) - \
+        ellippy.geocentric_latitude(src_lat)
+    corrections = ellippy.ellip_src_sta(src_lat, 100.0, 50.0, sta_lat, 
+                                        100.0, ["P", "PcP"])
+    assert sorted(corrections.keys()) == ["P", "PcP"]
+    for phase in ("P", "PcP"):
+        npt.assert_allclose(corrections[phase], ellippy.ellip_corrections(
+            ellippy.geocentric_latitude(src_lat), 50.0, 0.0, delta, phase),
+            atol=1e-6)
+    # Every source with every station
+    corrections = ellippy.ellip_src_sta(src_lat[:,None], 100.0, 50.0, 
+                                        sta_lat, -20.0, "S")
+    assert corrections.shape == (3, 3)
+    npt.assert_equal(corrections[1,2], ellippy.ellip_src_sta(src_lat[1],
+                     100.0, 50.0, sta_lat[2], -20.0, "S"))
+
+def test_ellippy_delta_azimuth():
+    # Values from geographiclib on a sphere
+    delta, azim = ellippy.delta_azimuth([0.0, 0.0, 10.0, 45.0], 
+        [0.0, 0.0, 20.0, 0.0], [0.0, 10.0, 10.0, 45.0], 
+        [30.0, 0.0, -10.0, 180.0])
+    npt.assert_allclose(delta, [30.0, 10.0, 29.533779, 90.0], atol=1e-6)
+    npt.assert_allclose(azim, [90.0, 0.0, 272.663988, 0.0], atol=1e-6)
+
+
 if __name__ == "__main__":
     test_ellippy_ttimel_lat_0_depth_0_azi_0_delta_45()
@@ -7,52 +7,119 @@
 #               <andrew.walker@bristol.ac.uk>
 import math as m
 
-def geog2cart(r, lat, lon):
+import numpy as np
+
+def _scalars(*args):
+    """True if all the arguments are scalars (not arrays), in which
+       case the math module is quicker than numpy"""
+    for arg in args:
+        if isinstance(arg, (float, int)):
+            continue
+        if np.ndim(arg) != 0 or isinstance(arg, np.ndarray):
+            return False
+    return True
+
+def geog2cart(r, lat, lon, out=None):
     """Converts from geograpical to 
        cartesian coordinates. Input lat
        and lon in degrees (lat: 90 -> 0 -> -90 
        north to south, lon: 0 -> 360 or 0 -> 
        90 -> 180 -> -90 -> 0 E -> W). Output in 
-       units of r."""
-
-    theta = m.radians(90.0 - lat)
-    if (lon < 0.0): 
-        lon = 360.0 + lon # -ve lon is degrees W of grenwich
-    phi = m.radians(lon)
-
-    return (sper2cart(r, phi, theta))
-
-def cart2geog(x, y, z):
+       units of r. 
+
+       The arguments can be numpy arrays, which are
+       broadcast together, and arrays (x, y, z) are
+       returned. If out is given, it is a tuple of three
+       arrays of the right shape, which the results are
+       written to (and returned)."""
+
+    if out is None and _scalars(r, lat, lon):
+        theta = m.radians(90.0 - lat)
+        if (lon < 0.0): 
+            lon = 360.0 + lon # -ve lon is degrees W of grenwich
+        phi = m.radians(lon)
+        return (sper2cart(r, phi, theta))
+
+    theta = np.radians(90.0 - np.asarray(lat, dtype=float))
+    lon = np.asarray(lon, dtype=float)
+    phi = np.radians(np.where(lon < 0.0, 360.0 + lon, lon))
+    return (sper2cart(r, phi, theta, out=out))
+
+def cart2geog(x, y, z, out=None):
     """Converts from our cartesian system (X3 to N pole,
        X1 to 0 E 0 N, X2 to 90 E 0 N) to geographical 
        coordinates (r, lat, lon). Radius units is the same
-       as the cartesian units system (typically km)."""
-    (r, theta, phi) = cart2sper(x, y, z)
-    lon = m.degrees(phi)
-    lat = (90.0 - m.degrees(theta))
+       as the cartesian units system (typically km). 
+       Arrays and out are as for geog2cart."""
+
+    if out is None and _scalars(x, y, z):
+        (r, theta, phi) = cart2sper(x, y, z)
+        lon = m.degrees(phi)
+        lat = (90.0 - m.degrees(theta))
+        return(r, lat, lon)
+
+    # Convert the new arrays (or out) in place
+    (r, lat, lon) = cart2sper(x, y, z, out=out)
+    np.degrees(lon, out=lon)
+    np.degrees(lat, out=lat)
+    np.subtract(90.0, lat, out=lat)
     return(r, lat, lon)
 
-def cart2sper(x, y, z):
+def cart2sper(x, y, z, out=None):
     """Converts from cartesian to spherical coordiates,
        angular results in radians, radial in units of 
        cart system. Theta is the angle between the point
        and the +ve Z-axis, phi is the angle between the 
        XZ plane and the point measured paralell to the XY
-       plane."""
-    r = m.sqrt(x**2 + y**2 + z**2)
-    # NB arctan2(a, b) is arctan(a/b) sorting out the quadrent
-    phi = m.atan2(y, x)
-    theta = m.acos(z/r)
-    return(r, theta, phi)
-
-def sper2cart (r, phi, theta):
+       plane. Arrays and out are as for geog2cart."""
+
+    if out is None and _scalars(x, y, z):
+        r = m.sqrt(x**2 + y**2 + z**2)
+        # NB arctan2(a, b) is arctan(a/b) sorting out the quadrent
+        phi = m.atan2(y, x)
+        theta = m.acos(z/r)
+        return(r, theta, phi)
+
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float),
+        np.asarray(y, dtype=float), np.asarray(z, dtype=float))
+    r = np.sqrt(x**2 + y**2 + z**2)
+    theta = np.arccos(z/r)
+    if out is None:
+        phi = np.arctan2(y, x)
+        return(r, theta, phi)
+    # out may be (x, y, z), so they are not used after writing to it
+    np.arctan2(y, x, out=out[2])
+    out[0][...] = r
+    out[1][...] = theta
+    return out
+
+def sper2cart (r, phi, theta, out=None):
     """Converts from sperical coordinates 
        to cartesian coordinates. Input theta
-       and phi are in radians"""
-
-    x = r * m.cos(phi) * m.sin(theta)
-    y = r * m.sin(phi) * m.sin(theta)
-    z = r * m.cos(theta)
+       and phi are in radians. Arrays and out are
+       as for geog2cart."""
+
+    if out is None and _scalars(r, phi, theta):
+        x = r * m.cos(phi) * m.sin(theta)
+        y = r * m.sin(phi) * m.sin(theta)
+        z = r * m.cos(theta)
+        return (x, y, z)
+
+    r, phi, theta = np.broadcast_arrays(np.asarray(r, dtype=float),
+        np.asarray(phi, dtype=float), np.asarray(theta, dtype=float))
+    sin_theta = np.sin(theta)
+    cos_theta = np.cos(theta)
+    cos_phi = np.cos(phi)
+    sin_phi = np.sin(phi)
+    if out is None:
+        out = (np.empty(r.shape), np.empty(r.shape), np.empty(r.shape))
+    (x, y, z) = out
+    # out may be (r, phi, theta), so r is used last
+    np.multiply(r, sin_phi, out=y)
+    np.multiply(y, sin_theta, out=y)
+    np.multiply(r, cos_theta, out=z)
+    np.multiply(r, cos_phi, out=x)
+    np.multiply(x, sin_theta, out=x)
     return (x, y, z)
 
 def geog2str(r, lat, lon):
@@ -220,6 +287,199 @@ def vincenty(lat1, lon1, lat2, lon2,
 
     return (s, m.degrees(alp1), m.degrees(alp2))
 
+def _ellipsoid(r_major, r_minor, r_sphere):
+    """Semi-major and semi-minor radius and flattening of the ellipsoid,
+       as given to vincenty"""
+    if (r_sphere is not None):
+        return (r_sphere, r_sphere, 0.0)
+    return (r_major, r_minor, (r_major-r_minor)/r_major)
+
+def vincenty_array(lat1, lon1, lat2, lon2, r_major=6378.1370, 
+                   r_minor=6356.752314, r_sphere=None, max_iter=500,
+                   epsilon=1E-12):
+    """
+    As vincenty, but for numpy arrays (or scalars) of the lattitudes and
+    longitudes of the points, which are broadcast together. All the 
+    points are iterated on at once, and each stops changing when it has
+    converged. 
+
+    A length three tuple of arrays is returned, giving the distance 
+    between the points and the azimuths of the geodesic at each. 
+    For points on the equator the geodesic is the equator (unless they
+    are nearly antipodal). Points for which the iteration does not 
+    converge in max_iter steps (which happens for nearly antipodal 
+    points) are done with geographiclib instead, or are NaN if that is
+    not installed.
+    """
+
+    r_major, r_minor, f = _ellipsoid(r_major, r_minor, r_sphere)
+    points = np.broadcast_arrays(*[np.asarray(a, dtype=float) 
+                                   for a in (lat1, lon1, lat2, lon2)])
+    shape = points[0].shape
+    lat1, lon1, lat2, lon2 = [np.radians(a.ravel()) for a in points]
+    U1 = np.arctan((1.0-f) * np.tan(lat1))
+    U2 = np.arctan((1.0-f) * np.tan(lat2))
+    L = lon2 - lon1
+    cU1 = np.cos(U1)
+    cU2 = np.cos(U2)
+    sU1 = np.sin(U1)
+    sU2 = np.sin(U2)
+
+    # The values of the last iteration for each point
+    lam = L.copy()
+    sin_sig = np.zeros(L.shape)
+    cos_sig = np.ones(L.shape)
+    sig = np.zeros(L.shape)
+    cos2_alp = np.ones(L.shape)
+    cos_2sigm = np.ones(L.shape)
+    # Points still being iterated on
+    active = np.arange(L.size)
+    for i in range(max_iter):
+        if active.size == 0:
+            break
+        lam_old = lam[active]
+        cU1a, cU2a, sU1a, sU2a = cU1[active], cU2[active], sU1[active], \
+            sU2[active]
+        sLam = np.sin(lam_old)
+        cLam = np.cos(lam_old)
+        sin_s = np.sqrt((cU2a*sLam)**2 + (cU1a*sU2a - sU1a*cU2a*cLam)**2)
+        cos_s = sU1a*sU2a + cU1a*cU2a*cLam
+        s = np.arctan2(sin_s, cos_s)
+        # Coincident points have no azimuth, but are converged
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sin_alp = np.where(sin_s == 0.0, 0.0, 
+                               (cU1a*cU2a*sLam) / sin_s)
+            c2a = 1.0 - sin_alp**2
+            # On the equator, cos2_alp is zero, and so is cos_2sigm
+            c2sm = np.where(c2a == 0.0, 0.0, 
+                            cos_s - (2.0*sU1a*sU2a)/c2a)
+        C = f/16.0 * c2a * (4.0 + f*(4.0-3.0*c2a))
+        lam_new = L[active] + (1.0 - C) * f * sin_alp * \
+            (s + C * sin_s * (c2sm + C * cos_s * (-1.0 + 2.0 * c2sm**2)))
+        lam[active] = lam_new
+        sin_sig[active] = sin_s
+        cos_sig[active] = cos_s
+        sig[active] = s
+        cos2_alp[active] = c2a
+        cos_2sigm[active] = c2sm
+        active = active[~(np.abs(lam_new - lam_old) <= epsilon)]
+
+    usq = cos2_alp * ((r_major**2 - r_minor**2) / r_minor**2)
+    A = 1 + usq/16384 * (4096 + usq*(-768 + usq*(320 - 175*usq)))
+    B = usq/1024 * (256 + usq*(-128 + usq*(74 - 47*usq)))
+    del_sig = B * sin_sig * (cos_2sigm + 0.25*B*(cos_sig*( \
+        -1 + 2*cos_2sigm**2) - (1.0/6.0)*B*cos_2sigm * ( \
+        -3 + 4*sin_sig**2) * (-3 + 4 * cos_2sigm**2)))
+    dist = r_minor * A * (sig - del_sig)
+    alp1 = np.degrees(np.arctan2(cU2*np.sin(lam),(cU1*sU2-sU1*cU2*np.cos(lam))))
+    alp2 = np.degrees(np.arctan2(cU1*np.sin(lam),
+                                 (cU1*sU2*np.cos(lam)-sU1*cU2)))
+
+    # Not converged
+    if active.size > 0:
+        dist[active] = np.nan
+        alp1[active] = np.nan
+        alp2[active] = np.nan
+        try:
+            import geographiclib.geodesic
+        except ImportError:
+            geographiclib = None
+        if geographiclib is not None:
+            geod = geographiclib.geodesic.Geodesic(r_major, f)
+            for j in active:
+                result = geod.Inverse(*[a.flat[j] for a in points])
+                dist[j] = result['s12']
+                alp1[j] = result['azi1']
+                alp2[j] = result['azi2']
+
+    return (dist.reshape(shape), alp1.reshape(shape), alp2.reshape(shape))
+
+def vincenty_direct_array(lat, lon, azimuth, distance, 
+                          r_major=6378.1370, r_minor=6356.752314, 
+                          r_sphere=None, max_iter=500, epsilon=1E-12):
+    """
+    As vincenty_direct, but for numpy arrays (or scalars) of the starting
+    points, azimuths and distances, which are broadcast together. All the
+    points are iterated on at once, and each stops changing when it has
+    converged.
+
+    A length two tuple of arrays is returned, giving the lattitude and
+    longitude of the points (in degrees). Points for which the iteration
+    does not converge in max_iter steps are done with geographiclib 
+    instead, or are NaN if that is not installed.
+    """
+
+    r_major, r_minor, f = _ellipsoid(r_major, r_minor, r_sphere)
+    lat, lon, azimuth, distance = np.broadcast_arrays(
+        *[np.asarray(a, dtype=float) for a in (lat, lon, azimuth, distance)])
+    shape = lat.shape
+    azi = np.radians(azimuth.ravel())
+    distance = distance.ravel()
+
+    U1 = np.arctan((1.0-f) * np.tan(np.radians(lat.ravel())))
+    sigma1 = np.arctan2(np.tan(U1), np.cos(azi))
+    sin_apha = np.cos(U1)*np.sin(azi)
+    cos_2_alpha = 1 - sin_apha**2
+    u_2 = cos_2_alpha * ((r_major**2 - r_minor**2) / r_minor**2) 
+    A = 1 + (u_2 / 16384)*(4096 + u_2 * (-768 + u_2 * (320 - 175 * u_2)))
+    B = (u_2/1024)*(256 + u_2*(-128+u_2*(74-47*u_2)))
+    sig_0 = distance/(r_minor*A)
+    sig = sig_0.copy()
+    sig_2_m = 2.0*sigma1 + sig
+
+    # Points still being iterated on
+    active = np.arange(sig.size)
+    for i in range(max_iter):
+        if active.size == 0:
+            break
+        sig_old = sig[active]
+        Ba = B[active]
+        s2m = 2.0*sigma1[active] + sig_old
+        d_sig = Ba * np.sin(sig_old) * (
+                  np.cos(s2m) + 0.25*Ba*(
+                    np.cos(sig_old)*(-1.0 + 2.0*np.cos(s2m)**2.0) 
+                  - (1.0/6.0)*Ba*np.cos(s2m)*(-3.0+4.0*np.sin(sig_old)**2.0)
+                  * (-3.0+4.0*np.cos(s2m)**2)))
+        sig[active] = sig_0[active] + d_sig
+        sig_2_m[active] = s2m
+        active = active[~(np.abs(sig[active] - sig_old) <= epsilon)]
+
+    sU1 = np.sin(U1)
+    cU1 = np.cos(U1)
+    lat2 = np.arctan2(sU1*np.cos(sig)+cU1*np.sin(sig)*np.cos(azi),
+               (1.0-f)*np.sqrt(sin_apha**2.0+(sU1*np.sin(sig)-cU1
+                          *np.cos(sig)*np.cos(azi))**2.0))
+
+    lam = np.arctan2(np.sin(sig)*np.sin(azi),
+                     cU1*np.cos(sig) - sU1*np.sin(sig)*np.cos(azi))
+
+    C = (f/16.0) * cos_2_alpha * (4.0 + f*(4.0-3.0*cos_2_alpha))
+
+    L = lam - (1.0-C)*f*sin_apha*(
+        sig+C*np.sin(sig)*(np.cos(sig_2_m)
+         +C*np.cos(sig)*(-1.0+2.0*np.cos(sig_2_m)**2.0)))
+
+    lat2 = np.degrees(lat2)
+    lon2 = np.degrees(L + np.radians(lon.ravel()))
+
+    # Not converged
+    if active.size > 0:
+        lat2[active] = np.nan
+        lon2[active] = np.nan
+        try:
+            import geographiclib.geodesic
+        except ImportError:
+            geographiclib = None
+        if geographiclib is not None:
+            geod = geographiclib.geodesic.Geodesic(r_major, f)
+            for j in active:
+                result = geod.Direct(lat.flat[j], lon.flat[j], 
+                                     azimuth.flat[j], distance[j])
+                lat2[j] = result['lat2']
+                lon2[j] = result['lon2']
+
+    return (lat2.reshape(shape), lon2.reshape(shape))
+
 def dms2dec(degs,mins,secs):
         """Converts angle given in degrees, mins and secs to
            angle in decimal degrees"""
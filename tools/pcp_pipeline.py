@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+"""Run the PcP - P processing of DataProcessing.ipynb on a whole catalogue
+
+   DataProcessing.ipynb reads an ISC file, pairs the PcP and P picks,
+   keeps paths between 30 and 80 degrees and then works out, one
+   DataFrame.apply at a time, the TauP times, the PcP bounce points,
+   the tomographic and ellipticity corrections and the residuals. This
+   module does the same stages on chunks of the file, in a pool of
+   worker processes, each with its own TauP and tomography model, and
+   writes the results as they come:
+
+       python pcp_pipeline.py ISC_2012.dat pcp_2012 [processes [chunksize
+                                         [cache_file [ttime_file]]]]
+       ...
+       results = pcp_pipeline.load_results('pcp_2012')
+
+   The output directory holds one part per chunk, each a table of
+   columns in the format of pick_cache (one .npy file per column), so
+   a result can be read while the rest are being worked on, and parts
+   are only ever written whole. The columns are those of
+   read_ISC.pair_pick_table plus those added in the notebook (e.g.
+   P_tomo_corr, CMB_bounce_lat, PcP_P_dtime_corrected_resid).
+
+   The time spent in each stage, and the number of rows going through
+   it, is reported at the end. The picks of an event must be together
+   in the file (as they are in ISC files), as a chunk always ends at
+   the end of an event.
+
+   Given a cache file (see correction_cache), rays are only traced for
+   paths not already done, so re-running a catalogue with new picks
+   added only pays for the new paths. Given a travel time table file
+   (see ttime_table, which builds it the first time), the TauP times
+   are interpolated from the table rather than found by TauP for each
+   distinct source depth and distance.
+"""
+
+import collections
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import geographiclib.geodesic as geod
+
+import correction_cache
+import geographical
+import pick_cache
+import read_ISC
+import ttime_table
+
+# The tomography and ellipticity code live below this directory
+_TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+for _subdir in ('tomocorr', os.path.join('ellippy', 'src')):
+    if os.path.join(_TOOLS_DIR, _subdir) not in sys.path:
+        sys.path.append(os.path.join(_TOOLS_DIR, _subdir))
+
+import elcor
+import tomocorr2
+
+PHASES = ('PcP', 'P')
+
+# Paths shorter than this have triplicated P, and longer have Pdiff
+DISTANCE_RANGE = (30.0, 80.0)
+
+FILE_1D = os.path.join(_TOOLS_DIR, 'tomocorr', 'ak135.1D_vp')
+FILE_3D = os.path.join(_TOOLS_DIR, 'tomocorr', 'vdh3D_1999')
+
+# Ray paths are found on a sphere (the ellipticity correction
+# is made separately)
+EARTH_RADIUS = 6371000.0
+
+# In the order they are run. Read and write are done in the main
+# process, the rest by the workers.
+STAGES = ('read', 'pair', 'filter', 'taup', 'bounce', 'tomography',
+          'ellipticity', 'residuals', 'write')
+
+
+class PcPCorrector(object):
+    """The models needed to correct PcP - P times: a tomocorr2
+       TomographicCorrection (with its TauP model) and a table of
+       ellipticity corrections. If cache_file is given, bounce points
+       and tomographic corrections are kept in a
+       correction_cache.CorrectionCache there, so they are only found
+       once for each path. If ttime_file is given, TauP times are taken
+       from the ttime_table.TravelTimeTable there (built first if need
+       be)."""
+
+    def __init__(self, file_1d=FILE_1D, file_3d=FILE_3D, taup_model='iasp91',
+                 cache_file=None, ttime_file=None):
+        self.cache = None
+        if cache_file is not None:
+            self.cache = correction_cache.CorrectionCache(cache_file)
+        self.tomography = tomocorr2.TomographicCorrection(file_1d, file_3d,
+            ellipsoid=geod.Geodesic(EARTH_RADIUS, 0.0), taup_model=taup_model,
+            cache=self.cache)
+        self.taup = self.tomography.earth_model
+        self.ellipticity = elcor.default_table()
+        self.ttimes = None
+        if ttime_file is not None:
+            self.ttimes = ttime_table.cached_table(ttime_file, PHASES,
+                                                   taup_model)
+
+
+def pair_stage(picks, corrector, duplicates='last'):
+    """Join the PcP and P picks of each path"""
+    return read_ISC.pair_pick_table(picks, PHASES, duplicates)
+
+
+def filter_stage(pairs, corrector):
+    """Keep the paths within DISTANCE_RANGE"""
+    distance = pairs['epicentral_distance'].values
+    keep = (distance > DISTANCE_RANGE[0]) & (distance < DISTANCE_RANGE[1])
+    return pairs[keep].reset_index(drop=True)
+
+
+def taup_stage(pairs, corrector):
+    """TauP times of the first P and PcP at the ISC distance, from the
+       travel time table of corrector if it has one, and otherwise from
+       TauP once for each distinct source depth and distance"""
+    depth = pairs['event_depth'].values
+    distance = pairs['epicentral_distance'].values
+    if corrector.ttimes is not None:
+        for phase in PHASES:
+            pairs[phase + '_ttime_calc'] = corrector.ttimes.time(
+                phase, distance, depth)
+        return pairs
+    first, inverse = tomocorr2.unique_paths(depth, distance)
+    times = np.empty((len(first), len(PHASES)))
+    times.fill(np.nan)
+    for k, i in enumerate(first):
+        arrivals = corrector.taup.get_travel_times(depth[i], distance[i],
+                                                   list(PHASES))
+        for j, phase in enumerate(PHASES):
+            for arrival in arrivals:
+                if arrival.name == phase:
+                    times[k,j] = arrival.time
+                    break
+    for j, phase in enumerate(PHASES):
+        pairs[phase + '_ttime_calc'] = times[inverse,j]
+    return pairs
+
+
+# Columns found from the ray paths, and kept in the cache
+_RAY_COLUMNS = ['CMB_bounce_lat', 'CMB_bounce_lon'] + \
+    [phase + '_tomo_corr' for phase in PHASES]
+
+
+def _geometry(pairs):
+    return [pairs[name].values for name in ('event_lat', 'event_lon',
+            'event_depth', 'station_lat', 'station_lon')]
+
+
+def bounce_stage(pairs, corrector):
+    """Ray paths of P and PcP, and the PcP bounce point (the deepest
+       point of its path, which is within a few metres of the pierce
+       point at the CMB used in the notebook). Rows with the same path
+       (picks of several reporters) are traced once, with both phases
+       found from one geodesic. With a cache, only the rows without a
+       bounce point and tomographic corrections in it are traced.
+
+       Returns the table and the rays traced, as the rows of the table
+       traced, the index of the first row of each distinct path among
+       them, the index into those of each row and a list of the paths
+       of each phase of each distinct path (None for a phase that does
+       not arrive).
+    """
+    values = np.empty((len(pairs), len(_RAY_COLUMNS)))
+    values.fill(np.nan)
+    found = np.zeros(values.shape, dtype=bool)
+    if corrector.cache is not None:
+        for j, name in enumerate(_RAY_COLUMNS):
+            values[:,j], found[:,j] = corrector.cache.lookup(
+                corrector.tomography.fingerprint, name, _geometry(pairs))
+    rows = np.flatnonzero(~found.all(axis=1))
+    first, inverse = tomocorr2.unique_paths(*[a[rows] for a in
+                                              _geometry(pairs)])
+    paths = []
+    bounce = np.empty((len(first), 2))
+    bounce.fill(np.nan)
+    for k, i in enumerate(rows[first]):
+        arrivals = corrector.taup.get_ray_paths_geo(
+            pairs['event_depth'].values[i], pairs['event_lat'].values[i],
+            pairs['event_lon'].values[i], pairs['station_lat'].values[i],
+            pairs['station_lon'].values[i], list(PHASES))
+        earliest = {}
+        for arrival in arrivals:
+            earliest.setdefault(arrival.name, arrival.path)
+        paths.append([earliest.get(phase) for phase in PHASES])
+        if 'PcP' in earliest:
+            deepest = np.argmax(earliest['PcP']['depth'])
+            bounce[k] = (earliest['PcP']['lat'][deepest],
+                         earliest['PcP']['lon'][deepest])
+    values[rows,:2] = bounce[inverse]
+    for j, name in enumerate(_RAY_COLUMNS):
+        pairs[name] = values[:,j]
+    return pairs, (rows, first, inverse, paths)
+
+
+def tomography_stage(pairs, rays, corrector):
+    """Tomographic corrections for the rays from bounce_stage, all
+       in one call to the Fortran. With a cache, these and the bounce
+       points of the paths are added to it."""
+    rows, first, inverse, paths = rays
+    found = np.array([[path is not None for path in phase_paths]
+                      for phase_paths in paths],
+                     dtype=bool).reshape(len(paths), len(PHASES))
+    dt = np.empty(found.shape)
+    dt.fill(np.nan)
+    dt[found] = corrector.tomography.model.path_delays(
+        [path for phase_paths in paths for path in phase_paths
+         if path is not None])
+    for j, phase in enumerate(PHASES):
+        column = pairs[phase + '_tomo_corr'].values.copy()
+        column[rows] = dt[inverse,j]
+        pairs[phase + '_tomo_corr'] = column
+    if corrector.cache is not None and len(first) > 0:
+        geometry = [a[rows[first]] for a in _geometry(pairs)]
+        for name in _RAY_COLUMNS:
+            corrector.cache.store(corrector.tomography.fingerprint, name,
+                                  geometry, pairs[name].values[rows[first]])
+    return pairs
+
+
+def ellipticity_stage(pairs, corrector):
+    """Event to station azimuth (on WGS84) and ellipticity corrections,
+       as ellippy.ellip_src_sta (with geocentric source colatitude,
+       distance and azimuth)"""
+    _, azimuth, _ = geographical.vincenty_array(
+        pairs['event_lat'].values, pairs['event_lon'].values,
+        pairs['station_lat'].values, pairs['station_lon'].values)
+    pairs['azimuth'] = azimuth
+    corrections = corrector.ellipticity.src_sta_corrections(
+        pairs['event_lat'].values, pairs['event_lon'].values,
+        pairs['event_depth'].values, pairs['station_lat'].values,
+        pairs['station_lon'].values, list(PHASES))
+    for phase in PHASES:
+        pairs[phase + '_ellip_corr'] = corrections[phase]
+    return pairs
+
+
+def residuals_stage(pairs, corrector):
+    """Corrected times and PcP - P residuals, as in the notebook"""
+    for phase in PHASES:
+        pairs[phase + '_ttime_corrected'] = pairs[phase + '_ttime'] + \
+            pairs[phase + '_tomo_corr'] + pairs[phase + '_ellip_corr']
+    pairs['PcP_P_dtime_calc'] = pairs['PcP_ttime_calc'] - \
+        pairs['P_ttime_calc']
+    pairs['PcP_P_dtime'] = pairs['PcP_ttime'] - pairs['P_ttime']
+    pairs['PcP_P_dtime_resid'] = pairs['PcP_P_dtime'] - \
+        pairs['PcP_P_dtime_calc']
+    pairs['PcP_P_dtime_corrected'] = pairs['PcP_ttime_corrected'] - \
+        pairs['P_ttime_corrected']
+    pairs['PcP_P_dtime_corrected_resid'] = pairs['PcP_P_dtime_corrected'] - \
+        pairs['PcP_P_dtime_calc']
+    return pairs
+
+
+def new_times():
+    """Seconds spent in and rows into each stage, all zero"""
+    return collections.OrderedDict((stage, [0.0, 0]) for stage in STAGES)
+
+
+def add_times(total, times):
+    """Add the stage times in times to total"""
+    for stage, (seconds, rows) in times.items():
+        total[stage][0] += seconds
+        total[stage][1] += rows
+
+
+def process_picks(picks, corrector, duplicates='last'):
+    """Run all the worker stages on a table of picks (from
+       read_ISC.iter_pick_table) holding whole events. Returns the
+       results and the stage times (see new_times)."""
+    times = new_times()
+
+    def timed(stage, function, table, *args):
+        start = time.time()
+        result = function(table, *args)
+        times[stage][0] += time.time() - start
+        times[stage][1] += len(table)
+        return result
+
+    pairs = timed('pair', pair_stage, picks, corrector, duplicates)
+    pairs = timed('filter', filter_stage, pairs, corrector)
+    pairs = timed('taup', taup_stage, pairs, corrector)
+    pairs, rays = timed('bounce', bounce_stage, pairs, corrector)
+    pairs = timed('tomography', tomography_stage, pairs, rays, corrector)
+    pairs = timed('ellipticity', ellipticity_stage, pairs, corrector)
+    pairs = timed('residuals', residuals_stage, pairs, corrector)
+    return pairs, times
+
+
+def iter_event_chunks(filename, chunksize=100000, leap_seconds=False):
+    """As read_ISC.iter_pick_table for PHASES, but each chunk ends
+       with the last pick of an event: the picks of the last event of
+       each chunk of the file are held back and put at the start of
+       the next."""
+    held = None
+    for chunk in read_ISC.iter_pick_table(filename, PHASES, chunksize,
+                                          leap_seconds):
+        if held is not None:
+            chunk = read_ISC.concat_pick_tables([held, chunk])
+        if len(chunk) == 0:
+            continue
+        eventid = chunk['eventid'].values
+        last = eventid == eventid[-1]
+        held = chunk[last].reset_index(drop=True)
+        if not last.all():
+            yield chunk[~last].reset_index(drop=True)
+    if held is not None and len(held) > 0:
+        yield held
+
+
+_corrector = None
+
+
+def _init_worker(file_1d, file_3d, taup_model, cache_file, ttime_file):
+    global _corrector
+    _corrector = PcPCorrector(file_1d, file_3d, taup_model, cache_file,
+                              ttime_file)
+
+
+def _process_chunk(args):
+    picks, duplicates = args
+    return process_picks(picks, _corrector, duplicates)
+
+
+def _part_directory(output, part):
+    return os.path.join(output, 'part{:06d}'.format(part))
+
+
+def run(filename, output, processes=1, chunksize=100000, file_1d=FILE_1D,
+        file_3d=FILE_3D, taup_model='iasp91', leap_seconds=False,
+        duplicates='last', cache_file=None, ttime_file=None, log=None):
+    """Process the ISC file filename, writing the results to the
+       directory output (which must not already hold results)
+
+       Chunks of chunksize lines are worked on by processes worker
+       processes (or in this process if processes is 1); at most two
+       chunks per worker are read ahead. If log is a file, a line is
+       written to it as each chunk is finished. If cache_file is given,
+       ray path results are cached there, and if ttime_file is given
+       TauP times are taken from a table there (see PcPCorrector; the
+       table is built, by processes processes, before the chunks are
+       worked on if it is not there already). Returns the stage
+       times (see new_times); the times of the worker stages are
+       summed over the workers.
+    """
+    if os.path.exists(output) and os.listdir(output):
+        raise ValueError("Output directory " + output + " is not empty")
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    if ttime_file is not None:
+        ttime_table.cached_table(ttime_file, PHASES, taup_model,
+                                 processes=processes)
+    total = new_times()
+    start = time.time()
+    part = [0]
+
+    def write(result):
+        table, times = result
+        add_times(total, times)
+        write_start = time.time()
+        if len(table) > 0:
+            pick_cache.save_pick_table(table, _part_directory(output,
+                                                              part[0]))
+            part[0] += 1
+        total['write'][0] += time.time() - write_start
+        total['write'][1] += len(table)
+        if log is not None:
+            log.write("{} rows of picks, {} results in {:.1f} s\n".format(
+                total['pair'][1], total['write'][1], time.time() - start))
+            log.flush()
+
+    def read_chunks():
+        chunks = iter_event_chunks(filename, chunksize, leap_seconds)
+        while True:
+            read_start = time.time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            total['read'][0] += time.time() - read_start
+            total['read'][1] += len(chunk)
+            yield chunk
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (file_1d, file_3d, taup_model,
+                                     cache_file, ttime_file))
+        try:
+            pending = collections.deque()
+            for chunk in read_chunks():
+                pending.append(pool.apply_async(_process_chunk,
+                                                ((chunk, duplicates),)))
+                while len(pending) > 2*processes or \
+                        (pending and pending[0].ready()):
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        corrector = PcPCorrector(file_1d, file_3d, taup_model, cache_file,
+                                 ttime_file)
+        for chunk in read_chunks():
+            write(process_picks(chunk, corrector, duplicates))
+    return total
+
+
+def format_times(times, wall_time=None):
+    """A table of the seconds spent in each stage and its throughput"""
+    lines = ["{:<12s}{:>10s}{:>12s}{:>12s}".format('stage', 'seconds',
+                                                   'rows', 'rows/s')]
+    for stage, (seconds, rows) in times.items():
+        rate = rows/seconds if seconds > 0.0 else float('nan')
+        lines.append("{:<12s}{:10.2f}{:12d}{:12.1f}".format(stage, seconds,
+                                                            rows, rate))
+    if wall_time is not None:
+        lines.append("{:<12s}{:10.2f}{:12d}{:12.1f}".format('wall',
+            wall_time, times['write'][1], times['write'][1]/wall_time))
+    return '\n'.join(lines)
+
+
+def load_results(output, mmap=True):
+    """Read the results written by run as one DataFrame"""
+    parts = sorted(p for p in os.listdir(output) if p.startswith('part'))
+    tables = [pick_cache.load_pick_table(os.path.join(output, p), mmap)
+              for p in parts]
+    if not tables:
+        raise ValueError("No results in " + output)
+    return read_ISC.concat_pick_tables(tables)
+
+
+if __name__ == "__main__":
+    # e.g. python pcp_pipeline.py ISC_Jan_2012_trim.dat pcp_Jan_2012 8
+    if len(sys.argv) not in (3, 4, 5, 6, 7):
+        sys.exit("Usage: pcp_pipeline.py isc_file output_dir "
+                 "[processes [chunksize [cache_file [ttime_file]]]]")
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else \
+        multiprocessing.cpu_count()
+    chunksize = int(sys.argv[4]) if len(sys.argv) > 4 else 100000
+    start = time.time()
+    cache_file = sys.argv[5] if len(sys.argv) > 5 else None
+    ttime_file = sys.argv[6] if len(sys.argv) > 6 else None
+    times = run(sys.argv[1], sys.argv[2], processes, chunksize,
+                cache_file=cache_file, ttime_file=ttime_file, log=sys.stderr)
+    print(format_times(times, time.time() - start))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""Binary on-disk cache of parsed ISC pick tables
+
+   Parsing a large ISC csv file (see read_ISC.read_pick_table)
+   takes a while, and every notebook does it. This module stores
+   the parsed table in a directory named after a hash of the
+   source file and the options used to read it. Columns of the
+   same dtype are stored together, as the rows of one 2D .npy
+   file (categorical columns are stored as a .npy file of integer
+   codes each, with the categories in a small json file). Loading
+   a cached table memory maps these files, so it is quick, and
+   load_pick_columns gives the columns as the memory maps, which
+   processes reading the same cache share. load_pick_table makes
+   a DataFrame of them without asking pandas to copy them, but
+   older versions of pandas (before 1.3) still copy the columns
+   of each dtype into one block.
+
+   Typical use is just:
+
+       picks = pick_cache.cached_pick_table('ISC_Jan_2012_trim.dat',
+                                            ('P', 'PcP'))
+
+   which parses and caches the file the first time and loads the
+   cache after that.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas
+
+import read_ISC
+
+# Bump this if the layout of the cache (or of the pick
+# table) changes, so old caches are not used.
+FORMAT_VERSION = 2
+
+_INDEX_FILE = 'columns.json'
+_HASHES_FILE = 'file_hashes.json'
+
+
+def file_hash(filename, cache_dir=None):
+    """SHA1 hash of the content of a file
+
+       Hashing a big file takes a noticeable time, so if cache_dir is
+       given the hash is remembered there, along with the size and
+       modification time of the file, and only recalculated if the
+       file changes."""
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    hashes = {}
+    if cache_dir is not None:
+        try:
+            with open(os.path.join(cache_dir, _HASHES_FILE), 'r') as fh:
+                hashes = json.load(fh)
+        except (IOError, OSError, ValueError):
+            hashes = {}
+        if path in hashes and hashes[path][:2] == [stat.st_size,
+                                                   stat.st_mtime]:
+            return hashes[path][2]
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024*1024), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        hashes[path] = [stat.st_size, stat.st_mtime, digest]
+        fd, tmpfile = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(hashes, fh)
+        os.rename(tmpfile, os.path.join(cache_dir, _HASHES_FILE))
+    return digest
+
+
+def cache_key(filename, phaselist, leap_seconds=False, cache_dir=None):
+    """Hash identifying a parsed version of an ISC file
+
+       The key depends on the content (not the name) of the file, the
+       phases read from it and the leap second option. See file_hash
+       for the use of cache_dir."""
+    sha = hashlib.sha1(file_hash(filename, cache_dir).encode('utf-8'))
+    options = json.dumps([FORMAT_VERSION, list(phaselist),
+                          bool(leap_seconds)])
+    sha.update(options.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _block_file(dtype):
+    """Name of the file holding the columns of dtype"""
+    return 'block_' + np.dtype(dtype).name + '.npy'
+
+
+def save_pick_table(table, directory):
+    """Write a pick table (or any DataFrame of numeric and categorical
+       columns) to directory, which must not already exist. The
+       directory is only created once it is complete."""
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmpdir = tempfile.mkdtemp(dir=parent)
+    try:
+        columns = []
+        blocks = collections.OrderedDict()
+        for name in table.columns:
+            column = table[name]
+            if hasattr(column, 'cat'):
+                np.save(os.path.join(tmpdir, name + '.npy'),
+                        np.ascontiguousarray(column.cat.codes.values))
+                columns.append({'name': name, 'categories':
+                                [str(c) for c in column.cat.categories]})
+            else:
+                block = blocks.setdefault(_block_file(column.dtype), [])
+                columns.append({'name': name, 'categories': None,
+                                'block': _block_file(column.dtype),
+                                'row': len(block)})
+                block.append(column.values)
+        for filename, block in blocks.items():
+            np.save(os.path.join(tmpdir, filename), np.array(block))
+        with open(os.path.join(tmpdir, _INDEX_FILE), 'w') as fh:
+            json.dump({'version': FORMAT_VERSION, 'nrows': len(table),
+                       'columns': columns}, fh)
+        try:
+            os.rename(tmpdir, directory)
+        except OSError:
+            # Someone else may have written the same cache first,
+            # in which case we can just use theirs
+            if not os.path.exists(os.path.join(directory, _INDEX_FILE)):
+                raise
+    finally:
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def load_pick_columns(directory, mmap=True):
+    """Read the columns of a saved pick table
+
+       Returns an OrderedDict mapping column names to arrays. Unless mmap is
+       False these are read-only memory maps of the cache files, so
+       nothing is read until it is used and the pages are shared with
+       other processes. Categorical columns are returned as
+       pandas.Categorical (with memory mapped codes)."""
+    with open(os.path.join(directory, _INDEX_FILE), 'r') as fh:
+        index = json.load(fh)
+    if index['version'] != FORMAT_VERSION:
+        raise ValueError("Pick cache in " + directory +
+                         " has the wrong format version")
+    mmap_mode = 'r' if mmap else None
+    blocks = {}
+    columns = collections.OrderedDict()
+    for column in index['columns']:
+        if column['categories'] is not None:
+            codes = np.load(os.path.join(directory, column['name'] + '.npy'),
+                            mmap_mode=mmap_mode)
+            columns[column['name']] = pandas.Categorical.from_codes(
+                codes, column['categories'])
+        else:
+            if column['block'] not in blocks:
+                blocks[column['block']] = np.load(os.path.join(
+                    directory, column['block']), mmap_mode=mmap_mode)
+            columns[column['name']] = blocks[column['block']][column['row']]
+    return columns
+
+
+def load_pick_table(directory, mmap=True):
+    """Read a saved pick table as a pandas DataFrame of the columns
+       from load_pick_columns (see the note above on copying)"""
+    columns = load_pick_columns(directory, mmap)
+    return pandas.DataFrame(columns, columns=list(columns), copy=False)
+
+
+def cache_directory(filename, phaselist, cache_dir=None, leap_seconds=False):
+    """Where the cache of an ISC file lives. By default caches go in
+       a directory called .pick_cache next to the file."""
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                                 '.pick_cache')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, cache_key(filename, phaselist,
+                                             leap_seconds, cache_dir))
+
+
+def cached_pick_table(filename, phaselist, cache_dir=None,
+                      leap_seconds=False, mmap=True):
+    """Read an ISC file with read_ISC.read_pick_table, using (and
+       creating if needed) a cache of the result in cache_dir"""
+    directory = cache_directory(filename, phaselist, cache_dir, leap_seconds)
+    if not os.path.exists(os.path.join(directory, _INDEX_FILE)):
+        table = read_ISC.read_pick_table(filename, phaselist,
+                                         leap_seconds=leap_seconds)
+        save_pick_table(table, directory)
+    return load_pick_table(directory, mmap)
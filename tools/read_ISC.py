@@ -6,27 +6,39 @@
    this into a dictionary of event picks
    for a given phase. 
 
+   For large catalogues read_pick_table (or
+   iter_pick_table, which yields bounded
+   chunks) parses the file column-wise into
+   a pandas DataFrame instead, with integer
+   (ns since the epoch) times and categorical
+   station, reporter and phase codes, and
+   pair_pick_table joins the picks of two or
+   more phases on such a table.
+
    When run as a script, this ...
 """
 
 import datetime
 
+import numpy as np
+import pandas
+from pandas.api.types import union_categoricals
+
 def _make_datetime(date, time):
     """Date and time are strings"""
     yr, mo, dy = date.split('-', 3)
     hr, mi, se = time.split(':', 3)
     # Sometimes we don't have a decimal
     if (len(se) == 2):
-        mse = 0
+        mse = '0'
     else:
         se, mse = se.split('.',2)
-    # We assume we have 2 dp of seconds,
-    # and convert the value (0 - 99) to
-    # microseconds
+    # Convert the decimal part (of any length, 
+    # but usually 2 dp) to microseconds
     dati = datetime.datetime(int(yr), int(mo), 
                              int(dy), int(hr), 
                              int(mi), int(se),
-                             int(mse)*10000 )
+                             int(mse.ljust(6, '0')[:6]) )
     return dati
 
 def read_picks(filename, phaselist):
@@ -94,3 +106,306 @@ def pair_picks(all_picks, phase1, phase2):
             pick_pairs[event_station] = thispick
 
     return pick_pairs
+
+
+# Columns of the ISC csv file we keep in a pick table, as
+# (column number, name, dtype). Dates and times (columns 11,
+# 12, 18 and 19) are handled separately.
+_PICK_COLUMNS = [
+    (0, 'eventid', np.int64),
+    (1, 'reporter', 'category'),
+    (2, 'station', 'category'),
+    (3, 'station_lat', np.float64),
+    (4, 'station_lon', np.float64),
+    (5, 'station_elev', np.float32),
+    (7, 'epicentral_distance', np.float64),
+    (8, 'backazimuth', np.float32),
+    (9, 'phase', 'category'),
+    (20, 'event_lat', np.float64),
+    (21, 'event_lon', np.float64),
+    (22, 'event_depth', np.float64)]
+_DATETIME_COLUMNS = [(11, 'pick_date'), (12, 'pick_time'),
+                     (18, 'event_date'), (19, 'event_time')]
+
+
+# Days at the end of which a leap second (23:59:60 UTC) was inserted,
+# from IERS Bulletin C. Update this when a new one is announced.
+LEAP_SECONDS = np.array([
+    '1972-06-30', '1972-12-31', '1973-12-31', '1974-12-31', '1975-12-31',
+    '1976-12-31', '1977-12-31', '1978-12-31', '1979-12-31', '1981-06-30',
+    '1982-06-30', '1983-06-30', '1985-06-30', '1987-12-31', '1989-12-31',
+    '1990-12-31', '1992-06-30', '1993-06-30', '1994-06-30', '1995-12-31',
+    '1997-06-30', '1998-12-31', '2005-12-31', '2008-12-31', '2012-06-30',
+    '2015-06-30', '2016-12-31'], dtype='M8[D]')
+
+
+def parse_datetimes(dates, times, leap_seconds=False):
+    """Convert arrays of ISC date and time strings to integer times
+
+       Dates are like '2012-01-31' and times like '05:31:07.54' or 
+       '05:31:07' (any number of decimal places, up to nine, is 
+       allowed). The strings are handled as bytes so the whole array 
+       is converted in a few numpy operations.
+
+       Returns a tuple of two arrays. The first holds the times as 
+       int64 nanoseconds since 1970-01-01 and the second the precision
+       of each time in seconds (e.g. 0.01 or 1.0) as float32. By 
+       default times are POSIX-like (every day has 86400 s, so a
+       difference across a leap second is one second short). If 
+       leap_seconds is True the leap seconds in LEAP_SECONDS are
+       counted so differences are true elapsed times, and times
+       in a leap second (23:59:60.xx) get a distinct value.
+    """
+    days = np.asarray(dates, dtype='S10').astype('M8[D]').astype(np.int64)
+    times = np.asarray(times, dtype='S18')
+    digits = times.view(np.uint8).reshape(-1, 18).astype(np.int64) - ord('0')
+    if (np.any(digits[:,2] != ord(':') - ord('0')) or 
+            np.any(digits[:,5] != ord(':') - ord('0'))):
+        raise ValueError("Cannot parse ISC times: expected HH:MM:SS[.ss]")
+    seconds = digits[:,6]*10 + digits[:,7]
+    secs = ((digits[:,0]*10 + digits[:,1])*3600 + 
+            (digits[:,3]*10 + digits[:,4])*60 + seconds)
+    # Only the run of digits straight after the decimal
+    # point counts towards the fraction
+    decimals = digits[:,9:]
+    is_digit = np.cumprod((decimals >= 0) & (decimals <= 9), axis=1)
+    scale = 10**np.arange(8, -1, -1, dtype=np.int64)
+    nanosecs = (decimals * is_digit * scale).sum(axis=1)
+    precision = (10.0**-is_digit.sum(axis=1)).astype(np.float32)
+
+    ns = (days*86400 + secs)*1000000000 + nanosecs
+    if leap_seconds:
+        # A leap second is inserted at the POSIX time of the start of 
+        # the next day. The leap second itself maps onto that time 
+        # too, so it must not count itself.
+        inserted = (LEAP_SECONDS.astype(np.int64) + 1)*86400*1000000000
+        elapsed = np.searchsorted(inserted, ns, side='right')
+        elapsed = elapsed - (seconds >= 60)
+        ns = ns + elapsed*1000000000
+    return ns, precision
+
+
+def parse_event_datetimes(eventids, dates, times, leap_seconds=False):
+    """As parse_datetimes, but for event (origin) times
+
+       Every pick of an event carries the same origin time, so only
+       the first date and time of each eventid is parsed and the 
+       result is used for all picks of that event. Only the times
+       (not the precision) are returned.
+    """
+    codes, _ = pandas.factorize(np.asarray(eventids))
+    _, first = np.unique(codes, return_index=True)
+    dates = np.asarray(dates)[first]
+    times = np.asarray(times)[first]
+    ns, _ = parse_datetimes(dates, times, leap_seconds)
+    return ns[codes]
+
+
+def travel_times(pick_times, event_times):
+    """Travel times in seconds from integer pick and event times"""
+    return (np.asarray(pick_times) - np.asarray(event_times)) / 1.0E9
+
+
+def _strip_category(column):
+    """Remove the padding from the categories of a categorical
+       column, merging any categories which then become equal"""
+    stripped = np.asarray(column.cat.categories.astype(str).str.strip())
+    categories, mapping = np.unique(stripped, return_inverse=True)
+    return pandas.Categorical.from_codes(
+        mapping[column.cat.codes.values], categories)
+
+
+def iter_pick_table(filename, phaselist, chunksize=100000, 
+                    leap_seconds=False):
+    """Read an ISC csv file in chunks of (at most) chunksize lines
+
+       Yields a pandas DataFrame for each chunk holding the picks
+       of the phases in phaselist, one row per pick. All picks are
+       kept (including duplicates; see pair_pick_table). The columns 
+       have the same names as the keys of the dicts returned by 
+       read_picks, but pick_datetime and event_datetime are replaced
+       by pick_time and event_time: int64 nanoseconds since the epoch
+       (see parse_datetimes for the meaning of leap_seconds). The 
+       precision of each pick time (in seconds) is in pick_precision.
+       Station, reporter and phase codes are pandas categoricals 
+       (but the station and reporter categories of each chunk differ).
+    """
+    usecols = ([c[0] for c in _PICK_COLUMNS] + 
+               [c[0] for c in _DATETIME_COLUMNS])
+    dtypes = dict((c[0], c[2]) for c in _PICK_COLUMNS)
+    names = dict((c[0], c[1]) for c in _PICK_COLUMNS + _DATETIME_COLUMNS)
+    try:
+        reader = pandas.read_csv(filename, header=None, usecols=usecols,
+                                 dtype=dtypes, skipinitialspace=True,
+                                 chunksize=chunksize)
+    except pandas.errors.EmptyDataError:
+        # An empty file has no chunks
+        return
+    for chunk in reader:
+        chunk = chunk.rename(columns=names)
+        phase = _strip_category(chunk['phase'])
+        keep = np.asarray(pandas.Series(phase).isin(phaselist))
+        chunk = chunk[keep]
+        table = pandas.DataFrame(index=np.arange(len(chunk)))
+        for _, name, dtype in _PICK_COLUMNS:
+            if name == 'phase':
+                table[name] = pandas.Categorical(phase[keep], 
+                                                 categories=list(phaselist))
+            elif dtype == 'category':
+                table[name] = _strip_category(chunk[name])
+            else:
+                table[name] = chunk[name].values
+        table['pick_time'], table['pick_precision'] = parse_datetimes(
+            chunk['pick_date'].values, chunk['pick_time'].values, 
+            leap_seconds)
+        table['event_time'] = parse_event_datetimes(
+            table['eventid'].values, chunk['event_date'].values, 
+            chunk['event_time'].values, leap_seconds)
+        yield table
+
+
+def _empty_pick_table(phaselist):
+    """A pick table with no rows, with the columns (and dtypes) of 
+       those from iter_pick_table"""
+    table = pandas.DataFrame(index=np.arange(0))
+    for _, name, dtype in _PICK_COLUMNS:
+        if name == 'phase':
+            table[name] = pandas.Categorical([], categories=list(phaselist))
+        elif dtype == 'category':
+            table[name] = pandas.Categorical([])
+        else:
+            table[name] = np.zeros(0, dtype=dtype)
+    table['pick_time'] = np.zeros(0, dtype=np.int64)
+    table['pick_precision'] = np.zeros(0, dtype=np.float32)
+    table['event_time'] = np.zeros(0, dtype=np.int64)
+    return table
+
+
+def read_pick_table(filename, phaselist, chunksize=100000, 
+                    leap_seconds=False):
+    """Read an ISC csv file into a pandas DataFrame
+
+       This is the columnar equivalent of read_picks; see 
+       iter_pick_table for a description of the columns. The file 
+       is parsed in chunks of chunksize lines so memory use is 
+       limited to the (compact) result. Unlike iter_pick_table
+       the station and reporter categories cover the whole table.
+    """
+    chunks = list(iter_pick_table(filename, phaselist, chunksize, 
+                                  leap_seconds))
+    if not chunks:
+        return _empty_pick_table(phaselist)
+    return concat_pick_tables(chunks)
+
+
+def concat_pick_tables(tables):
+    """Join pick tables (or any DataFrames with the same columns) end
+       to end, with a new index. The categories of each categorical
+       column are merged, where pandas.concat would give up and make
+       them strings."""
+    table = pandas.concat(tables, ignore_index=True)
+    for name in tables[0].columns:
+        if hasattr(tables[0][name], 'cat'):
+            table[name] = union_categoricals([t[name] for t in tables])
+    return table
+
+
+# Ways of choosing between picks of the same phase reported more than
+# once by the same reporter at the same station for the same event. 
+# Each maps to the column to order the duplicates by (None for the 
+# order in the file) and whether the last (rather than first) is kept.
+# Ties keep the order in the file.
+DUPLICATE_POLICIES = {
+    'last': (None, True),
+    'first': (None, False),
+    'latest': ('pick_time', True),
+    'earliest': ('pick_time', False),
+    'precise': ('pick_precision', False)}
+
+# Columns of a pick table that describe the event-station path
+# (rather than a particular pick) and are copied to the pairs
+_PATH_COLUMNS = ['eventid', 'reporter', 'station', 'station_lat',
+                 'station_lon', 'station_elev', 'epicentral_distance',
+                 'backazimuth', 'event_lat', 'event_lon', 'event_depth',
+                 'event_time']
+
+
+def _pick_keys(table):
+    """Encode (eventid, station, reporter) of each pick as one int64"""
+    events = pandas.factorize(table['eventid'].values)[0].astype(np.int64)
+    stations = table['station'].cat.codes.values.astype(np.int64)
+    reporters = table['reporter'].cat.codes.values.astype(np.int64)
+    nstations = len(table['station'].cat.categories)
+    nreporters = len(table['reporter'].cat.categories)
+    return (events*nstations + stations)*nreporters + reporters
+
+
+def _select_picks(table, keys, phase, duplicates):
+    """Row numbers of the picks of one phase, one per key (and 
+       chosen according to the duplicates policy), sorted by key"""
+    try:
+        order_column, keep_last = DUPLICATE_POLICIES[duplicates]
+    except KeyError:
+        raise ValueError("Unknown duplicate policy: " + str(duplicates))
+    rows = np.flatnonzero(np.asarray(table['phase'] == phase))
+    if order_column is None:
+        order = rows
+    else:
+        order = table[order_column].values[rows]
+    rows = rows[np.lexsort((order, keys[rows]))]
+    sorted_keys = keys[rows]
+    if keep_last:
+        chosen = np.append(sorted_keys[1:] != sorted_keys[:-1], True)
+    else:
+        chosen = np.insert(sorted_keys[1:] != sorted_keys[:-1], 0, True)
+    return rows[chosen]
+
+
+def pair_pick_table(table, phases, duplicates='last'):
+    """Join the picks of several phases for each event-station path
+
+       This is the columnar equivalent of pair_picks. Picks in table 
+       (from read_pick_table) are matched if they share an event, 
+       station and reporter, and each of the phases in phases is 
+       present. Any number of phases may be joined (e.g. ('PcP', 'P')
+       or ('PKiKP', 'PKIKP', 'PcP')). The returned DataFrame has one 
+       row per matched path, holding the path information (taken from 
+       the pick of the first phase) and the pick time and precision of
+       each phase in columns called phase + '_time' and 
+       phase + '_precision'.
+
+       When a phase is reported more than once for a path, duplicates
+       chooses the pick to use. This must be a key of 
+       DUPLICATE_POLICIES: 'last' (the last in the file, as for 
+       read_picks), 'first', 'latest' or 'earliest' (by pick time)
+       or 'precise' (the pick reported to most decimal places, the
+       first in the file if there is a tie).
+
+       Travel times (in seconds) are put in phase + '_ttime'.
+    """
+    for phase in phases:
+        if phase not in table['phase'].cat.categories:
+            raise ValueError("Phase " + phase + " is not in the pick table")
+    keys = _pick_keys(table)
+    rows = [_select_picks(table, keys, phase, duplicates) 
+            for phase in phases]
+    # Sort-merge join: the rows of each phase are sorted by key, so we 
+    # can intersect the keys phase by phase keeping track of positions
+    common = keys[rows[0]]
+    for i in range(1, len(phases)):
+        common, in_common, in_phase = np.intersect1d(
+            common, keys[rows[i]], assume_unique=True, return_indices=True)
+        for j in range(i):
+            rows[j] = rows[j][in_common]
+        rows[i] = rows[i][in_phase]
+
+    pairs = pandas.DataFrame(index=np.arange(len(common)))
+    for name in _PATH_COLUMNS:
+        pairs[name] = table[name].values[rows[0]]
+    for phase, phase_rows in zip(phases, rows):
+        pairs[phase + '_time'] = table['pick_time'].values[phase_rows]
+        pairs[phase + '_precision'] = \
+            table['pick_precision'].values[phase_rows]
+        pairs[phase + '_ttime'] = travel_times(pairs[phase + '_time'].values,
+                                               pairs['event_time'].values)
+    return pairs
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""Bootstrap and jackknife uncertainties of spherical harmonic models
+   of the CMB
+
+   A model made by cmb_sh is only as good as the picks that went into
+   it. Bootstrapping (solving again for many resamples of the picks,
+   drawn with replacement, and looking at the spread of the solutions)
+   gives its uncertainty without re-running the notebooks. Resamples
+   can be drawn of the picks, or of whole stations or events (so that
+   the many picks of one station count as one sample):
+
+       fit = cmb_fit.CMBFit.from_sensitivity(sens, depth=100.0)
+       inversion = cmb_sh.SHInversion(bounce_lat, bounce_lon, 4,
+                                      fit.slope(distance, 0.0))
+       result = resampling.bootstrap(inversion, resid, 1000,
+                                     groups=paired_picks_df['station'],
+                                     processes=4)
+       low, high = result.interval(0.95)          # cilm arrays
+       low_map, high_map = result.grid_interval(0.95)
+
+   (To bootstrap the notebook's fit of deflections instead, make the
+   inversion with a sensitivity of one and pass the deflections from
+   fit.deflection as the values.)
+
+   The jackknife solves again leaving out each pick (or station or
+   event) in turn, and scales the spread of those solutions up to the
+   uncertainty of the solution with all of them; it needs as many
+   solutions as there are picks or groups, but no random numbers:
+
+       result = resampling.jackknife(inversion, resid,
+                                     groups=paired_picks_df['eventid'])
+       low, high = result.interval(0.95)
+
+   A bootstrap resample is a weight for each pick (the number of times
+   it is drawn), so each solution uses the basis of the inversion,
+   which is worked out once and shared, read only, by all of them.
+   The jackknife forms the normal equations of all the picks once, and
+   takes those of the picks left out from them for each solution.
+   Picks without a group are left out of everything, including the
+   solution with all the picks. Resamples are solved in batches, which are
+   spread over processes processes; bootstrap resample i is always
+   drawn from the same seed, so the result does not depend on the
+   batches or processes.
+"""
+
+import multiprocessing
+
+import numpy as np
+import pandas
+import scipy.stats
+
+import cmb_sh
+
+
+def group_codes(groups):
+    """Index of the group (e.g. station or event) of each pick, -1 where
+       it has none, and the number of groups"""
+    if groups is None:
+        return None, 0
+    codes, uniques = pandas.factorize(np.asarray(groups))
+    return codes, len(uniques)
+
+
+def resample_weights(seed, n, codes=None, ngroups=0):
+    """Number of times each of n picks is drawn in the bootstrap
+       resample made from seed: n picks drawn with replacement or, given
+       the group of each pick (see group_codes), ngroups groups drawn
+       with replacement, with all the picks of each"""
+    rng = np.random.RandomState(seed)
+    if codes is None:
+        return np.bincount(rng.randint(n, size=n), minlength=n)
+    counts = np.bincount(rng.randint(ngroups, size=ngroups),
+                         minlength=ngroups)
+    return np.where(codes >= 0, counts[codes], 0)
+
+
+def jackknife_weights(left_out, n, codes=None):
+    """Weights (one row for each of left_out) of the n picks in the
+       jackknife resamples leaving out each pick in left_out or, given
+       the group of each pick (see group_codes), each group in left_out.
+       Picks without a group are always left out."""
+    left_out = np.asarray(left_out, dtype=int)
+    if codes is None:
+        weights = np.ones((len(left_out), n))
+        weights[np.arange(len(left_out)), left_out] = 0.0
+        return weights
+    return ((codes >= 0) &
+            (codes != left_out[:, np.newaxis])).astype(float)
+
+
+def solve_batch(inversion, values, weights, damping=0.0, roughness=0.0):
+    """Coefficients (one row for each row of weights, in the order of
+       cmb_sh.coefficient_index) of the dense solution of inversion for
+       values with each row of weights, as SHInversion.solve gives. Rows
+       where there are too few picks for a solution are NaN."""
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    use = inversion.ok & np.isfinite(values)
+    kernel = inversion.kernel[use]
+    data = values[use]/inversion.error[use]
+    weights = weights[:, use]
+    penalty = np.diag(inversion.penalty(damping, roughness))
+    rhs = (weights*data).dot(kernel)
+    normal = np.array([kernel.T.dot(kernel*w[:, np.newaxis])
+                       for w in weights]) + penalty
+    return _solve_normal(normal, rhs)
+
+
+def _solve_normal(normal, rhs):
+    """Solutions of a stack of normal equations, NaN for any that are
+       singular"""
+    try:
+        return np.linalg.solve(normal, rhs[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        pass
+    # One at a time, to find the ones that cannot be solved
+    coefficients = np.full(rhs.shape, np.nan)
+    for i in range(len(rhs)):
+        solution, _, rank, _ = np.linalg.lstsq(normal[i], rhs[i],
+                                               rcond=None)
+        if rank == rhs.shape[1]:
+            coefficients[i] = solution
+    return coefficients
+
+
+_state = None
+
+
+def _init_worker(*state):
+    global _state
+    _state = state
+
+
+def _resample_batch(seeds):
+    inversion, values, codes, ngroups, damping, roughness = _state
+    weights = [resample_weights(seed, inversion.n, codes, ngroups)
+               for seed in seeds]
+    return solve_batch(inversion, values, weights, damping, roughness)
+
+
+def _jackknife_batch(left_out):
+    normal, rhs, kernel, data, order, bounds, penalty = _state
+    left_out = np.asarray(left_out, dtype=int)
+    if order is None:
+        # Take each pick out of the normal equations of all of them
+        rows = kernel[left_out]
+        down = rows[:, :, np.newaxis]*rows[:, np.newaxis, :]
+        down_rhs = rows*data[left_out, np.newaxis]
+    else:
+        # ... or all the picks of each group
+        down = np.zeros((len(left_out),) + normal.shape)
+        down_rhs = np.zeros((len(left_out), len(rhs)))
+        for i, group in enumerate(left_out):
+            rows = order[bounds[group]:bounds[group + 1]]
+            down[i] = kernel[rows].T.dot(kernel[rows])
+            down_rhs[i] = data[rows].dot(kernel[rows])
+    return _solve_normal(normal - down + np.diag(penalty), rhs - down_rhs)
+
+
+def _solve_batches(function, batches, args, processes, ncoefficients):
+    """Coefficients (ncoefficients of each) of all the resamples in
+       batches, each solved by function (with the worker state from
+       args) in processes processes"""
+    if processes > 1 and len(batches) > 1:
+        # Forked workers share the inversion without copying it
+        pool = multiprocessing.Pool(min(processes, len(batches)),
+                                    _init_worker, args)
+        try:
+            results = pool.map(function, batches)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*args)
+        results = [function(batch) for batch in batches]
+    return np.concatenate(results) if results else \
+        np.zeros((0, ncoefficients))
+
+
+class BootstrapResult(object):
+    """Coefficients of the models of nresamples bootstrap resamples
+       (coefficients, of shape (nresamples, (lmax + 1)**2), in the order
+       of cmb_sh.coefficient_index, NaN for any resample that could not
+       be solved), and model, the cmb_sh.SHModel of all the picks"""
+
+    def __init__(self, coefficients, model):
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.model = model
+        self.lmax = model.lmax
+
+    def __len__(self):
+        return len(self.coefficients)
+
+    def _percentiles(self, samples, confidence):
+        tail = 50.0*(1.0 - confidence)
+        # nanpercentile is much slower, and only needed if a resample
+        # could not be solved
+        percentile = np.percentile if np.isfinite(samples).all() else \
+            np.nanpercentile
+        return percentile(samples, [tail, 100.0 - tail], axis=0)
+
+    def std(self):
+        """Standard deviation of each coefficient (a cilm array)"""
+        return cmb_sh.to_cilm(np.nanstd(self.coefficients, axis=0, ddof=1),
+                              self.lmax)
+
+    def interval(self, confidence=0.95):
+        """Lower and upper bounds (cilm arrays) of the central
+           confidence interval of each coefficient, from the percentiles
+           of the resamples"""
+        low, high = self._percentiles(self.coefficients, confidence)
+        return cmb_sh.to_cilm(low, self.lmax), \
+            cmb_sh.to_cilm(high, self.lmax)
+
+    def grid_samples(self, lats=None, lons=None):
+        """Deflection of each resample on a grid (as cmb_sh.make_grid),
+           as an iterator over the latitudes of an array of shape
+           (nresamples, len(lons)) for each"""
+        if lats is None:
+            lats = np.arange(-90.0, 91.0)
+        if lons is None:
+            lons = np.arange(0.0, 361.0)
+        # The deflections are linear in the coefficients, so each row
+        # is one product of its harmonics with all the resamples
+        for lat in lats:
+            yield self.coefficients.dot(cmb_sh.design_matrix(
+                lat, lons, self.lmax).T)
+
+    def grid_interval(self, confidence=0.95, lats=None, lons=None):
+        """Lower and upper bounds of the central confidence interval of
+           the deflection (km) at each point of a grid (as
+           cmb_sh.make_grid)"""
+        bounds = [self._percentiles(samples, confidence)
+                  for samples in self.grid_samples(lats, lons)]
+        return np.array([b[0] for b in bounds]), \
+            np.array([b[1] for b in bounds])
+
+    def grid_std(self, lats=None, lons=None):
+        """Standard deviation of the deflection (km) at each point of a
+           grid (as cmb_sh.make_grid)"""
+        return np.array([np.nanstd(samples, axis=0, ddof=1)
+                         for samples in self.grid_samples(lats, lons)])
+
+
+def _jackknife_std(samples):
+    """Jackknife standard error from the leave-one-out samples (one
+       row each, NaN rows left out)"""
+    n = np.sum(np.isfinite(samples), axis=0)
+    deviation = samples - np.nanmean(samples, axis=0)
+    return np.sqrt((n - 1.0)/n*np.nansum(deviation**2, axis=0))
+
+
+class JackknifeResult(BootstrapResult):
+    """Coefficients of the models leaving out each pick or group (as
+       for BootstrapResult). Spreads are scaled by the jackknife factor,
+       (n - 1)/n for the variance of n samples, to the uncertainty of
+       model, and intervals are normal ones about model."""
+
+    def _interval(self, best, std, confidence):
+        z = scipy.stats.norm.ppf(0.5*(1.0 + confidence))
+        return best - z*std, best + z*std
+
+    def std(self):
+        """Jackknife standard error of each coefficient (a cilm array)"""
+        return cmb_sh.to_cilm(_jackknife_std(self.coefficients), self.lmax)
+
+    def interval(self, confidence=0.95):
+        """Lower and upper bounds (cilm arrays) of the normal confidence
+           interval of each coefficient about that of model"""
+        low, high = self._interval(self.model.coefficients,
+                                   _jackknife_std(self.coefficients),
+                                   confidence)
+        return cmb_sh.to_cilm(low, self.lmax), \
+            cmb_sh.to_cilm(high, self.lmax)
+
+    def grid_interval(self, confidence=0.95, lats=None, lons=None):
+        """Lower and upper bounds of the normal confidence interval of the
+           deflection (km) at each point of a grid (as cmb_sh.make_grid)
+           about that of model"""
+        return self._interval(self.model.grid(lats, lons),
+                              self.grid_std(lats, lons), confidence)
+
+    def grid_std(self, lats=None, lons=None):
+        """Jackknife standard error of the deflection (km) at each point
+           of a grid (as cmb_sh.make_grid)"""
+        return np.array([_jackknife_std(samples)
+                         for samples in self.grid_samples(lats, lons)])
+
+
+def _grouped_values(values, n, codes):
+    """values as an array of n, NaN for any pick without a group (see
+       group_codes), which no resample has"""
+    values = np.broadcast_to(np.asarray(values, float).ravel(), (n,))
+    if codes is not None:
+        values = np.where(codes >= 0, values, np.nan)
+    return values
+
+
+def bootstrap(inversion, values, nresamples=1000, groups=None,
+              damping=0.0, roughness=0.0, processes=1, batch=50, seed=0):
+    """Bootstrap the cmb_sh.SHInversion inversion of values (one for
+       each of its picks, e.g. residuals), with damping and roughness as
+       for its solve method, for nresamples resamples of the picks or,
+       given groups (a label for each pick, such as its station or
+       event), of the groups. Picks without a group are left out of
+       model too. Resamples are solved batch at a time by processes
+       processes. Returns a BootstrapResult."""
+    codes, ngroups = group_codes(groups)
+    values = _grouped_values(values, inversion.n, codes)
+    model = inversion.solve(values, damping, roughness)
+    seeds = np.random.RandomState(seed).randint(2**31 - 1, size=nresamples)
+    batches = [seeds[start:start + batch]
+               for start in range(0, nresamples, batch)]
+    args = (inversion, values, codes, ngroups, damping, roughness)
+    return BootstrapResult(_solve_batches(_resample_batch, batches, args,
+                                          processes, (inversion.lmax + 1)**2),
+                           model)
+
+
+def jackknife(inversion, values, groups=None, damping=0.0, roughness=0.0,
+              processes=1, batch=50):
+    """Jackknife the cmb_sh.SHInversion inversion of values, as for
+       bootstrap, leaving out each pick or, given groups, each group in
+       turn. The normal equations of all the picks are formed once, and
+       those of each resample by taking out the picks it leaves out, so
+       this costs little more than one solution for each. Returns a
+       JackknifeResult."""
+    codes, ngroups = group_codes(groups)
+    values = _grouped_values(values, inversion.n, codes)
+    model = inversion.solve(values, damping, roughness)
+    use = inversion.ok & np.isfinite(values)
+    # Picks that are not used have nothing to take out
+    kernel = np.where(use[:, np.newaxis], inversion.kernel, 0.0)
+    data = np.where(use, values/inversion.error, 0.0)
+    normal = kernel.T.dot(kernel)
+    rhs = data.dot(kernel)
+    if codes is None:
+        order = bounds = None
+        units = np.arange(inversion.n)
+    else:
+        # The used picks of group g are order[bounds[g]:bounds[g + 1]]
+        used_codes = np.where(use, codes, -1)
+        order = np.argsort(used_codes, kind='mergesort')
+        bounds = np.searchsorted(used_codes[order], np.arange(ngroups + 1))
+        units = np.arange(ngroups)
+    batches = [units[start:start + batch]
+               for start in range(0, len(units), batch)]
+    args = (normal, rhs, kernel, data, order, bounds,
+            inversion.penalty(damping, roughness))
+    return JackknifeResult(_solve_batches(_jackknife_batch, batches, args,
+                                          processes, len(rhs)), model)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""Station statics of PcP - P residuals
+
+   StationStatics.ipynb takes the mean and standard deviation of the
+   residuals at each station by filtering the whole table once for
+   each, and subtracts the means one row at a time with apply. Here
+   the terms for every station (or reporter, or station and reporter)
+   come from one grouped pass, and are applied to all rows at once:
+
+       stats = station_statics.group_statistics(paired_picks_df)
+       paired_picks_df['PcP_P_dtime_corrected_station_resid'] = \\
+           station_statics.apply_statics(paired_picks_df, stats['mean'])
+
+   The mean residual at a station is also made by the events it
+   recorded and the CMB under its bounce points, so solve_joint finds
+   station statics, event terms and (optionally) a spherical harmonic
+   model of the CMB (see cmb_sh) together, as one sparse least squares
+   problem. Residuals that fit badly are down-weighted (iteratively
+   reweighted least squares with Huber weights), so a few bad picks do
+   not set a static:
+
+       joint = station_statics.solve_joint(paired_picks_df, lmax=4,
+           sensitivity=fit.slope(paired_picks_df['epicentral_distance'],
+                                 0.0))
+       corrected = station_statics.apply_statics(paired_picks_df,
+                                                 joint.statics)
+
+   Each residual adds one row with two ones and the harmonics at its
+   bounce point to the matrix, so this scales to many thousands of
+   stations and events.
+"""
+
+import numpy as np
+import pandas
+import scipy.sparse
+import scipy.sparse.linalg
+
+import cmb_sh
+
+RESIDUAL = 'PcP_P_dtime_corrected_resid'
+
+
+def _keys(table, by):
+    """Index of the group of each row of table (-1 where a key is
+       missing) and the keys of the groups, for grouping by by (a column
+       name or a list of them)"""
+    grouped = table.groupby(by, sort=True, observed=True)
+    codes = grouped.ngroup().fillna(-1).values.astype(int)
+    keys = grouped.size().index
+    # Observed groups of categoricals come in order of appearance
+    order = np.argsort(keys)
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    return np.where(codes >= 0, rank[codes], -1), keys[order]
+
+
+def group_statistics(table, by='station', column=RESIDUAL):
+    """Mean, standard deviation and count of column for each value of by
+       (a column name, such as 'station' or 'reporter', or a list of
+       them), as a DataFrame indexed by the values of by"""
+    return table.groupby(by, sort=True, observed=True)[column].agg(
+        ['mean', 'std', 'count']).sort_index()
+
+
+def apply_statics(table, statics, by='station', column=RESIDUAL):
+    """column of table less the static of the group (see
+       group_statistics) of each row, from statics, a Series indexed as
+       group_statistics gives. Rows of groups with no static are NaN."""
+    if isinstance(by, (list, tuple)):
+        keys = pandas.MultiIndex.from_arrays([table[name] for name in by])
+    else:
+        keys = np.asarray(table[by])
+    statics = pandas.Series(statics)
+    position = statics.index.get_indexer(keys)
+    correction = np.where(position >= 0, statics.values[position], np.nan)
+    return pandas.Series(table[column].values - correction,
+                         index=table.index, name=column)
+
+
+def huber_weights(misfit, threshold=1.345):
+    """Huber weights of misfits: one within threshold times a robust
+       estimate of their scatter (the normalised median absolute
+       deviation), falling as one over the misfit beyond it"""
+    misfit = np.asarray(misfit, dtype=float)
+    scale = 1.4826*np.median(np.abs(misfit - np.median(misfit)))
+    if scale == 0.0:
+        return np.ones(misfit.shape)
+    size = np.abs(misfit)/(threshold*scale)
+    return np.where(size <= 1.0, 1.0, 1.0/np.maximum(size, 1.0))
+
+
+class JointStatics(object):
+    """Result of solve_joint
+
+       statics and events are Series of the static of each group and
+       the term of each event (s), and model the cmb_sh.SHModel of the
+       CMB (or None). weights are the final robust weights and misfit
+       the misfit (s) of each row of the table (NaN for rows not used),
+       rms the weighted root mean square misfit, and iterations the
+       number of least squares solutions made.
+    """
+
+    def __init__(self, statics, events, model, weights, misfit,
+                 iterations):
+        self.statics = statics
+        self.events = events
+        self.model = model
+        self.weights = weights
+        self.misfit = misfit
+        self.iterations = iterations
+        used = np.isfinite(misfit)
+        self.rms = np.sqrt(np.sum(weights[used]*misfit[used]**2) /
+                           np.sum(weights[used])) if used.any() else None
+
+
+def solve_joint(table, by='station', column=RESIDUAL, events='eventid',
+                lmax=None, sensitivity=1.0, lat='CMB_bounce_lat',
+                lon='CMB_bounce_lon', damping=0.01, sh_damping=0.0,
+                roughness=0.0, robust=True, threshold=1.345,
+                iterations=20, tol=0.01):
+    """Find a static for each value of by, a term for each value of
+       events and, if lmax is not None, spherical harmonic coefficients
+       of degree lmax of the CMB at the bounce points lat and lon, that
+       together best fit column of table, where
+
+           residual = static + event term + sensitivity * CMB(lat, lon)
+
+       for sensitivity (an array with a value for each row, or a scalar,
+       e.g. the slope of a cmb_fit.CMBFit in s/km, giving a model of the
+       CMB in km). A constant can be moved between the statics and the
+       event terms (and the degree zero harmonic) without changing the
+       fit, so they are damped towards zero by damping; the harmonics
+       are regularised by sh_damping and roughness as by
+       cmb_sh.SHInversion.
+
+       If robust, the problem is solved again with Huber weights (see
+       huber_weights) of the misfits until no weight changes by more
+       than tol, or for at most iterations solutions. Returns a
+       JointStatics."""
+    resid = table[column].values.astype(float)
+    static_codes, static_keys = _keys(table, by)
+    event_codes, event_keys = _keys(table, events)
+    sensitivity = np.broadcast_to(np.asarray(sensitivity, float),
+                                  resid.shape)
+    use = np.isfinite(resid) & (static_codes >= 0) & (event_codes >= 0)
+    if lmax is not None:
+        points = np.column_stack((table[lat].values.astype(float),
+                                  table[lon].values.astype(float)))
+        use &= np.all(np.isfinite(points), axis=1) & np.isfinite(sensitivity)
+    rows = np.arange(use.sum())
+    blocks = [scipy.sparse.csr_matrix((np.ones(len(rows)),
+                                       (rows, codes[use])),
+                                      shape=(len(rows), len(keys)))
+              for codes, keys in ((static_codes, static_keys),
+                                  (event_codes, event_keys))]
+    penalty = np.full(len(static_keys) + len(event_keys), damping**2)
+    if lmax is not None:
+        inversion = cmb_sh.SHInversion(points[use, 0], points[use, 1], lmax)
+        blocks.append(scipy.sparse.csr_matrix(
+            inversion.basis*sensitivity[use, np.newaxis]))
+        penalty = np.concatenate((penalty, inversion.penalty(sh_damping,
+                                                             roughness)))
+    g = scipy.sparse.vstack((scipy.sparse.hstack(blocks),
+                             scipy.sparse.diags(np.sqrt(penalty)))).tocsr()
+    data = np.concatenate((resid[use], np.zeros(len(penalty))))
+
+    weights = np.ones(len(rows))
+    x = np.zeros(g.shape[1])
+    for iteration in range(1, iterations + 1):
+        scale = scipy.sparse.diags(np.concatenate((np.sqrt(weights),
+                                                   np.ones(len(penalty)))))
+        x = scipy.sparse.linalg.lsqr(scale.dot(g), scale.dot(data),
+                                     atol=1e-10, btol=1e-10, x0=x)[0]
+        misfit = resid[use] - g[:len(rows)].dot(x)
+        if not robust or iteration == iterations:
+            break
+        new = huber_weights(misfit, threshold)
+        converged = np.max(np.abs(new - weights)) < tol
+        weights = new
+        if converged:
+            break
+
+    nstatics, nevents = len(static_keys), len(event_keys)
+    model = None
+    if lmax is not None:
+        model = cmb_sh.SHModel(cmb_sh.to_cilm(x[nstatics + nevents:], lmax),
+                               damping=sh_damping, roughness=roughness)
+    all_weights = np.zeros(len(resid))
+    all_weights[use] = weights
+    all_misfit = np.full(len(resid), np.nan)
+    all_misfit[use] = misfit
+    return JointStatics(pandas.Series(x[:nstatics], index=static_keys),
+                        pandas.Series(x[nstatics:nstatics + nevents],
+                                      index=event_keys),
+                        model, all_weights, all_misfit, iteration)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import benchmark
+import read_ISC
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_synthetic_isc(self):
+        filename = benchmark.catalogue(self.workdir, 500)
+        with open(filename) as fh:
+            lines = fh.readlines()
+        self.assertEqual(len(lines), 500)
+        # The same rows every time
+        other = os.path.join(self.workdir, 'other.csv')
+        benchmark.write_synthetic_isc(other, 500)
+        with open(other) as fh:
+            self.assertEqual(fh.readlines(), lines)
+        table = read_ISC.read_pick_table(filename, benchmark.PHASES)
+        s_picks = sum(',S       ,' in line for line in lines)
+        self.assertEqual(len(table), 500 - s_picks)
+        paths = benchmark.ray_paths(20)
+        self.assertEqual(len(paths), 20)
+        self.assertTrue(np.all((paths['distance'] > 30.0) &
+                               (paths['distance'] < 80.0)))
+
+    def test_run(self):
+        cases = ['read', 'pair', 'vincenty', 'ellip_corrections', 'elcor']
+        results = benchmark.run([300, 2000], cases, self.workdir,
+                                reference_rows=500, isolate=False)
+        self.assertEqual(len(results), 10)
+        for result in results:
+            self.assertTrue(result['agrees'], result)
+            self.assertEqual(result['reference_rows'],
+                             min(result['rows'], 500))
+            self.assertTrue(result['rows_per_second'] > 0.0)
+        self.assertRaises(ValueError, benchmark.run, [10], ['nothing'],
+                          self.workdir)
+
+    def test_isolated(self):
+        results = benchmark.run([1000], ['vincenty'], self.workdir,
+                                reference_rows=100)
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0]['peak_memory_mb'] >=
+                        results[0]['start_memory_mb'] > 0.0)
+        # Ray tracing is not run at more than its largest size
+        self.assertEqual(benchmark.run([10**6], ['ray_paths'], self.workdir,
+                                       isolate=False), [])
+
+    def test_history(self):
+        filename = os.path.join(self.workdir, 'history.json')
+        self.assertEqual(benchmark.load_history(filename), [])
+        result = {'case': 'vincenty', 'rows': 1000, 'rows_per_second': 100.0,
+                  'error': 0.0, 'tolerance': 1e-6, 'agrees': True}
+        benchmark.save_run(filename, [result])
+        history = benchmark.load_history(filename)
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0]['results'], [result])
+        self.assertEqual(benchmark.regressions(history, [result]), [])
+        slower = dict(result, rows_per_second=40.0)
+        self.assertEqual(len(benchmark.regressions(history, [slower])), 1)
+        # Only runs on the same host are compared
+        self.assertEqual(benchmark.regressions(history, [slower],
+                                               host='elsewhere'), [])
+        wrong = dict(result, error=1.0, agrees=False)
+        self.assertEqual(len(benchmark.regressions(history, [wrong])), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
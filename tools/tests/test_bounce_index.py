@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import bounce_index
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas
+
+
+def random_points(n, seed=1):
+    rng = np.random.RandomState(seed)
+    lat = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, n)))
+    return lat, rng.uniform(-180.0, 180.0, n)
+
+
+def great_circle(lat1, lon1, lat2, lon2, radius=bounce_index.CMB_RADIUS):
+    cos = np.sum(bounce_index.unit_vectors(lat1, lon1) *
+                 bounce_index.unit_vectors(lat2, lon2), axis=-1)
+    return np.arccos(np.clip(cos, -1.0, 1.0))*radius
+
+
+class TestBounceIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.lat, cls.lon = random_points(5000)
+        cls.lat[10] = np.nan
+        cls.values = np.random.RandomState(2).normal(size=5000)
+        cls.index = bounce_index.BounceIndex(cls.lat, cls.lon)
+
+    def test_cells(self):
+        cells = bounce_index.EqualAreaCells(2.0)
+        lat, lon = random_points(20000, seed=3)
+        cell = cells.cell(lat, lon)
+        self.assertTrue(np.all((cell >= 0) & (cell < cells.ncells)))
+        # The centre of a cell is in it
+        centre_lat, centre_lon = cells.centre(np.arange(cells.ncells))
+        npt.assert_array_equal(cells.cell(centre_lat, centre_lon),
+                               np.arange(cells.ncells))
+        npt.assert_array_equal(cells.cell(lat, lon + 360.0), cell)
+        self.assertEqual(cells.cell(np.nan, 0.0), -1)
+        area = cells.area(np.arange(cells.ncells), 1.0)
+        self.assertAlmostEqual(area.sum(), 4.0*np.pi)
+        # Equal area, away from the poles
+        polar = np.abs(centre_lat) > 80.0
+        self.assertTrue(area[~polar].max()/area[~polar].min() < 1.1)
+        self.assertEqual(len(self.index.cell_rows(self.index.cell[0])),
+                         np.sum(self.index.cell == self.index.cell[0]))
+
+    def test_cap(self):
+        for lat, lon, distance in ((10.0, 150.0, 500.0), (89.0, 0.0, 300.0),
+                                   (0.0, 179.9, 200.0)):
+            rows = self.index.cap(lat, lon, distance)
+            with np.errstate(invalid='ignore'):
+                expected = np.flatnonzero(great_circle(
+                    lat, lon, self.lat, self.lon) <= distance)
+            npt.assert_array_equal(rows, expected)
+            self.assertTrue(len(rows) > 0)
+        rows = self.index.cap([10.0, 89.0], [150.0, 0.0], 500.0)
+        self.assertEqual(len(rows), 2)
+        npt.assert_array_equal(rows[0], self.index.cap(10.0, 150.0, 500.0))
+
+    def test_nearest(self):
+        distance, rows = self.index.nearest([10.0, -40.0], [150.0, 20.0],
+                                            k=5)
+        self.assertEqual(rows.shape, (2, 5))
+        for i, (lat, lon) in enumerate(((10.0, 150.0), (-40.0, 20.0))):
+            with np.errstate(invalid='ignore'):
+                all_distances = great_circle(lat, lon, self.lat, self.lon)
+            all_distances[np.isnan(all_distances)] = np.inf
+            npt.assert_array_equal(rows[i], np.argsort(all_distances)[:5])
+            npt.assert_allclose(distance[i], np.sort(all_distances)[:5])
+        distance, rows = bounce_index.BounceIndex([0.0], [0.0]).nearest(
+            1.0, 0.0, k=2)
+        npt.assert_array_equal(rows, [0, -1])
+        self.assertEqual(distance[1], np.inf)
+
+    def test_cell_statistics(self):
+        stats = self.index.cell_statistics(self.values)
+        frame = pandas.DataFrame({'cell': self.index.cell,
+                                  'value': self.values})
+        grouped = frame[frame['cell'] >= 0].groupby('cell')['value']
+        npt.assert_array_equal(stats.index.values, grouped.size().index)
+        npt.assert_array_equal(stats['count'], grouped.count())
+        npt.assert_allclose(stats['mean'], grouped.mean())
+        npt.assert_allclose(stats['median'], grouped.median())
+        mad = grouped.apply(lambda v: np.median(np.abs(v - np.median(v))))
+        npt.assert_allclose(stats['spread'], bounce_index.MAD_SCALE*mad)
+        npt.assert_array_equal(stats['lat'],
+            self.index.cells.centre(stats.index.values)[0])
+        self.assertEqual(stats['count'].sum(), 4999)
+
+    def test_cap_statistics(self):
+        lats, lons = [10.0, -40.0, 50.0], [150.0, 20.0, 0.0]
+        distances = [500.0, 300.0, 0.001]
+        stats = self.index.cap_statistics(self.values, lats, lons, distances)
+        self.assertEqual(len(stats), 3)
+        for i in range(2):
+            values = self.values[self.index.cap(lats[i], lons[i],
+                                                distances[i])]
+            self.assertEqual(stats['count'][i], len(values))
+            self.assertAlmostEqual(stats['mean'][i], values.mean())
+            self.assertAlmostEqual(stats['median'][i], np.median(values))
+        self.assertEqual(stats['count'][2], 0)
+        self.assertTrue(np.isnan(stats['mean'][2]))
+        empty = bounce_index.grouped_statistics([], [])
+        self.assertEqual(len(empty), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
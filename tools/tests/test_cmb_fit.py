@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import cmb_fit
+import cmb_sensitivity
+import unittest
+import itertools
+import os
+import tempfile
+import numpy as np
+import numpy.testing as npt
+import scipy.optimize as spo
+
+# Roughly what FitCMB.ipynb finds for iasp91
+COEFFICIENTS = [0.0, -0.1, 1.0e-4, 0.0, 1.0e-4, 0.0, 0.0, 5.0e-6, 0.0]
+
+
+def notebook_polyval2d(x, y, m):
+    # As in FitCMB.ipynb
+    order = int(np.sqrt(len(m))) - 1
+    ij = itertools.product(range(order+1), range(order+1))
+    z = np.zeros_like(x)
+    for a, (i,j) in zip(m, ij):
+        z += a * x**i * y**j
+    return z
+
+
+def notebook_get_disp(dt, dist, m):
+    def misfit(dcmb):
+        return np.absolute(notebook_polyval2d(dist, dcmb[0], m) - dt)
+    return spo.fmin(misfit, 0.0, disp=0, xtol=1e-8, ftol=1e-10)[0]
+
+
+class TestCMBFit(unittest.TestCase):
+
+    def setUp(self):
+        self.distance, self.dc = np.meshgrid(np.arange(20.0, 91.0, 5.0),
+                                             np.arange(-20.0, 21.0, 5.0))
+        self.fit = cmb_fit.CMBFit(COEFFICIENTS)
+
+    def test_dt(self):
+        npt.assert_allclose(self.fit.dt(self.distance, self.dc),
+            notebook_polyval2d(self.distance, self.dc, COEFFICIENTS))
+        self.assertEqual(self.fit.dt(self.distance, 5.0).shape,
+                         self.distance.shape)
+        step = 1.0e-4
+        npt.assert_allclose(self.fit.slope(self.distance, self.dc),
+            (self.fit.dt(self.distance, self.dc + step) -
+             self.fit.dt(self.distance, self.dc - step))/(2*step), rtol=1e-6)
+
+    def test_fit(self):
+        dt = notebook_polyval2d(self.distance, self.dc, COEFFICIENTS)
+        fit = cmb_fit.CMBFit.fit(self.distance, self.dc, dt, order=2)
+        npt.assert_allclose(fit.coefficients, COEFFICIENTS, atol=1e-10)
+        self.assertEqual(fit.n, self.distance.size)
+        self.assertTrue(fit.rms < 1e-10)
+        self.assertEqual(fit.domain, ((20.0, 90.0), (-20.0, 20.0)))
+        self.assertRaises(ValueError, cmb_fit.CMBFit.fit, [30.0, 40.0],
+                          [0.0, 1.0], [0.0, 0.1])
+
+    def test_deflection(self):
+        for order in (1, 2, 3):
+            rng = np.random.RandomState(order)
+            fit = cmb_fit.CMBFit.fit(self.distance, self.dc,
+                notebook_polyval2d(self.distance, self.dc, COEFFICIENTS) +
+                rng.normal(0.0, 0.01, self.distance.shape), order)
+            dt = fit.dt(self.distance, self.dc)
+            npt.assert_allclose(fit.deflection(dt, self.distance), self.dc,
+                                atol=1e-8)
+            for dt, distance in ((0.5, 40.0), (-1.2, 75.0)):
+                npt.assert_allclose(fit.deflection(dt, distance),
+                    notebook_get_disp(dt, distance, fit.coefficients),
+                    atol=1e-5)
+        # No deflection gives this much
+        fit = cmb_fit.CMBFit([10.0, -1.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        self.assertTrue(np.isnan(fit.deflection(0.0, 50.0)))
+        # At 50 degrees dt does not depend on the deflection
+        for coefficients in ([0.0, 1.0, 0.0, -0.02],
+                             [0.0, 1.0, 0.0, 0.0, -0.02, 0.0, 0.0, 0.0, 0.0]):
+            fit = cmb_fit.CMBFit(coefficients)
+            dc = fit.deflection([0.5, 0.0, 0.5], [50.0, 50.0, 40.0])
+            self.assertTrue(np.isnan(dc[0]))
+            self.assertEqual(dc[1], 0.0)
+            self.assertAlmostEqual(dc[2], 2.5)
+
+    def test_deflection_error(self):
+        rng = np.random.RandomState(0)
+        dt = notebook_polyval2d(self.distance, self.dc, COEFFICIENTS)
+        fit = cmb_fit.CMBFit.fit(self.distance, self.dc,
+            dt + rng.normal(0.0, 0.05, dt.shape))
+        error = fit.deflection_error(dt, self.distance)
+        self.assertEqual(error.shape, dt.shape)
+        self.assertTrue(np.all(error > 0.0))
+        # Errors in dt add in quadrature
+        slope = np.abs(fit.slope(self.distance, fit.deflection(dt,
+                                                               self.distance)))
+        npt.assert_allclose(fit.deflection_error(dt, self.distance, 0.5),
+                            np.sqrt(error**2 + (0.5/slope)**2))
+        self.assertRaises(ValueError, cmb_fit.CMBFit(COEFFICIENTS)
+                          .deflection_error, 0.5, 40.0)
+
+    def test_from_sensitivity(self):
+        distances = np.arange(20.0, 91.0, 10.0)
+        depths = np.array([0.0, 200.0])
+        dcs = np.arange(-20.0, 21.0, 5.0)
+        dt = notebook_polyval2d(*np.meshgrid(distances, dcs, indexing='ij') +
+                                [COEFFICIENTS])
+        sens = cmb_sensitivity.CMBSensitivity('iasp91', distances, depths,
+            dcs, np.repeat(dt[:,None,:], 2, axis=1))
+        fit = cmb_fit.CMBFit.from_sensitivity(sens, depth=100.0,
+                                              distance_range=(30.0, 80.0))
+        npt.assert_allclose(fit.coefficients, COEFFICIENTS, atol=1e-10)
+        self.assertEqual(fit.domain[0], (30.0, 80.0))
+
+    def test_save_load(self):
+        fit = cmb_fit.CMBFit.fit(self.distance, self.dc,
+            notebook_polyval2d(self.distance, self.dc, COEFFICIENTS))
+        fd, filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            fit.save(filename)
+            loaded = cmb_fit.CMBFit.load(filename)
+        finally:
+            os.remove(filename)
+        npt.assert_array_equal(loaded.coefficients, fit.coefficients)
+        npt.assert_array_equal(loaded.covariance, fit.covariance)
+        self.assertEqual(loaded.n, fit.n)
+        npt.assert_array_equal(loaded.domain, fit.domain)
+        npt.assert_array_equal(loaded.deflection(0.5, 40.0),
+                               fit.deflection(0.5, 40.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
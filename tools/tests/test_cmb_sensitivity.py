@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import cmb_sensitivity
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+from obspy.taup import TauPyModel
+
+DISTANCES = np.array([30.0, 55.0, 80.0])
+DEPTHS = np.array([0.0, 100.0, 300.0])
+DCS = np.array([-10.0, 10.0])
+
+
+class TestCMBSensitivity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cache_dir = tempfile.mkdtemp()
+        cls.sens = cmb_sensitivity.CMBSensitivity.build(
+            distances=DISTANCES, depths=DEPTHS, dcs=DCS,
+            cache_dir=cls.cache_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cache_dir)
+
+    def test_models_cached(self):
+        filenames = cmb_sensitivity.build_models(np.append(0.0, DCS),
+            cache_dir=self.cache_dir)
+        self.assertEqual(sorted(filenames),
+            sorted(os.path.join(self.cache_dir, f)
+                   for f in os.listdir(self.cache_dir)))
+        mtimes = [os.path.getmtime(f) for f in filenames]
+        cmb_sensitivity.build_models(DCS, cache_dir=self.cache_dir)
+        self.assertEqual([os.path.getmtime(f) for f in filenames], mtimes)
+
+    def test_agrees_with_taup(self):
+        for dc, filename in zip(DCS, cmb_sensitivity.build_models(DCS,
+                                cache_dir=self.cache_dir)):
+            model = TauPyModel(model=filename)
+            self.assertAlmostEqual(model.model.cmb_depth, 2889.0 - dc)
+            base = TauPyModel(model=cmb_sensitivity.model_filename(0.0,
+                              cache_dir=self.cache_dir))
+            for distance in DISTANCES:
+                times = [dict((a.name, a.time) for a in reversed(
+                    m.get_travel_times(100.0, distance, ['P', 'PcP'])))
+                    for m in (model, base)]
+                npt.assert_allclose(self.sens(distance, 100.0, dc),
+                    (times[0]['PcP'] - times[0]['P']) -
+                    (times[1]['PcP'] - times[1]['P']), atol=1e-6)
+        # Moving the CMB up makes PcP earlier
+        self.assertTrue(np.all(self.sens.dt[...,1] < -0.2))
+        self.assertTrue(np.all(self.sens.dt[...,0] > 0.2))
+
+    def test_interpolation(self):
+        dt = self.sens(55.0, [[0.0], [300.0]], [-10.0, 0.0, 10.0])
+        self.assertEqual(dt.shape, (2, 3))
+        npt.assert_allclose(dt[:,1], (dt[:,0] + dt[:,2])/2.0)
+        npt.assert_allclose(self.sens(42.5, 100.0, 10.0),
+            (self.sens(30.0, 100.0, 10.0) + self.sens(55.0, 100.0, 10.0))/2.0)
+        self.assertTrue(np.isnan(self.sens(20.0, 100.0, 0.0)))
+        self.assertTrue(np.isnan(self.sens(55.0, 100.0, 15.0)))
+
+    def test_bad_dc(self):
+        self.assertRaises(ValueError, cmb_sensitivity.perturbed_velocity_model,
+                          500.0)
+        self.assertRaises(ValueError, cmb_sensitivity.base_model_file,
+                          'no_such_model')
+
+    def test_save_load(self):
+        fd, filename = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        try:
+            self.sens.save(filename)
+            sens = cmb_sensitivity.CMBSensitivity.load(filename)
+            self.assertEqual(sens.base, 'iasp91')
+            npt.assert_array_equal(sens.dt, self.sens.dt)
+            npt.assert_array_equal(sens(50.0, 50.0, 5.0),
+                                   self.sens(50.0, 50.0, 5.0))
+            cached = cmb_sensitivity.cached_sensitivity(filename,
+                distances=DISTANCES, depths=DEPTHS, dcs=DCS,
+                cache_dir=self.cache_dir)
+            npt.assert_array_equal(cached.dt, self.sens.dt)
+        finally:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
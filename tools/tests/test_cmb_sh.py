@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import cmb_sh
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+import scipy.special
+
+
+def random_cilm(lmax, seed=1):
+    cilm = np.random.RandomState(seed).normal(size=(2, lmax + 1, lmax + 1))
+    return cmb_sh.to_cilm(cmb_sh.from_cilm(cilm), lmax)
+
+
+def random_points(n, seed=2):
+    rng = np.random.RandomState(seed)
+    lat = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, n)))
+    return lat, rng.uniform(-180.0, 180.0, n)
+
+
+class TestCMBSH(unittest.TestCase):
+
+    def test_legendre(self):
+        z = np.linspace(-1.0, 1.0, 7)
+        p = cmb_sh.legendre(6, z)
+        self.assertEqual(p.shape, (7, 7, 7))
+        for l in range(7):
+            for m in range(7):
+                if m > l:
+                    npt.assert_array_equal(p[:, l, m], 0.0)
+                    continue
+                # 4-pi normalisation, and lpmv has the Condon-Shortley
+                # phase
+                norm = np.sqrt((2.0 - (m == 0))*(2*l + 1) *
+                               scipy.special.factorial(l - m) /
+                               scipy.special.factorial(l + m))
+                npt.assert_allclose(p[:, l, m], (-1)**m*norm *
+                                    scipy.special.lpmv(m, l, z), atol=1e-12)
+
+    def test_orthonormal(self):
+        # Mean of the product of two harmonics over the sphere, from
+        # Gauss-Legendre quadrature in latitude
+        lmax = 5
+        z, w = np.polynomial.legendre.leggauss(lmax + 1)
+        lons = np.arange(2*lmax + 2)*360.0/(2*lmax + 2)
+        lat, lon = np.meshgrid(np.degrees(np.arcsin(z)), lons, indexing='ij')
+        g = cmb_sh.design_matrix(lat, lon, lmax)
+        weights = np.repeat(w, len(lons))/(2.0*len(lons))
+        npt.assert_allclose(g.T.dot(g*weights[:, np.newaxis]),
+                            np.eye((lmax + 1)**2), atol=1e-12)
+
+    def test_cilm(self):
+        cilm = random_cilm(4)
+        self.assertEqual(len(cmb_sh.coefficient_index(4)[0]), 25)
+        npt.assert_array_equal(cmb_sh.to_cilm(cmb_sh.from_cilm(cilm), 4),
+                               cilm)
+        npt.assert_array_equal(cilm[1, :, 0], 0.0)
+
+    def test_synthesis(self):
+        cilm = random_cilm(6)
+        lat, lon = random_points(50)
+        # One point at a time, as MakeGridPoint is used in the notebooks
+        p = cmb_sh.legendre(6, np.sin(np.radians(lat)))
+        expected = [sum(p[k, l, m]*(cilm[0, l, m]*np.cos(m*np.radians(lon[k]))
+                                    + cilm[1, l, m]*np.sin(m*np.radians(lon[k])))
+                        for l in range(7) for m in range(l + 1))
+                    for k in range(len(lat))]
+        npt.assert_allclose(cmb_sh.synthesize(cilm, lat, lon), expected)
+        npt.assert_allclose(cmb_sh.design_matrix(lat, lon, 6).dot(
+            cmb_sh.from_cilm(cilm)), expected)
+        self.assertAlmostEqual(float(cmb_sh.synthesize(cilm, lat[3], lon[3])),
+                               expected[3])
+        grid = cmb_sh.make_grid(cilm)
+        self.assertEqual(grid.shape, (181, 361))
+        lats, lons = np.meshgrid(np.arange(-90.0, 91.0),
+                                 np.arange(0.0, 361.0), indexing='ij')
+        npt.assert_allclose(grid, cmb_sh.synthesize(cilm, lats, lons),
+                            atol=1e-12)
+        npt.assert_allclose(grid[:, 0], grid[:, -1], atol=1e-12)
+
+    def test_expand_points(self):
+        # With a sensitivity of one, values at enough points give back
+        # the coefficients exactly, as SHExpandLSQ does
+        cilm = random_cilm(4)
+        lat, lon = random_points(200)
+        inversion = cmb_sh.SHInversion(lat, lon, 4)
+        for method in ('dense', 'sparse'):
+            model = inversion.solve(cmb_sh.synthesize(cilm, lat, lon),
+                                    method=method)
+            npt.assert_allclose(model.cilm, cilm, atol=1e-8)
+            self.assertAlmostEqual(model.chi2, 0.0)
+            self.assertEqual(model.n, 200)
+        self.assertRaises(ValueError, inversion.solve, lat, method='other')
+        self.assertRaises(ValueError, cmb_sh.SHInversion(lat[:10], lon[:10],
+                          4).solve, lat[:10])
+
+    def test_residuals(self):
+        cilm = random_cilm(3)
+        lat, lon = random_points(300)
+        sensitivity = np.linspace(-0.05, -0.1, 300)
+        error = np.linspace(0.1, 0.3, 300)
+        rng = np.random.RandomState(3)
+        resid = sensitivity*cmb_sh.synthesize(cilm, lat, lon) + \
+            rng.normal(size=300)*error*1e-3
+        resid[5] = np.nan
+        inversion = cmb_sh.SHInversion(lat, lon, 3, sensitivity, error)
+        dense = inversion.solve(resid)
+        sparse = inversion.solve(resid, method='sparse')
+        npt.assert_allclose(dense.cilm, cilm, atol=1e-2)
+        npt.assert_allclose(sparse.cilm, dense.cilm, atol=1e-8)
+        self.assertEqual(dense.n, 299)
+        self.assertTrue(sparse.covariance is None)
+        # The covariance matches the scatter of the misfit
+        self.assertTrue(0.5e-3 < dense.rms < 2e-3)
+        npt.assert_allclose(np.sqrt(np.diag(dense.covariance)),
+                            np.sqrt(np.diag(np.linalg.inv(
+                                inversion.kernel.T.dot(inversion.kernel))))
+                            * dense.rms, rtol=0.05)
+        predicted = inversion.predict(dense)
+        npt.assert_allclose(predicted[6:], resid[6:], atol=1e-2)
+        # Weights act as repeated points
+        weights = np.ones(300, dtype=int)
+        weights[:100] = 2
+        repeated = np.concatenate((np.arange(300), np.arange(100)))
+        expected = cmb_sh.SHInversion(lat[repeated], lon[repeated], 3,
+            sensitivity[repeated], error[repeated]).solve(resid[repeated])
+        for method in ('dense', 'sparse'):
+            weighted = inversion.solve(resid, weights=weights, method=method)
+            npt.assert_allclose(weighted.cilm, expected.cilm, atol=1e-8)
+            self.assertAlmostEqual(weighted.chi2, expected.chi2)
+
+    def test_regularisation(self):
+        cilm = random_cilm(6)
+        lat, lon = random_points(100)
+        resid = cmb_sh.synthesize(cilm, lat, lon)
+        inversion = cmb_sh.SHInversion(lat, lon, 6)
+        free = inversion.solve(resid)
+        previous = free
+        for damping in (0.1, 1.0, 10.0):
+            model = inversion.solve(resid, damping=damping)
+            self.assertTrue(model.power().sum() < previous.power().sum())
+            npt.assert_allclose(inversion.solve(resid, damping=damping,
+                                                method='sparse').cilm,
+                                model.cilm, atol=1e-8)
+            previous = model
+        smooth = inversion.solve(resid, roughness=1.0)
+        npt.assert_allclose(inversion.solve(resid, roughness=1.0,
+                                            method='sparse').cilm,
+                            smooth.cilm, atol=1e-8)
+        # Roughness damps high degrees more than low ones
+        ratio = smooth.power()/free.power()
+        self.assertTrue(ratio[6] < ratio[1])
+        self.assertEqual(smooth.roughness, 1.0)
+        # Enough damping allows more coefficients than points
+        model = cmb_sh.SHInversion(lat[:10], lon[:10], 6).solve(
+            resid[:10], damping=0.01)
+        npt.assert_allclose(model(lat[:10], lon[:10]), resid[:10], atol=0.1)
+
+    def test_save_load(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            lat, lon = random_points(100)
+            model = cmb_sh.SHInversion(lat, lon, 3).solve(lat, damping=0.1)
+            filename = os.path.join(tmpdir, 'model.json')
+            model.save(filename)
+            loaded = cmb_sh.SHModel.load(filename)
+            npt.assert_array_equal(loaded.cilm, model.cilm)
+            npt.assert_array_equal(loaded.covariance, model.covariance)
+            for name in ('rms', 'chi2', 'n', 'damping', 'roughness'):
+                self.assertEqual(getattr(loaded, name), getattr(model, name))
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertRaises(ValueError, cmb_sh.SHModel, np.zeros((2, 3, 4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
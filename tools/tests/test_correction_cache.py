@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import correction_cache
+import pcp_pipeline
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+
+# pcp_pipeline puts these on the path
+import ellippy
+import tomocorr2
+
+GEOMETRY = ([10.0, 10.00001, 20.0, np.nan], [30.0, 30.0, 40.0, 50.0],
+            100.0)
+
+
+class TestCorrectionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'corrections.sqlite')
+        self.cache = correction_cache.CorrectionCache(self.filename)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_geometry_keys(self):
+        keys = correction_cache.geometry_keys(GEOMETRY)
+        self.assertEqual(keys, ['100000,300000,1000000',
+                                '100000,300000,1000000',
+                                '200000,400000,1000000', None])
+        self.assertEqual(correction_cache.geometry_keys(([1.26], [-1.26]),
+                                                        decimals=1),
+                         ['13,-13'])
+
+    def test_lookup_store(self):
+        values, found = self.cache.lookup('model', 'P', GEOMETRY)
+        self.assertFalse(found.any())
+        self.assertTrue(np.isnan(values).all())
+        self.cache.store('model', 'P', GEOMETRY, [1.0, 2.0, np.nan, 4.0])
+        # The first two paths are the same when rounded, and the last
+        # can't be cached
+        self.assertEqual(len(self.cache), 2)
+        # Replacing corrections does not change the count
+        self.cache.store('model', 'P', GEOMETRY, [1.0, 2.0, np.nan, 4.0])
+        self.assertEqual(len(self.cache), 2)
+        values, found = self.cache.lookup('model', 'P', GEOMETRY)
+        npt.assert_array_equal(found, [True, True, True, False])
+        npt.assert_array_equal(values[:2], [2.0, 2.0])
+        self.assertTrue(np.isnan(values[2:]).all())
+        self.assertFalse(self.cache.lookup('model', 'PcP', GEOMETRY)[1].any())
+        self.assertFalse(self.cache.lookup('other', 'P', GEOMETRY)[1].any())
+        # Kept between runs
+        cache = correction_cache.CorrectionCache(self.filename)
+        npt.assert_array_equal(cache.lookup('model', 'P', GEOMETRY)[1],
+                               found)
+        cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_cached(self):
+        calls = []
+
+        def function(rows):
+            calls.append(rows)
+            return rows*2.0
+
+        geometry = (np.arange(10.0), 0.0)
+        npt.assert_array_equal(self.cache.cached('model', 'P', geometry,
+                                                 function), np.arange(10)*2.0)
+        geometry = (np.arange(5.0, 15.0), 0.0)
+        npt.assert_array_equal(self.cache.cached('model', 'P', geometry,
+                                                 function),
+                               [10.0, 12.0, 14.0, 16.0, 18.0,
+                                10.0, 12.0, 14.0, 16.0, 18.0])
+        npt.assert_array_equal(calls[1], np.arange(5, 10))
+
+    def test_eviction(self):
+        cache = correction_cache.CorrectionCache(self.filename,
+                                                 max_entries=10)
+        cache.store('model', 'P', (np.arange(8.0),), np.arange(8.0))
+        cache.lookup('model', 'P', ([0.0, 1.0],))
+        cache.store('model', 'P', (np.arange(8.0, 12.0),), 1.0)
+        self.assertEqual(len(cache), 10)
+        # The least recently used went first
+        npt.assert_array_equal(cache.lookup('model', 'P',
+                                            (np.arange(12.0),))[1],
+                               [True, True, False, False] + [True]*8)
+        cache.close()
+
+    def test_touch_batch(self):
+        cache = correction_cache.CorrectionCache(self.filename,
+                                                 touch_batch=3)
+
+        def used():
+            return [row[0] for row in cache._connect().execute(
+                "SELECT used FROM corrections ORDER BY geometry")]
+
+        cache.store('model', 'P', (np.arange(4.0),), 1.0)
+        before = used()
+        # Lookups do not write until there are touch_batch rows to write
+        cache.lookup('model', 'P', ([0.0, 1.0],))
+        self.assertEqual(used(), before)
+        cache.lookup('model', 'P', ([2.0],))
+        self.assertTrue(used()[:3] > before[:3])
+        self.assertEqual(used()[3], before[3])
+        cache.lookup('model', 'P', ([3.0],))
+        cache.close()
+        self.assertEqual(len(set(used())), 2)
+        cache.close()
+
+    def test_fingerprint(self):
+        filename = os.path.join(self.tmpdir, 'model.txt')
+        with open(filename, 'w') as fh:
+            fh.write('1 2 3\n')
+        first = self.cache.fingerprint('tomography', filename, 'iasp91')
+        self.assertEqual(first, self.cache.fingerprint('tomography',
+                                                       filename, 'iasp91'))
+        self.assertNotEqual(first, self.cache.fingerprint('tomography',
+                                                          filename, 'ak135'))
+        # A unicode name is a file too
+        self.assertEqual(first, self.cache.fingerprint('tomography',
+                         filename.encode('ascii').decode('ascii'), 'iasp91'))
+        with open(filename, 'w') as fh:
+            fh.write('1 2 4 5\n')
+        self.assertNotEqual(first, self.cache.fingerprint('tomography',
+                                                          filename, 'iasp91'))
+
+    def test_tomographic_correction(self):
+        evtlat, evtlon, evtdep = [10.0, -20.0], [20.0, 30.0], [100.0, 10.0]
+        stalat, stalon = [50.0, 20.0], [60.0, 100.0]
+        plain = tomocorr2.TomographicCorrection(pcp_pipeline.FILE_1D,
+            pcp_pipeline.FILE_3D)
+        expected = plain.calculate_many(evtlat, evtlon, evtdep, stalat,
+                                        stalon, ['P', 'PcP'])
+        corrector = tomocorr2.TomographicCorrection(pcp_pipeline.FILE_1D,
+            pcp_pipeline.FILE_3D, cache=self.cache)
+        npt.assert_array_equal(corrector.calculate_many(evtlat, evtlon,
+            evtdep, stalat, stalon, ['P', 'PcP']), expected)
+        self.assertEqual(len(self.cache), 4)
+        # What is in the cache is used
+        self.cache.store(corrector.fingerprint, 'P',
+                         (evtlat, evtlon, evtdep, stalat, stalon), 99.0)
+        npt.assert_array_equal(corrector.calculate_many(evtlat, evtlon,
+            evtdep, stalat, stalon, ['P', 'PcP']),
+            [[99.0, expected[0,1]], [99.0, expected[1,1]]])
+        # calculate uses the cache too, and gives every arrival (there
+        # are several P at 20 degrees), in the same order, as without it
+        args = (0.0, 0.0, 10.0, 0.0, 20.0, ['P', 'PKiKP', 'PcP'])
+        uncached = plain.calculate(*args)
+        self.assertTrue(len(uncached) > 3)
+        npt.assert_allclose(corrector.calculate(*args), uncached)
+        self.assertEqual(len(self.cache), 4 + len(uncached) + 1)
+        self.cache.store(corrector.fingerprint, 'arrivals:P,PKiKP,PcP:1',
+                         [[a] for a in args[:5]], 99.0)
+        cached = corrector.calculate(*args)
+        self.assertEqual(cached[1], 99.0)
+        npt.assert_allclose(np.delete(cached, 1), np.delete(uncached, 1))
+        self.assertEqual(len(self.cache), 4 + len(uncached) + 1)
+        other = tomocorr2.TomographicCorrection(pcp_pipeline.FILE_1D,
+            pcp_pipeline.FILE_3D, taup_model='prem', cache=self.cache)
+        self.assertNotEqual(other.fingerprint, corrector.fingerprint)
+
+    def test_ellippy(self):
+        src_lat = np.array([0.0, 10.0, 45.0])
+        args = (src_lat, 100.0, [0.0, 90.0, 200.0], [30.0, 50.0, 70.0])
+        for phase in ('PcP', np.array(['P', 'PcP', 'P'])):
+            expected = ellippy.ellip_corrections(*(args + (phase,)))
+            npt.assert_array_equal(ellippy.ellip_corrections(
+                *(args + (phase,)), cache=self.cache), expected)
+            npt.assert_array_equal(ellippy.ellip_corrections(
+                *(args + (phase,)), cache=self.cache), expected)
+        self.assertEqual(len(self.cache), 5)
+        tcor = ellippy.ellip_src_sta(10.0, 20.0, 100.0, 50.0, 60.0,
+                                     ['P', 'PcP'], cache=self.cache)
+        self.assertAlmostEqual(float(tcor['P']), float(ellippy.ellip_src_sta(
+            10.0, 20.0, 100.0, 50.0, 60.0, 'P')))
+
+
+if __name__ == '__main__':
+    unittest.main()
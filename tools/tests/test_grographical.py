@@ -4,6 +4,11 @@ import geographical as gt
 import unittest
 import numpy.testing as npt # This has support for array-like test comparisons
 import random
+import numpy as np
+try:
+    import geographiclib.geodesic as geodesic
+except ImportError:
+    geodesic = None
 
 class TestGeographicalFunctions(unittest.TestCase):
 
@@ -58,6 +63,59 @@ class TestGeographicalFunctions(unittest.TestCase):
             (r, lat, lon) = gt.cart2geog(x, y, z)
             npt.assert_almost_equal(gt.geog2cart(r, lat, lon), (x, y, z))
 
+class TestGeographicalArrays(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(987)
+        self.r = rng.uniform(0.0, 1000, 500)
+        self.lat = rng.uniform(-90, 90, 500)
+        self.lon = rng.uniform(-180, 180, 500)
+        # Include the known points
+        self.lat[:4] = (90.0, -90.0, 0.0, 0.0)
+        self.lon[:4] = (0.0, 0.0, 180.0, -90.0)
+
+    def test_geog2cart_arrays(self):
+        (x, y, z) = gt.geog2cart(self.r, self.lat, self.lon)
+        for i in range(len(self.r)):
+            npt.assert_allclose((x[i], y[i], z[i]), gt.geog2cart(self.r[i],
+                float(self.lat[i]), float(self.lon[i])), rtol=1e-14, 
+                atol=1e-12)
+        (r, lat, lon) = gt.cart2geog(x, y, z)
+        for i in range(len(self.r)):
+            self.assertEqual((r[i], lat[i], lon[i]), gt.cart2geog(
+                float(x[i]), float(y[i]), float(z[i])))
+        npt.assert_allclose(r, self.r)
+        npt.assert_allclose(lat, self.lat, atol=1e-10)
+        npt.assert_allclose(lon[4:], self.lon[4:], atol=1e-10)
+
+    def test_broadcast(self):
+        (x, y, z) = gt.geog2cart(6378.0, self.lat[:,None], self.lon[None,:10])
+        self.assertEqual(x.shape, (500, 10))
+        npt.assert_array_equal(z[:,0], z[:,9])
+        (r, theta, phi) = gt.cart2sper(x, y, z[:,:1])
+        self.assertEqual(r.shape, (500, 10))
+        npt.assert_array_equal((r, theta, phi), gt.cart2sper(x, y, z))
+
+    def test_out(self):
+        out = (np.empty(500), np.empty(500), np.empty(500))
+        result = gt.geog2cart(self.r, self.lat, self.lon, out=out)
+        self.assertTrue(all(a is b for a, b in zip(result, out)))
+        npt.assert_array_equal(out, gt.geog2cart(self.r, self.lat, self.lon))
+        # In place
+        x, y, z = [a.copy() for a in out]
+        gt.cart2geog(x, y, z, out=out)
+        npt.assert_array_equal(out, gt.cart2geog(x, y, z))
+        gt.sper2cart(*out, out=out)
+        npt.assert_array_equal(out, gt.sper2cart(*gt.cart2geog(x, y, z)))
+        expected = gt.cart2sper(x, y, z)
+        gt.cart2sper(x, y, z, out=(x, y, z))
+        npt.assert_array_equal((x, y, z), expected)
+
+    def test_scalars(self):
+        for value in gt.geog2cart(1000, 10.0, -20.0) + \
+                gt.cart2geog(1.0, 2.0, 3.0):
+            self.assertTrue(isinstance(value, float))
+
 class TestVincentyFunctions(unittest.TestCase):
    
     # Table II of Vincenty's paper (T. Vincenty 1975, "Direct
@@ -141,6 +199,73 @@ class TestVincentyFunctions(unittest.TestCase):
         npt.assert_almost_equal(gt.vincenty_direct(lat1, lon1, azi, dist,
              r_major=6378.388000,r_minor=6356.911946),correct_result,6)
 
+class TestVincentyArrays(unittest.TestCase):
+
+    def setUp(self):
+        # Vincenty's tabulated cases b, c and e, as above
+        self.lat1 = np.array([gt.dms2dec(37.0,19.0,54.95367),
+                              gt.dms2dec(35.0,16.0,11.24862),
+                              gt.dms2dec(1.0,0.0,0.0)])
+        self.lat2 = np.array([gt.dms2dec(26.0,7.0,42.83946),
+                              gt.dms2dec(67.0,22.0,14.77638),
+                              gt.dms2dec(1.0,1.0,15.18952)])
+        self.lon2 = np.array([gt.dms2dec(41.0,28.0,35.50729),
+                              gt.dms2dec(137.0,47.0,28.31435),
+                              gt.dms2dec(179.0,46.0,17.84244)])
+        self.dist = np.array([4085.966703, 8084.823839, 19780.006558])
+        self.azi1 = np.array([gt.dms2dec(95.0,27.0,59.63089),
+                              gt.dms2dec(15.0,44.0,23.74850),
+                              gt.dms2dec(4.0,59.0,59.99995)])
+        self.azi2 = np.array([gt.dms2dec(118,5.0,58.96161),
+                              gt.dms2dec(144.0,55.0,39.92147),
+                              gt.dms2dec(174.0,59.0,59.88481)])
+        self.ellipsoid = {'r_major': 6378.388000, 'r_minor': 6356.911946}
+
+    def test_vincenty_array_tabulated(self):
+        npt.assert_almost_equal(gt.vincenty_array(self.lat1, 0.0, self.lat2,
+            self.lon2, **self.ellipsoid), (self.dist, self.azi1, self.azi2),
+            6)
+
+    def test_vincenty_direct_array_tabulated(self):
+        npt.assert_almost_equal(gt.vincenty_direct_array(self.lat1, 0.0,
+            self.azi1, self.dist, **self.ellipsoid), (self.lat2, self.lon2),
+            6)
+
+    def test_vincenty_array_agrees(self):
+        rng = np.random.RandomState(11)
+        lat1 = rng.uniform(-90, 90, (20, 10))
+        lon1 = rng.uniform(-180, 180, (20, 10))
+        lat2 = rng.uniform(-90, 90, 10)
+        lon2 = rng.uniform(-180, 180, 10)
+        (dist, azi1, azi2) = gt.vincenty_array(lat1, lon1, lat2, lon2)
+        self.assertEqual(dist.shape, (20, 10))
+        (lat3, lon3) = gt.vincenty_direct_array(lat1, lon1, azi1, dist)
+        for i in range(20):
+            for j in range(10):
+                npt.assert_almost_equal((dist[i,j], azi1[i,j], azi2[i,j]),
+                    gt.vincenty(lat1[i,j], lon1[i,j], lat2[j], lon2[j]))
+                npt.assert_almost_equal((lat3[i,j], lon3[i,j]),
+                    gt.vincenty_direct(lat1[i,j], lon1[i,j], azi1[i,j],
+                                       dist[i,j]))
+
+    @unittest.skipIf(geodesic is None, "needs geographiclib")
+    def test_vincenty_array_special(self):
+        # Along the equator, coincident points, and nearly antipodal
+        # points, for which the iteration does not converge, compared
+        # with geographiclib
+        geod = geodesic.Geodesic.WGS84
+        lat1 = np.array([0.0, 0.0, 10.0, 0.0, 0.5])
+        lon1 = np.array([0.0, 10.0, 20.0, 0.0, 0.0])
+        lat2 = np.array([0.0, 0.0, 10.0, 0.0, -0.5])
+        lon2 = np.array([50.0, -60.0, 20.0, 179.7, 179.8])
+        (dist, azi1, azi2) = gt.vincenty_array(lat1, lon1, lat2, lon2)
+        for i in range(len(lat1)):
+            result = geod.Inverse(lat1[i], lon1[i], lat2[i], lon2[i])
+            npt.assert_almost_equal(dist[i], result['s12']/1000.0, 6)
+            if i != 2:
+                npt.assert_almost_equal(azi1[i], result['azi1'], 6)
+                npt.assert_almost_equal(azi2[i], result['azi2'], 6)
+
 if __name__ == '__main__':
     unittest.main()
 
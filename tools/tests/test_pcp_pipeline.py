@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import pcp_pipeline
+import read_ISC
+import ttime_table
+import ellippy
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+import pandas
+import geographiclib.geodesic as geod
+
+# An ISC line, with the fields that change between picks left out
+ISC_LINE = ("  {eventid:9d},ISC      ,{station:<5s},{station_lat:8.4f},"
+            "{station_lon:9.4f}, 250.0,???,{distance:7.2f}, 153.4,"
+            "{phase:<8s},{phase:<8s},2012-01-01,{pick_time},  0.0,T__,     ,"
+            "    ,ISC      ,2012-01-01,05:20:00.00,{event_lat:8.4f},"
+            "{event_lon:9.4f},{event_depth:6.1f},ISC,mb, 6.1\n")
+
+# (eventid, lat, lon, depth) of some events, and (name, lat, lon) of
+# some stations. Each station reports P and PcP for each event.
+EVENTS = [(600000001, 31.4562, 138.1719, 365.3),
+          (600000002, -5.1, 100.0, 10.0),
+          (600000003, 52.0, 160.0, 35.0)]
+STATIONS = [('ARU', 56.4302, 58.5625), ('KBZ', 43.7247, 42.8969),
+            ('WRAB', -19.9336, 134.36), ('YKA', 62.4931, -114.6053)]
+
+
+def synthetic_isc_lines():
+    lines = []
+    ellipsoid = geod.Geodesic.WGS84
+    for eventid, event_lat, event_lon, event_depth in EVENTS:
+        for station, station_lat, station_lon in STATIONS:
+            distance = ellipsoid.Inverse(event_lat, event_lon, station_lat,
+                                         station_lon)['a12']
+            for phase, pick_time in (('P', '05:28:{:05.2f}'),
+                                     ('PcP', '05:29:{:05.2f}')):
+                lines.append(ISC_LINE.format(eventid=eventid,
+                    station=station, station_lat=station_lat,
+                    station_lon=station_lon, distance=distance, phase=phase,
+                    pick_time=pick_time.format(distance/2.0),
+                    event_lat=event_lat, event_lon=event_lon,
+                    event_depth=event_depth))
+    return ''.join(lines)
+
+
+class TestPcPPipeline(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.tmpdir, 'isc.csv')
+        with open(cls.filename, 'w') as fh:
+            fh.write(synthetic_isc_lines())
+        cls.corrector = pcp_pipeline.PcPCorrector()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_event_chunks(self):
+        table = read_ISC.read_pick_table(self.filename, pcp_pipeline.PHASES)
+        chunks = list(pcp_pipeline.iter_event_chunks(self.filename,
+                                                     chunksize=5))
+        self.assertTrue(len(chunks) > 1)
+        events = [set(chunk['eventid']) for chunk in chunks]
+        for i in range(len(events)):
+            for j in range(i):
+                self.assertFalse(events[i] & events[j])
+        joined = read_ISC.concat_pick_tables(chunks)
+        for name in table.columns:
+            npt.assert_array_equal(np.asarray(joined[name]),
+                                   np.asarray(table[name]))
+
+    def test_agrees_with_notebook(self):
+        picks = read_ISC.read_pick_table(self.filename, pcp_pipeline.PHASES)
+        results, times = pcp_pipeline.process_picks(picks, self.corrector)
+        distance = results['epicentral_distance'].values
+        self.assertTrue(np.all((distance > 30.0) & (distance < 80.0)))
+        self.assertTrue(0 < len(results) < len(EVENTS)*len(STATIONS))
+        self.assertEqual(times['pair'][1], len(picks))
+        self.assertEqual(times['residuals'][1], len(results))
+
+        # The calculations done row by row in DataProcessing.ipynb
+        taup = self.corrector.taup
+        wgs84 = geod.Geodesic.WGS84
+        for _, row in results.iterrows():
+            for phase in pcp_pipeline.PHASES:
+                arrivals = taup.get_travel_times(row['event_depth'],
+                    row['epicentral_distance'], phase_list=[phase])
+                self.assertAlmostEqual(row[phase + '_ttime_calc'],
+                                       arrivals[0].time)
+                self.assertAlmostEqual(row[phase + '_tomo_corr'],
+                    self.corrector.tomography.calculate(row['event_lat'],
+                        row['event_lon'], row['event_depth'],
+                        row['station_lat'], row['station_lon'],
+                        [phase])[0], places=5)
+            arrivals = taup.get_pierce_points_geo(row['event_depth'],
+                row['event_lat'], row['event_lon'], row['station_lat'],
+                row['station_lon'], ['PcP'])
+            pierce = arrivals[0].pierce[arrivals[0].pierce['depth'] == 2889.0]
+            # The ray path and pierce points differ by a few metres
+            self.assertAlmostEqual(row['CMB_bounce_lat'], pierce['lat'][0],
+                                   places=3)
+            self.assertAlmostEqual(row['CMB_bounce_lon'], pierce['lon'][0],
+                                   places=3)
+            azimuth = wgs84.Inverse(row['event_lat'], row['event_lon'],
+                row['station_lat'], row['station_lon'])['azi1']
+            self.assertAlmostEqual(np.cos(np.radians(row['azimuth'])),
+                                   np.cos(np.radians(azimuth)))
+            # Geocentric, as ellip_src_sta
+            for phase in pcp_pipeline.PHASES:
+                self.assertAlmostEqual(row[phase + '_ellip_corr'],
+                    ellippy.ellip_src_sta(row['event_lat'], row['event_lon'],
+                        row['event_depth'], row['station_lat'],
+                        row['station_lon'], phase), places=4)
+        npt.assert_allclose(results['PcP_P_dtime_corrected_resid'],
+            (results['PcP_ttime'] + results['PcP_tomo_corr'] +
+             results['PcP_ellip_corr']) -
+            (results['P_ttime'] + results['P_tomo_corr'] +
+             results['P_ellip_corr']) -
+            (results['PcP_ttime_calc'] - results['P_ttime_calc']))
+
+    def test_shared_paths(self):
+        picks = read_ISC.read_pick_table(self.filename, pcp_pipeline.PHASES)
+        pairs = pcp_pipeline.filter_stage(pcp_pipeline.pair_stage(picks,
+            self.corrector), self.corrector)
+        # As if each path had been reported by two agencies
+        doubled = pandas.concat([pairs, pairs], ignore_index=True)
+        doubled, rays = pcp_pipeline.bounce_stage(doubled, self.corrector)
+        rows, first, inverse, paths = rays
+        self.assertEqual(len(rows), 2*len(pairs))
+        self.assertEqual(len(paths), len(pairs))
+        doubled = pcp_pipeline.tomography_stage(doubled, rays, self.corrector)
+        expected, _ = pcp_pipeline.process_picks(picks, self.corrector)
+        for name in ('CMB_bounce_lat', 'CMB_bounce_lon', 'P_tomo_corr',
+                     'PcP_tomo_corr'):
+            npt.assert_array_equal(doubled[name].values,
+                                   np.tile(expected[name].values, 2))
+
+    def test_taup_times(self):
+        picks = read_ISC.read_pick_table(self.filename, pcp_pipeline.PHASES)
+        pairs = pcp_pipeline.filter_stage(pcp_pipeline.pair_stage(picks,
+            self.corrector), self.corrector)
+        expected = pcp_pipeline.taup_stage(pairs.copy(), self.corrector)
+        # Each distinct depth and distance is only done once
+        doubled = pcp_pipeline.taup_stage(
+            pandas.concat([pairs, pairs], ignore_index=True), self.corrector)
+        corrector = pcp_pipeline.PcPCorrector()
+        corrector.ttimes = ttime_table.TravelTimeTable.build(
+            pcp_pipeline.PHASES, distances=np.arange(25.0, 86.0),
+            depths=[0.0, 10.0, 20.0, 35.0, 50.0, 300.0, 350.0, 400.0])
+        interpolated = pcp_pipeline.taup_stage(pairs.copy(), corrector)
+        for phase in pcp_pipeline.PHASES:
+            column = phase + '_ttime_calc'
+            npt.assert_array_equal(doubled[column].values,
+                                   np.tile(expected[column].values, 2))
+            npt.assert_allclose(interpolated[column], expected[column],
+                                atol=0.05)
+
+    def test_run(self):
+        outputs = []
+        for processes in (1, 2):
+            output = os.path.join(self.tmpdir, 'out{}'.format(processes))
+            times = pcp_pipeline.run(self.filename, output, processes,
+                                     chunksize=5)
+            outputs.append(pcp_pipeline.load_results(output))
+            self.assertEqual(times['write'][1], len(outputs[-1]))
+            self.assertEqual(times['read'][1], 2*len(EVENTS)*len(STATIONS))
+            self.assertTrue('rows/s' in pcp_pipeline.format_times(times,
+                                                                  1.0))
+        picks = read_ISC.read_pick_table(self.filename, pcp_pipeline.PHASES)
+        expected, _ = pcp_pipeline.process_picks(picks, self.corrector)
+        for results in outputs:
+            self.assertEqual(list(results.columns), list(expected.columns))
+            for name in expected.columns:
+                npt.assert_array_equal(np.asarray(results[name]),
+                                       np.asarray(expected[name]))
+        self.assertRaises(ValueError, pcp_pipeline.run, self.filename,
+                          output)
+
+    def test_run_cached(self):
+        cache_file = os.path.join(self.tmpdir, 'corrections.sqlite')
+        outputs = []
+        for run in range(2):
+            output = os.path.join(self.tmpdir, 'cached{}'.format(run))
+            pcp_pipeline.run(self.filename, output, chunksize=5,
+                             cache_file=cache_file)
+            outputs.append(pcp_pipeline.load_results(output))
+        corrector = pcp_pipeline.PcPCorrector(cache_file=cache_file)
+        self.assertEqual(len(corrector.cache), 4*len(outputs[0]))
+        # With everything cached, no rays are traced
+        pairs = pcp_pipeline.filter_stage(pcp_pipeline.pair_stage(
+            read_ISC.read_pick_table(self.filename, pcp_pipeline.PHASES),
+            corrector), corrector)
+        _, (rows, _, _, paths) = pcp_pipeline.bounce_stage(pairs, corrector)
+        self.assertEqual(len(rows), 0)
+        self.assertEqual(paths, [])
+        for name in outputs[0].columns:
+            npt.assert_array_equal(np.asarray(outputs[1][name]),
+                                   np.asarray(outputs[0][name]))
+
+
+if __name__ == '__main__':
+    unittest.main()
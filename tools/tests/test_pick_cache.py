@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import pick_cache
+import read_ISC
+import unittest
+import mmap
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas
+
+from test_read_ISC import ISC_LINES
+
+
+def _mapped(array):
+    """Whether array is a view of a memory mapped file"""
+    while array is not None:
+        if isinstance(array, mmap.mmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+class TestPickCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'isc.csv')
+        with open(self.filename, 'w') as fh:
+            fh.write(ISC_LINES)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_pick_table_round_trip(self):
+        table = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        cached = pick_cache.cached_pick_table(self.filename, ('P', 'PcP'),
+                                              cache_dir=self.cache_dir)
+        self.assertTrue(table.equals(cached))
+        # Second time round this comes from the cache
+        cached = pick_cache.cached_pick_table(self.filename, ('P', 'PcP'),
+                                              cache_dir=self.cache_dir)
+        self.assertTrue(table.equals(cached))
+        self.assertEqual(len([d for d in os.listdir(self.cache_dir)
+                              if not d.endswith('.json')]), 1)
+
+    def test_cache_key(self):
+        key = pick_cache.cache_key(self.filename, ('P', 'PcP'))
+        self.assertEqual(key, pick_cache.cache_key(self.filename, 
+                                                   ('P', 'PcP')))
+        self.assertNotEqual(key, pick_cache.cache_key(self.filename, 
+                                                      ('P', 'S')))
+        self.assertNotEqual(key, pick_cache.cache_key(self.filename, 
+                                    ('P', 'PcP'), leap_seconds=True))
+        with open(self.filename, 'a') as fh:
+            fh.write(ISC_LINES.splitlines()[0] + '\n')
+        self.assertNotEqual(key, pick_cache.cache_key(self.filename,
+                                                      ('P', 'PcP')))
+
+    def test_file_hash_remembered(self):
+        os.mkdir(self.cache_dir)
+        digest = pick_cache.file_hash(self.filename, self.cache_dir)
+        self.assertEqual(digest, pick_cache.file_hash(self.filename))
+        self.assertEqual(digest, pick_cache.file_hash(self.filename,
+                                                      self.cache_dir))
+        with open(self.filename, 'a') as fh:
+            fh.write(ISC_LINES.splitlines()[0] + '\n')
+        self.assertEqual(pick_cache.file_hash(self.filename),
+                         pick_cache.file_hash(self.filename, self.cache_dir))
+
+    def test_load_pick_columns_mmap(self):
+        pick_cache.cached_pick_table(self.filename, ('P', 'PcP'),
+                                     cache_dir=self.cache_dir)
+        directory = pick_cache.cache_directory(self.filename, ('P', 'PcP'),
+                                               cache_dir=self.cache_dir)
+        columns = pick_cache.load_pick_columns(directory)
+        self.assertTrue(isinstance(columns['pick_time'], np.memmap))
+        self.assertEqual(list(columns['station'].categories), ['ARU', 'KBZ'])
+
+    def test_load_pick_table_mmap(self):
+        table = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        cached = pick_cache.cached_pick_table(self.filename, ('P', 'PcP'),
+                                              cache_dir=self.cache_dir)
+        selected = cached[cached['phase'] == 'P']
+        self.assertTrue(table.equals(cached))
+        # The codes of categorical columns are never copied, and newer
+        # pandas does not copy the others either
+        self.assertTrue(_mapped(cached['phase'].cat.codes.values))
+        version = tuple(int(v) for v in pandas.__version__.split('.')[:2])
+        if version >= (1, 3):
+            for name in cached.columns:
+                if not hasattr(cached[name], 'cat'):
+                    self.assertTrue(_mapped(cached[name].values))
+        self.assertEqual(len(selected), 4)
+        directory = pick_cache.cache_directory(self.filename, ('P', 'PcP'),
+                                               cache_dir=self.cache_dir)
+        loaded = pick_cache.load_pick_table(directory, mmap=False)
+        self.assertTrue(table.equals(loaded))
+        self.assertFalse(_mapped(loaded['pick_time'].values))
+
+
+if __name__ == '__main__':
+    unittest.main()
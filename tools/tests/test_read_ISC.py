@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import read_ISC
+import unittest
+import os
+import tempfile
+import numpy as np
+import numpy.testing as npt
+
+# A few lines from an ISC STNARRIVALS csv file, with the padding
+# the ISC uses. The ARU P pick from ISC is reported twice, one
+# IDC pick is reported to 1 s and the S pick should be ignored.
+ISC_LINES = """\
+  600479998,ISC      ,ARU  , 56.4302,  58.5625, 250.0,???,  26.98, 153.4,P       ,P       ,2012-01-01,05:31:07.54, -0.6,T__,     ,    ,ISC      ,2012-01-01,05:27:55.88, 31.4562, 138.1719, 365.3,ISC,mb, 6.1
+  600479998,ISC      ,ARU  , 56.4302,  58.5625, 250.0,???,  26.98, 153.4,P       ,P       ,2012-01-01,05:31:07.61, -0.5,T__,     ,    ,ISC      ,2012-01-01,05:27:55.88, 31.4562, 138.1719, 365.3,ISC,mb, 6.1
+  600479998,ISC      ,ARU  , 56.4302,  58.5625, 250.0,???,  26.98, 153.4,PcP     ,PcP     ,2012-01-01,05:36:04.12,  0.3,T__,     ,    ,ISC      ,2012-01-01,05:27:55.88, 31.4562, 138.1719, 365.3,ISC,mb, 6.1
+  600479998,IDC      ,ARU  , 56.4302,  58.5625, 250.0,???,  26.98, 153.4,PcP     ,PcP     ,2012-01-01,05:36:04,     0.2,T__,     ,    ,ISC      ,2012-01-01,05:27:55.88, 31.4562, 138.1719, 365.3,ISC,mb, 6.1
+  600479998,IDC      ,KBZ  , 43.7247,  42.8969, 720.0,???,  85.47,  67.2,P       ,P       ,2012-01-01,05:40:02,     1.1,T__,     ,    ,ISC      ,2012-01-01,05:27:55.88, 31.4562, 138.1719, 365.3,ISC,mb, 6.1
+  600479998,IDC      ,KBZ  , 43.7247,  42.8969, 720.0,???,  85.47,  67.2,S       ,S       ,2012-01-01,05:50:02,     1.1,T__,     ,    ,ISC      ,2012-01-01,05:27:55.88, 31.4562, 138.1719, 365.3,ISC,mb, 6.1
+  600480001,ISC      ,KBZ  , 43.7247,  42.8969, 720.0,???,  45.20,  80.1,PcP     ,PcP     ,2012-01-02,23:59:59.99, -0.1,T__,     ,    ,ISC      ,2012-01-02,23:50:10.00,  5.1000, 100.0000,  10.0,ISC,mb, 5.1
+  600480001,ISC      ,KBZ  , 43.7247,  42.8969, 720.0,???,  45.20,  80.1,P       ,P       ,2012-01-02,23:57:52.02, -0.1,T__,     ,    ,ISC      ,2012-01-02,23:50:10.00,  5.1000, 100.0000,  10.0,ISC,mb, 5.1
+"""
+
+
+def _datetime_to_ns(dt):
+    return np.datetime64(dt, 'ns').astype(np.int64)
+
+
+class TestPickTable(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(ISC_LINES)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_read_pick_table_columns(self):
+        table = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        self.assertEqual(len(table), 7)
+        self.assertEqual(table.pick_time.dtype, np.int64)
+        self.assertEqual(table.station_lat.dtype, np.float64)
+        self.assertEqual(list(table.phase.cat.categories), ['P', 'PcP'])
+        self.assertEqual(sorted(table.station.cat.categories), ['ARU', 'KBZ'])
+        self.assertEqual(sorted(table.reporter.cat.categories), ['IDC', 'ISC'])
+
+    def test_read_pick_table_chunks_agree(self):
+        whole = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        chunked = read_ISC.read_pick_table(self.filename, ('P', 'PcP'),
+                                           chunksize=2)
+        self.assertTrue(whole.equals(chunked))
+
+    def test_concat_pick_tables(self):
+        whole = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        parts = [read_ISC.read_pick_table(self.filename, ('P',)),
+                 read_ISC.read_pick_table(self.filename, ('PcP',))]
+        table = read_ISC.concat_pick_tables(parts)
+        self.assertEqual(len(table), len(whole))
+        for name in ('reporter', 'station', 'phase'):
+            self.assertEqual(table[name].dtype.name, 'category')
+        self.assertEqual(sorted(table.phase.cat.categories), ['P', 'PcP'])
+        self.assertEqual(list(table.index), list(range(len(whole))))
+
+    def test_read_pick_table_empty(self):
+        columns = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        # No picks of the phases
+        table = read_ISC.read_pick_table(self.filename, ('SKS',))
+        self.assertEqual(len(table), 0)
+        self.assertEqual(list(table.columns), list(columns.columns))
+        # An empty file
+        with open(self.filename, 'w'):
+            pass
+        table = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        self.assertEqual(len(table), 0)
+        self.assertEqual(list(table.columns), list(columns.columns))
+        for name in columns.columns:
+            self.assertEqual(table[name].dtype.name, columns[name].dtype.name)
+        self.assertEqual(list(table.phase.cat.categories), ['P', 'PcP'])
+
+    def test_iter_pick_table_bounded(self):
+        sizes = [len(c) for c in read_ISC.iter_pick_table(self.filename,
+                                                 ('P', 'PcP'), chunksize=3)]
+        self.assertEqual(sum(sizes), 7)
+        self.assertTrue(max(sizes) <= 3)
+
+    def test_read_pick_table_agrees_with_read_picks(self):
+        table = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        all_picks = read_ISC.read_picks(self.filename, ('P', 'PcP'))
+        for phase in ('P', 'PcP'):
+            for pick in all_picks[phase].values():
+                # read_picks keeps the last of any duplicates
+                row = table[(table.eventid == int(pick['eventid'])) &
+                            (table.station == pick['station']) &
+                            (table.reporter == pick['reporter']) &
+                            (table.phase == phase)].iloc[-1]
+                self.assertEqual(row.pick_time,
+                                 _datetime_to_ns(pick['pick_datetime']))
+                self.assertEqual(row.event_time,
+                                 _datetime_to_ns(pick['event_datetime']))
+                npt.assert_almost_equal(row.event_depth, pick['event_depth'])
+                npt.assert_almost_equal(row.epicentral_distance,
+                                        pick['epicentral_distance'])
+
+    def test_read_pick_table_precision(self):
+        table = read_ISC.read_pick_table(self.filename, ('P', 'PcP'))
+        idc = (table.reporter == 'IDC').values
+        npt.assert_almost_equal(table.pick_precision.values[idc], 1.0)
+        npt.assert_almost_equal(table.pick_precision.values[~idc], 0.01)
+
+
+class TestParseDatetimes(unittest.TestCase):
+
+    def test_parse_datetimes(self):
+        times, precision = read_ISC.parse_datetimes(
+            ['2012-01-01', '2012-01-01', '1999-12-31'],
+            ['05:31:07.54', '05:31:07', '23:59:59.123456'])
+        self.assertEqual(list(times), 
+            [_datetime_to_ns('2012-01-01T05:31:07.54'),
+             _datetime_to_ns('2012-01-01T05:31:07'),
+             _datetime_to_ns('1999-12-31T23:59:59.123456')])
+        npt.assert_almost_equal(precision, [0.01, 1.0, 0.000001])
+
+    def test_parse_datetimes_bad_time(self):
+        self.assertRaises(ValueError, read_ISC.parse_datetimes,
+                          ['2012-01-01'], ['5.31.07'])
+
+    def test_parse_datetimes_leap_second(self):
+        # A leap second was added at the end of 2016
+        dates = ['2016-12-31', '2016-12-31', '2017-01-01']
+        times = ['23:59:59.5', '23:59:60.5', '00:00:00.5']
+        posix, _ = read_ISC.parse_datetimes(dates, times)
+        elapsed, _ = read_ISC.parse_datetimes(dates, times, leap_seconds=True)
+        npt.assert_almost_equal(read_ISC.travel_times(posix[2], posix[0]), 1.0)
+        npt.assert_almost_equal(read_ISC.travel_times(elapsed[1:], 
+                                                      elapsed[:-1]), [1, 1])
+
+    def test_parse_event_datetimes(self):
+        times = read_ISC.parse_event_datetimes(
+            [7, 7, 3, 7], ['2012-01-01', 'junk', '2012-01-02', 'junk'],
+            ['00:00:01.00', 'junk', '00:00:02.00', 'junk'])
+        self.assertEqual(list(times),
+            [_datetime_to_ns('2012-01-01T00:00:01'),
+             _datetime_to_ns('2012-01-01T00:00:01'),
+             _datetime_to_ns('2012-01-02T00:00:02'),
+             _datetime_to_ns('2012-01-01T00:00:01')])
+
+
+class TestPairPickTable(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(ISC_LINES)
+        self.table = read_ISC.read_pick_table(self.filename, ('P', 'PcP', 'S'))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_pair_pick_table_agrees_with_pair_picks(self):
+        pairs = read_ISC.pair_pick_table(self.table, ('PcP', 'P'))
+        pick_pairs = read_ISC.pair_picks(
+            read_ISC.read_picks(self.filename, ('P', 'PcP')), 'PcP', 'P')
+        self.assertEqual(len(pairs), len(pick_pairs))
+        for pair in pick_pairs.values():
+            row = pairs[(pairs.eventid == int(pair['eventid'])) &
+                        (pairs.station == pair['station']) &
+                        (pairs.reporter == pair['reporter'])]
+            self.assertEqual(len(row), 1)
+            self.assertEqual(row.P_time.iloc[0],
+                             _datetime_to_ns(pair['P_datetime']))
+            self.assertEqual(row.PcP_time.iloc[0],
+                             _datetime_to_ns(pair['PcP_datetime']))
+
+    def test_pair_pick_table_duplicates(self):
+        last = read_ISC.pair_pick_table(self.table, ('PcP', 'P'),
+                                        duplicates='last')
+        first = read_ISC.pair_pick_table(self.table, ('PcP', 'P'),
+                                         duplicates='first')
+        earliest = read_ISC.pair_pick_table(self.table, ('PcP', 'P'),
+                                            duplicates='earliest')
+        aru = (last.station == 'ARU').values
+        self.assertEqual(last.P_time[aru].iloc[0], 
+                         _datetime_to_ns('2012-01-01T05:31:07.61'))
+        self.assertEqual(first.P_time[aru].iloc[0], 
+                         _datetime_to_ns('2012-01-01T05:31:07.54'))
+        self.assertEqual(earliest.P_time[aru].iloc[0], 
+                         _datetime_to_ns('2012-01-01T05:31:07.54'))
+        self.assertRaises(ValueError, read_ISC.pair_pick_table, self.table,
+                          ('PcP', 'P'), duplicates='random')
+
+    def test_pair_pick_table_precise(self):
+        # Make the ARU PcP pick from IDC (to 1 s) a duplicate of the
+        # earlier one from ISC (to 0.01 s)
+        table = self.table.copy()
+        table.loc[3, 'reporter'] = 'ISC'
+        last = read_ISC.pair_pick_table(table, ('P', 'PcP'))
+        precise = read_ISC.pair_pick_table(table, ('P', 'PcP'),
+                                           duplicates='precise')
+        aru = (last.station == 'ARU').values
+        npt.assert_almost_equal(last.PcP_precision.values[aru], [1.0])
+        npt.assert_almost_equal(precise.PcP_precision.values[aru], [0.01])
+
+    def test_pair_pick_table_travel_times(self):
+        pairs = read_ISC.pair_pick_table(self.table, ('PcP', 'P'))
+        kbz = (pairs.station == 'KBZ').values
+        npt.assert_almost_equal(pairs.PcP_ttime.values[kbz], [589.99])
+        npt.assert_almost_equal(pairs.P_ttime.values[kbz], [462.02])
+
+    def test_pair_pick_table_three_phases(self):
+        triples = read_ISC.pair_pick_table(self.table, ('P', 'S', 'PcP'))
+        self.assertEqual(len(triples), 0)
+        pairs = read_ISC.pair_pick_table(self.table, ('S', 'P'))
+        self.assertEqual(len(pairs), 1)
+        self.assertEqual(pairs.station.iloc[0], 'KBZ')
+        self.assertEqual(pairs.reporter.iloc[0], 'IDC')
+
+    def test_pair_pick_table_unknown_phase(self):
+        self.assertRaises(ValueError, read_ISC.pair_pick_table, self.table,
+                          ('PcP', 'PKiKP'))
+
+
+if __name__ == '__main__':
+    unittest.main()
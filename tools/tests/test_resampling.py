@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import resampling
+import cmb_sh
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+
+def synthetic_picks(n=400, lmax=2, noise=0.1, seed=1):
+    rng = np.random.RandomState(seed)
+    lat = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, n)))
+    lon = rng.uniform(0.0, 360.0, n)
+    cilm = cmb_sh.to_cilm(rng.normal(size=(lmax + 1)**2), lmax)
+    resid = -0.1*cmb_sh.synthesize(cilm, lat, lon) + \
+        rng.normal(size=n)*noise
+    return lat, lon, resid, cilm
+
+
+class TestResampling(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.lat, cls.lon, cls.resid, cls.cilm = synthetic_picks()
+        cls.inversion = cmb_sh.SHInversion(cls.lat, cls.lon, 2, -0.1)
+
+    def test_weights(self):
+        weights = resampling.resample_weights(3, 100)
+        self.assertEqual(weights.sum(), 100)
+        npt.assert_array_equal(weights, resampling.resample_weights(3, 100))
+        groups = np.array(['A', 'B', 'C', 'A', None, 'C'], dtype=object)
+        codes, ngroups = resampling.group_codes(groups)
+        self.assertEqual(ngroups, 3)
+        weights = resampling.resample_weights(4, 6, codes, ngroups)
+        # All the picks of a group are drawn together
+        self.assertEqual(weights[0], weights[3])
+        self.assertEqual(weights[2], weights[5])
+        self.assertEqual(weights[4], 0)
+        self.assertEqual(weights[[0, 1, 2]].sum(), 3)
+
+    def test_solve_batch(self):
+        weights = [resampling.resample_weights(seed, self.inversion.n)
+                   for seed in range(5)]
+        coefficients = resampling.solve_batch(self.inversion, self.resid,
+                                              weights, damping=0.1)
+        for w, c in zip(weights, coefficients):
+            npt.assert_allclose(c, self.inversion.solve(self.resid, 0.1,
+                                weights=w).coefficients, atol=1e-10)
+        # A resample with too few picks has no solution
+        few = np.zeros((2, self.inversion.n))
+        few[:, :20] = 1.0
+        few[1, 5:] = 0.0
+        coefficients = resampling.solve_batch(self.inversion, self.resid, few)
+        self.assertTrue(np.isfinite(coefficients[0]).all())
+        self.assertTrue(np.isnan(coefficients[1]).all())
+
+    def test_bootstrap(self):
+        result = resampling.bootstrap(self.inversion, self.resid, 200,
+                                      batch=30)
+        self.assertEqual(len(result), 200)
+        npt.assert_allclose(result.model.cilm, self.inversion.solve(
+            self.resid).cilm)
+        # The spread matches the formal errors of the fit
+        npt.assert_allclose(cmb_sh.from_cilm(result.std()),
+                            np.sqrt(np.diag(result.model.covariance)),
+                            rtol=0.3)
+        low, high = result.interval(0.95)
+        index = cmb_sh.coefficient_index(2)
+        self.assertTrue(np.all(low[index] < result.model.cilm[index]))
+        self.assertTrue(np.all(high[index] > result.model.cilm[index]))
+        self.assertTrue(np.mean((low[index] < self.cilm[index]) &
+                                (high[index] > self.cilm[index])) > 0.7)
+        # Grids
+        lats, lons = np.arange(-90.0, 91.0, 30.0), np.arange(0.0, 361.0, 60.0)
+        low, high = result.grid_interval(0.9, lats, lons)
+        self.assertEqual(low.shape, (7, 7))
+        best = result.model.grid(lats, lons)
+        self.assertTrue(np.all(low < best) and np.all(high > best))
+        samples = np.array([cmb_sh.make_grid(cmb_sh.to_cilm(c, 2), lats,
+                                             lons)
+                            for c in result.coefficients])
+        npt.assert_allclose(result.grid_std(lats, lons),
+                            np.std(samples, axis=0, ddof=1))
+        npt.assert_allclose(high, np.percentile(samples, 95.0, axis=0))
+
+    def test_processes(self):
+        groups = np.arange(self.inversion.n) % 37
+        results = [resampling.bootstrap(self.inversion, self.resid, 40,
+                                        groups=groups, processes=processes,
+                                        batch=batch)
+                   for processes, batch in ((1, 40), (2, 7))]
+        npt.assert_allclose(results[0].coefficients, results[1].coefficients)
+        single = resampling.bootstrap(self.inversion, self.resid, 40, seed=1)
+        self.assertFalse(np.allclose(single.coefficients,
+                                     results[0].coefficients))
+
+    def test_jackknife(self):
+        weights = resampling.jackknife_weights([2, 0], 4)
+        npt.assert_array_equal(weights, [[1, 1, 0, 1], [0, 1, 1, 1]])
+        codes, _ = resampling.group_codes(['A', 'B', None, 'A'])
+        npt.assert_array_equal(resampling.jackknife_weights([0], 4, codes),
+                               [[0, 1, 0, 0]])
+        result = resampling.jackknife(self.inversion, self.resid,
+                                      processes=2, batch=150)
+        self.assertEqual(len(result), self.inversion.n)
+        npt.assert_allclose(result.coefficients[3], self.inversion.solve(
+            self.resid, weights=resampling.jackknife_weights(
+                [3], self.inversion.n)[0]).coefficients, atol=1e-10)
+        # The scaled spread matches the formal errors of the fit
+        npt.assert_allclose(cmb_sh.from_cilm(result.std()),
+                            np.sqrt(np.diag(result.model.covariance)),
+                            rtol=0.3)
+        low, high = result.interval(0.95)
+        index = cmb_sh.coefficient_index(2)
+        npt.assert_allclose(0.5*(low + high)[index],
+                            result.model.cilm[index])
+        npt.assert_allclose((high - low)[index],
+                            2.0*1.959964*result.std()[index], rtol=1e-5)
+        lats, lons = np.arange(-90.0, 91.0, 30.0), np.arange(0.0, 361.0, 60.0)
+        low, high = result.grid_interval(0.9, lats, lons)
+        npt.assert_allclose(0.5*(low + high), result.model.grid(lats, lons))
+        samples = np.array([cmb_sh.make_grid(cmb_sh.to_cilm(c, 2), lats,
+                                             lons)
+                            for c in result.coefficients])
+        n = len(samples)
+        npt.assert_allclose(result.grid_std(lats, lons),
+                            np.sqrt((n - 1.0)*np.var(samples, axis=0)))
+        # By group, one solution for each
+        groups = np.arange(self.inversion.n) % 37
+        result = resampling.jackknife(self.inversion, self.resid,
+                                      groups=groups)
+        self.assertEqual(len(result), 37)
+        self.assertTrue(np.isfinite(result.coefficients).all())
+        # Picks with no group, or no value, are left out of everything
+        labels = np.where(np.arange(self.inversion.n) % 10 == 0, None,
+                          groups)
+        codes, _ = resampling.group_codes(labels)
+        resid = self.resid.copy()
+        resid[1] = np.nan
+        result = resampling.jackknife(self.inversion, resid, groups=labels,
+                                      damping=0.1, processes=2, batch=10)
+        self.assertEqual(len(result), 37)
+        model = self.inversion.solve(np.where(codes >= 0, resid, np.nan),
+                                     0.1)
+        npt.assert_allclose(result.model.coefficients, model.coefficients)
+        for i in (0, 17, 36):
+            npt.assert_allclose(result.coefficients[i], self.inversion.solve(
+                resid, 0.1, weights=resampling.jackknife_weights(
+                    [i], self.inversion.n, codes)[0]).coefficients,
+                atol=1e-10)
+        npt.assert_allclose(resampling.bootstrap(
+            self.inversion, resid, 5, groups=labels,
+            damping=0.1).model.coefficients, model.coefficients)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import station_statics
+import cmb_sh
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas
+
+
+def synthetic_table(nstations=60, nevents=40, npicks=3000, lmax=None,
+                    outliers=0, seed=1):
+    """Residuals made of a static at each station, a term for each event,
+       CMB topography (if lmax is not None, with a sensitivity of -0.1
+       s/km) and a little noise, with some big outliers. Returns the
+       table, the statics, event terms and SH coefficients."""
+    rng = np.random.RandomState(seed)
+    statics = rng.normal(size=nstations)
+    terms = rng.normal(size=nevents)*0.5
+    station = rng.randint(nstations, size=npicks)
+    event = rng.randint(nevents, size=npicks)
+    lat = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, npicks)))
+    lon = rng.uniform(0.0, 360.0, npicks)
+    resid = statics[station] + terms[event] + rng.normal(size=npicks)*0.01
+    cilm = None
+    if lmax is not None:
+        cilm = cmb_sh.to_cilm(rng.normal(size=(lmax + 1)**2)*2.0, lmax)
+        resid += -0.1*cmb_sh.synthesize(cilm, lat, lon)
+    resid[:outliers] += 20.0
+    reporter = np.array(['ISC', 'NEIC'])[station % 2]
+    table = pandas.DataFrame({
+        'station': pandas.Categorical(['S{:03d}'.format(s) for s in station]),
+        'reporter': pandas.Categorical(reporter), 'eventid': 600000000 + event,
+        'CMB_bounce_lat': lat, 'CMB_bounce_lon': lon,
+        station_statics.RESIDUAL: resid})
+    return table, statics, terms, cilm
+
+
+class TestStationStatics(unittest.TestCase):
+
+    def test_group_statistics(self):
+        table, _, _, _ = synthetic_table()
+        table.loc[7, station_statics.RESIDUAL] = np.nan
+        stats = station_statics.group_statistics(table)
+        self.assertEqual(len(stats), table['station'].nunique())
+        # As the notebook does, one station at a time
+        column = table[station_statics.RESIDUAL]
+        for station in table['station'].unique():
+            values = column[table['station'] == station]
+            self.assertAlmostEqual(stats.loc[station, 'mean'], values.mean())
+            self.assertAlmostEqual(stats.loc[station, 'std'], values.std())
+            self.assertEqual(stats.loc[station, 'count'], values.count())
+        corrected = station_statics.apply_statics(table, stats['mean'])
+        expected = table.apply(lambda row: row[station_statics.RESIDUAL] -
+                               stats.loc[row['station'], 'mean'], axis=1)
+        npt.assert_allclose(corrected.values, expected.values)
+        # By station and reporter, or for stations with no static
+        both = station_statics.group_statistics(table, ['station',
+                                                        'reporter'])
+        npt.assert_allclose(station_statics.apply_statics(table,
+            both['mean'], ['station', 'reporter']).values, expected.values)
+        self.assertTrue(np.isnan(station_statics.apply_statics(table,
+            stats['mean'][1:]).values[table['station'] ==
+                                      stats.index[0]]).all())
+
+    def test_huber_weights(self):
+        misfit = np.concatenate((np.random.RandomState(2).normal(size=100),
+                                 [50.0]))
+        weights = station_statics.huber_weights(misfit)
+        self.assertTrue(weights[-1] < 0.1)
+        self.assertTrue(np.mean(weights[:-1] == 1.0) > 0.7)
+        npt.assert_array_equal(station_statics.huber_weights(np.zeros(5)),
+                               1.0)
+
+    def test_joint(self):
+        table, statics, terms, _ = synthetic_table()
+        joint = station_statics.solve_joint(table, robust=False)
+        self.assertEqual(joint.iterations, 1)
+        # Statics and event terms are found up to a constant
+        shift = np.mean(joint.statics.values - statics)
+        npt.assert_allclose(joint.statics.values - shift, statics, atol=0.01)
+        npt.assert_allclose(joint.events.values + shift, terms, atol=0.01)
+        self.assertTrue(joint.rms < 0.011)
+        npt.assert_allclose(joint.misfit,
+            station_statics.apply_statics(table, joint.statics).values -
+            joint.events.reindex(table['eventid']).values, atol=1e-12)
+
+    def test_joint_sh(self):
+        table, statics, terms, cilm = synthetic_table(npicks=5000, lmax=2,
+                                                      outliers=50)
+        plain = station_statics.solve_joint(table, lmax=2, sensitivity=-0.1,
+                                            robust=False)
+        joint = station_statics.solve_joint(table, lmax=2, sensitivity=-0.1)
+        self.assertTrue(joint.iterations > 1)
+        self.assertTrue(np.all(joint.weights[:50] < 0.01))
+        self.assertTrue(np.mean(joint.weights[50:] == 1.0) > 0.7)
+        # It converged, and the weights are those of the final misfit
+        self.assertTrue(joint.iterations < 20)
+        npt.assert_allclose(joint.weights,
+                            station_statics.huber_weights(joint.misfit))
+        # Apart from degree zero, which trades off with the statics
+        cilm[0, 0, 0] = joint.model.cilm[0, 0, 0]
+        npt.assert_allclose(joint.model.cilm, cilm, atol=0.05)
+        shift = np.mean(joint.statics.values - statics)
+        npt.assert_allclose(joint.statics.values - shift, statics, atol=0.05)
+        self.assertTrue(np.abs(plain.statics.values - plain.statics.mean() -
+                               statics + statics.mean()).max() > 0.1)
+        # Rows without a bounce point are left out
+        table.loc[100, 'CMB_bounce_lat'] = np.nan
+        joint = station_statics.solve_joint(table, lmax=2, sensitivity=-0.1)
+        self.assertTrue(np.isnan(joint.misfit[100]))
+        self.assertEqual(joint.weights[100], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import ttime_table
+import unittest
+import os
+import tempfile
+import numpy as np
+import numpy.testing as npt
+from obspy.taup import TauPyModel
+
+# A small grid, so the table is quick to make, but with points at
+# the iasp91 Moho and Conrad discontinuities
+DISTANCES = np.arange(30.0, 131.0, 5.0)
+DEPTHS = np.array([0.0, 20.0, 35.0, 100.0, 200.0, 300.0, 400.0, 500.0, 600.0])
+
+
+class TestTravelTimeTable(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.table = ttime_table.TravelTimeTable.build(('P', 'PcP'),
+            distances=DISTANCES, depths=DEPTHS)
+
+    def test_agrees_with_taup(self):
+        model = TauPyModel(model='iasp91')
+        for distance, depth in ((42.3, 33.0), (61.7, 250.0), (77.0, 580.0)):
+            arrivals = model.get_pierce_points(depth, distance,
+                                               phase_list=['P', 'PcP'])
+            for phase in ('P', 'PcP'):
+                arrival = [a for a in arrivals if a.name == phase][0]
+                npt.assert_allclose(self.table.time(phase, distance, depth),
+                                    arrival.time, atol=0.3)
+                npt.assert_allclose(self.table.slowness(phase, distance, 
+                                    depth), arrival.ray_param_sec_degree,
+                                    atol=0.05)
+            arrival = [a for a in arrivals if a.name == 'PcP'][0]
+            bounce = np.degrees(arrival.pierce['dist'][
+                np.argmax(arrival.pierce['depth'])])
+            npt.assert_allclose(self.table.bounce_distance('PcP', distance,
+                                depth), bounce, atol=0.05)
+
+    def test_arrays(self):
+        distances = np.array([[40.0, 50.0], [60.0, 70.0]])
+        times = self.table.time('P', distances, 100.0)
+        self.assertEqual(times.shape, (2, 2))
+        for index in np.ndindex(distances.shape):
+            npt.assert_almost_equal(times[index],
+                self.table.time('P', distances[index], 100.0))
+
+    def test_missing(self):
+        # Outside the grid, and in the core shadow for P
+        self.assertTrue(np.isnan(self.table.time('P', 20.0, 100.0)))
+        self.assertTrue(np.isnan(self.table.time('P', 50.0, 700.0)))
+        self.assertTrue(np.isnan(self.table.time('P', 50.0, np.nan)))
+        self.assertTrue(np.isnan(self.table.time('P', 120.0, 100.0)))
+        self.assertFalse(np.isnan(self.table.time('P', 30.0, 0.0)))
+        self.assertFalse(np.isnan(self.table.time('P', 90.0, 600.0)))
+        self.assertRaises(ValueError, self.table.time, 'S', 50.0, 100.0)
+
+    def test_save_load(self):
+        fd, filename = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        try:
+            self.table.save(filename)
+            table = ttime_table.TravelTimeTable.load(filename)
+            self.assertEqual(table.model, 'iasp91')
+            self.assertEqual(table.phases, ('P', 'PcP'))
+            for key in self.table.values:
+                npt.assert_array_equal(table.values[key], 
+                                       self.table.values[key])
+            cached = ttime_table.cached_table(filename, ('PcP',), 
+                distances=DISTANCES, depths=DEPTHS)
+            self.assertEqual(cached.phases, ('P', 'PcP'))
+        finally:
+            os.remove(filename)
+
+    def test_accuracy_report(self):
+        report = ttime_table.accuracy_report(self.table, npoints=10)
+        self.assertEqual(set(report.keys()),
+            set((q, p) for q in ttime_table.QUANTITIES for p in ('P', 'PcP')))
+        self.assertEqual(report[('time', 'PcP')]['mismatch'], 0)
+        self.assertTrue(report[('time', 'PcP')]['max'] < 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
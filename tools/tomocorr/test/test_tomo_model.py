@@ -0,0 +1,147 @@
+"""Tests of the TomoModel class
+
+   Like test_tomo_predict, these need the tomo_predict module to
+   have been built and are run from the tomocorr directory.
+"""
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import tomo_model
+import tomo_predict
+from test_tomo_predict import FILE_1D, FILE_3D, MODEL_DIR, make_paths
+
+S362_FILE = os.path.join(MODEL_DIR, '..', '..', 'module_introductions',
+                         'S362WMANI-Xipercent.txt')
+
+
+def concatenate(paths):
+    offsets = np.cumsum([0] + [len(p[0]) for p in paths])
+    return [np.concatenate([p[i] for p in paths]) for i in range(3)] + \
+        [offsets]
+
+
+def test_model_agrees_with_setup():
+    tomo_predict.tomo_predict.setup(FILE_1D, FILE_3D)
+    model = tomo_model.TomoModel.from_files(FILE_1D, FILE_3D)
+    npt.assert_array_equal(model.dv, tomo_predict.tomo_predict.tomo)
+    npt.assert_array_equal(model.ztop, tomo_predict.tomo_predict.top_layer)
+    paths = make_paths(50)
+    expected = tomo_predict.tomo_predict.tomo_delay_batch(*concatenate(paths))
+    npt.assert_array_equal(model.delay_batch(*concatenate(paths)), expected)
+    npt.assert_almost_equal(model.delay(*paths[0]), expected[0])
+
+
+def test_models_are_independent():
+    model = tomo_model.TomoModel.from_files(FILE_1D, FILE_3D)
+    doubled = tomo_model.TomoModel(2*model.dv, model.ztop, model.zbot,
+                                   model.v1d)
+    zero = tomo_model.TomoModel(np.zeros_like(model.dv), model.ztop,
+                                model.zbot, model.v1d)
+    points = concatenate(make_paths(10))
+    dt = model.delay_batch(*points)
+    assert np.all(doubled.delay_batch(*points) != dt)
+    npt.assert_array_equal(zero.delay_batch(*points), 0.0)
+    npt.assert_array_equal(model.delay_batch(*points), dt)
+    with pytest.raises(ValueError):
+        model.dv[0,0,0] = 1.0
+
+
+def test_threads():
+    model = tomo_model.TomoModel.from_files(FILE_1D, FILE_3D)
+    batches = [concatenate(make_paths(20, seed=i)) for i in range(8)]
+    expected = [model.delay_batch(*batch) for batch in batches]
+    pool = ThreadPool(4)
+    try:
+        dts = pool.map(lambda batch: model.delay_batch(*batch), batches)
+    finally:
+        pool.close()
+    for dt, exp in zip(dts, expected):
+        npt.assert_array_equal(dt, exp)
+
+
+def test_bad_input():
+    model = tomo_model.TomoModel.from_files(FILE_1D, FILE_3D)
+    lat, lon, dep, offsets = concatenate(make_paths(2))
+    with pytest.raises(ValueError):
+        model.delay_batch(lat, lon, dep, offsets[:-1])
+    with pytest.raises(ValueError):
+        model.delay_batch(lat + 100.0, lon, dep, offsets)
+    with pytest.raises(ValueError):
+        tomo_model.TomoModel(model.dv[:,:,:-1], model.ztop, model.zbot,
+                             model.v1d)
+
+
+def test_grid_file():
+    model = tomo_model.TomoModel.from_files(FILE_1D, FILE_3D)
+    fd, filename = tempfile.mkstemp(suffix='.grid')
+    os.close(fd)
+    try:
+        model.save(filename)
+        assert tomo_model.is_grid_file(filename)
+        assert not tomo_model.is_grid_file(FILE_3D)
+        for mmap in (True, False):
+            loaded = tomo_model.TomoModel.from_files(FILE_1D, filename, 
+                                                     mmap=mmap)
+            npt.assert_array_equal(loaded.dv, model.dv)
+            npt.assert_array_equal(loaded.ztop, model.ztop)
+            npt.assert_array_equal(loaded.grid, model.grid)
+            points = concatenate(make_paths(10))
+            npt.assert_array_equal(loaded.delay_batch(*points),
+                                   model.delay_batch(*points))
+            del loaded
+    finally:
+        os.remove(filename)
+
+
+def test_grid_spacing():
+    # Refining the grid by linear interpolation should not change
+    # the delays, as the model is interpolated linearly anyway
+    model = tomo_model.TomoModel.from_files(FILE_1D, FILE_3D)
+    dv = np.empty((2*tomo_model.NLAT - 1, tomo_model.NLON, model.dv.shape[2]))
+    dv[::2] = model.dv
+    dv[1::2] = (model.dv[:-1] + model.dv[1:])/2.0
+    fine = np.empty((dv.shape[0], 2*tomo_model.NLON, dv.shape[2]))
+    fine[:,::2] = dv
+    fine[:,1::2] = (dv + np.roll(dv, -1, axis=1))/2.0
+    fine_model = tomo_model.TomoModel(fine, model.ztop, model.zbot, model.v1d,
+                                      grid=(-88.0, 1.0, -178.0, 1.0))
+    points = concatenate(make_paths(50))
+    npt.assert_allclose(fine_model.delay_batch(*points),
+                        model.delay_batch(*points), rtol=1e-4, atol=1e-4)
+
+
+def test_grid_edges():
+    # Latitude is clamped to the grid and longitude wraps around
+    dv = np.zeros((2, 4, 1))
+    dv[:,0,0] = [1.0, 2.0]
+    model = tomo_model.TomoModel(dv, [0.0], [6370.0], [10.0], 
+                                 grid=(-45.0, 90.0, 0.0, 90.0))
+    def resid(lat, lon):
+        # dt = l/(v(1 + resid/100)) - l/v
+        dt = model.delay([lat, lat], [lon, lon], [0.0, 10.0])
+        return 100.0*(1.0/(1.0 + dt) - 1.0)
+    npt.assert_almost_equal(resid(-80.0, 0.0), 1.0, decimal=4)
+    npt.assert_almost_equal(resid(80.0, 0.0), 2.0, decimal=4)
+    npt.assert_almost_equal(resid(-80.0, -45.0), 0.5, decimal=4)
+    npt.assert_almost_equal(resid(-80.0, 315.0), 0.5, decimal=4)
+    npt.assert_almost_equal(resid(0.0, 180.0), 0.0, decimal=4)
+
+
+def test_read_point_file():
+    dv, ztop, zbot, grid = tomo_model.read_point_file(S362_FILE,
+        columns=('lon', 'lat', 'value'), ztop=[2600.0], zbot=[2891.0])
+    assert dv.shape == (37, 72, 1)
+    npt.assert_array_equal(grid, (-90.0, 5.0, -180.0, 5.0))
+    data = np.loadtxt(S362_FILE)
+    for lon, lat, value in data[::97]:
+        ilat = int(round((lat + 90.0)/5.0))
+        ilon = int(round((lon + 180.0)/5.0)) % 72
+        npt.assert_almost_equal(dv[ilat,ilon,0], value, decimal=5)
+    with pytest.raises(ValueError):
+        tomo_model.read_point_file(S362_FILE, columns=('lon', 'lat', 'value'),
+                                   ztop=[2600.0, 2700.0], zbot=[2891.0])
@@ -0,0 +1,41 @@
+"""Tests of the Fortran tomographic correction
+
+   These need the tomo_predict module to have been built
+   (see the README) and are run from the tomocorr directory.
+"""
+import os
+
+import numpy as np
+import numpy.testing as npt
+
+import tomo_predict
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FILE_1D = os.path.join(MODEL_DIR, 'ak135.1D_vp')
+FILE_3D = os.path.join(MODEL_DIR, 'vdh3D_1999')
+
+
+def make_paths(npaths, seed=42):
+    """Some simple down-and-up paths through the mantle"""
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(npaths):
+        npts = rng.randint(2, 200)
+        lat = np.linspace(rng.uniform(-80, 80), rng.uniform(-80, 80), npts)
+        lon = np.linspace(rng.uniform(-170, 170), rng.uniform(-170, 170), npts)
+        dep = 2800.0 * np.sin(np.linspace(0, np.pi, npts))
+        paths.append((lat, lon, dep))
+    return paths
+
+
+def test_tomo_delay_batch():
+    tomo_predict.tomo_predict.setup(FILE_1D, FILE_3D)
+    paths = make_paths(50)
+    expected = [tomo_predict.tomo_predict.tomo_delay(lat, lon, dep) 
+                for lat, lon, dep in paths]
+    offsets = np.cumsum([0] + [len(p[0]) for p in paths])
+    dt = tomo_predict.tomo_predict.tomo_delay_batch(
+        np.concatenate([p[0] for p in paths]), 
+        np.concatenate([p[1] for p in paths]),
+        np.concatenate([p[2] for p in paths]), offsets)
+    npt.assert_array_equal(dt, np.array(expected, dtype=np.float32))
@@ -0,0 +1,63 @@
+"""Tests of run_tomocorr
+
+   These need the tomo_predict module to have been built and
+   are run from the tomocorr directory.
+"""
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+
+import geographiclib.geodesic as geod
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import tomocorr
+import tomocorr2
+
+SLAT = [13.60, 11.60, 40.0]
+SLON = [77.44, 80.44, 100.0]
+ELAT = [83.0, 81.0, -10.0]
+ELON = [8.0, 7.0, 120.0]
+EDEP = [100, 120, 35]
+STATN = ['GBA', 'HLMB', 'XYZ']
+
+
+def test_run_tomocorr():
+    startdir = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Nothing is written to (or needed from) the current directory
+        os.chdir(tmpdir)
+        dtP, dtPcP = tomocorr.run_tomocorr(SLAT, SLON, ELAT, ELON, EDEP,
+                                           STATN)
+        assert os.listdir(tmpdir) == []
+    finally:
+        os.chdir(startdir)
+        shutil.rmtree(tmpdir)
+    assert dtP.dtype == dtPcP.dtype == np.float64
+    assert dtP.shape == dtPcP.shape == (3,)
+    corrector = tomocorr2.TomographicCorrection(
+        os.path.join(tomocorr._SCRIPT_DIR, 'ak135.1D_vp'),
+        os.path.join(tomocorr._SCRIPT_DIR, 'vdh3D_1999'),
+        ellipsoid=geod.Geodesic(6371000.0, 0.0), taup_model=tomocorr._AK135)
+    for i in range(3):
+        for phase, dt in (('P', dtP), ('PcP', dtPcP)):
+            npt.assert_allclose(dt[i], corrector.calculate(ELAT[i], ELON[i],
+                EDEP[i], SLAT[i], SLON[i], [phase])[0], rtol=1e-6)
+    with pytest.raises(ValueError):
+        tomocorr.run_tomocorr(SLAT, SLON, ELAT, ELON, EDEP, STATN[:2])
+
+
+def test_run_tomocorr_threads():
+    expected = tomocorr.run_tomocorr(SLAT, SLON, ELAT, ELON, EDEP, STATN)
+    pool = ThreadPool(4)
+    try:
+        results = pool.map(lambda i: tomocorr.run_tomocorr(SLAT[i], SLON[i],
+            ELAT[i], ELON[i], EDEP[i], STATN[i:i+1]), [0, 1, 2] * 3)
+    finally:
+        pool.close()
+    for k, (dtP, dtPcP) in enumerate(results):
+        npt.assert_array_equal(dtP, expected[0][k % 3:k % 3 + 1])
+        npt.assert_array_equal(dtPcP, expected[1][k % 3:k % 3 + 1])
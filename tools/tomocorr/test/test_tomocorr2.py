@@ -0,0 +1,93 @@
+"""Tests of the geographical ray paths in tomocorr2
+
+   These need obspy and geographiclib, and are run from the
+   tomocorr directory.
+"""
+import geographiclib.geodesic as geod
+import numpy as np
+import numpy.testing as npt
+
+import tomocorr2
+from test_tomo_predict import FILE_1D, FILE_3D
+
+SPHERE = geod.Geodesic(6371000.0, 0.0)
+
+
+def lon_difference(lon1, lon2):
+    d = np.abs(np.asarray(lon1) - np.asarray(lon2)) % 360.0
+    return np.minimum(d, 360.0 - d)
+
+
+def test_arc_positions():
+    rng = np.random.RandomState(7)
+    for ellipsoid in (geod.Geodesic.WGS84, SPHERE):
+        for i in range(20):
+            lat1 = rng.uniform(-90, 90)
+            lon1 = rng.uniform(-180, 180)
+            azi1 = rng.uniform(-180, 180)
+            arc = np.linspace(0.0, rng.uniform(0, 180), 30)
+            line = ellipsoid.Line(lat1, lon1, azi1)
+            expected = [line.ArcPosition(a) for a in arc]
+            lat, lon = tomocorr2.arc_positions(lat1, lon1, azi1, arc,
+                                               ellipsoid.f)
+            npt.assert_allclose(lat, [e['lat2'] for e in expected], atol=1e-8)
+            npt.assert_allclose(lon_difference(lon, [e['lon2'] for e in
+                                                     expected]), 0, atol=1e-7)
+
+
+def test_get_ray_paths_geo():
+    model = tomocorr2.TauPyModelGeo(model='iasp91', ellipsoid=SPHERE)
+    arrivals = model.get_ray_paths_geo(100.0, 10.0, 20.0, -30.0, 100.0,
+                                       phase_list=('P', 'PcP', 'PKiKP'))
+    assert len(arrivals) > 1
+    for arrival in arrivals:
+        path = arrival.path
+        assert path.dtype == tomocorr2.TimeDistLoc
+        npt.assert_almost_equal(path['lat'][0], 10.0)
+        npt.assert_almost_equal(path['lon'][0], 20.0)
+        npt.assert_almost_equal(path['lat'][-1], -30.0, decimal=2)
+        npt.assert_almost_equal(path['lon'][-1], 100.0, decimal=2)
+    pierce = model.get_pierce_points_geo(100.0, 10.0, 20.0, -30.0, 100.0,
+                                         phase_list=('PcP',))
+    line = SPHERE.Line(10.0, 20.0,
+                       SPHERE.Inverse(10.0, 20.0, -30.0, 100.0)['azi1'])
+    for point in pierce[0].pierce:
+        expected = line.ArcPosition(np.degrees(point['dist']))
+        npt.assert_almost_equal(point['lat'], expected['lat2'])
+        npt.assert_almost_equal(point['lon'], expected['lon2'])
+
+
+def test_unique_paths():
+    evtlat = np.array([10.0, 10.0, 20.0, 10.0])
+    evtlon = np.array([5.0, 5.0, 5.0, 6.0])
+    first, inverse = tomocorr2.unique_paths(evtlat, evtlon, 100.0)
+    assert len(first) == 3
+    npt.assert_array_equal(evtlat[first][inverse], evtlat)
+    npt.assert_array_equal(evtlon[first][inverse], evtlon)
+    first, inverse = tomocorr2.unique_paths([], [])
+    assert len(first) == 0 and len(inverse) == 0
+
+
+def test_calculate_many_duplicates():
+    corrector = tomocorr2.TomographicCorrection(FILE_1D, FILE_3D,
+                                                ellipsoid=SPHERE)
+    evtlat = np.array([10.0, -20.0, 10.0, 10.0])
+    evtlon = np.array([20.0, 30.0, 20.0, 20.0])
+    stalat = np.array([50.0, 20.0, 50.0, 51.0])
+    traced = []
+    get_ray_paths_geo = corrector.earth_model.get_ray_paths_geo
+
+    def counting(*args):
+        traced.append(args)
+        return get_ray_paths_geo(*args)
+
+    corrector.earth_model.get_ray_paths_geo = counting
+    dt = corrector.calculate_many(evtlat, evtlon, 100.0, stalat, 60.0,
+                                  ['P', 'PcP'])
+    assert len(traced) == 3
+    assert dt.shape == (4, 2)
+    npt.assert_array_equal(dt[0], dt[2])
+    for i in range(4):
+        npt.assert_allclose(dt[i], [corrector.calculate(evtlat[i],
+            evtlon[i], 100.0, stalat[i], 60.0, [phase])[0]
+            for phase in ('P', 'PcP')], rtol=1e-6)
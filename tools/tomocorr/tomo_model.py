@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""3D velocity models for tomographic corrections
+
+   The Fortran module tomo_predict keeps a single model in module
+   variables, set once by tomo_predict.setup. A TomoModel instead
+   holds its own copy of the model arrays and passes them to the
+   Fortran on every call, so any number of models can be loaded
+   at once in one process, and a model can be replaced by just
+   making a new one. The Fortran routines used (path_delay_batch)
+   do not touch any module state and release the GIL, so one model
+   can also be used from many threads at once:
+
+       model = tomo_model.TomoModel.from_files('ak135.1D_vp', 'vdh3D_1999')
+       pool = multiprocessing.pool.ThreadPool(4)
+       dts = pool.map(model.path_delays, list_of_lists_of_paths)
+
+   Models can be on any regular latitude-longitude grid, with any
+   number of layers. As well as the vdh3D_1999 format read by the
+   Fortran, models can be read from files of points (such as
+   S362WMANI-Xipercent.txt), and saved in a binary format which
+   is much quicker to read:
+
+       dv, ztop, zbot, grid = tomo_model.read_point_file(
+           'S362WMANI-Xipercent.txt', columns=('lon', 'lat', 'value'),
+           ztop=[2600.0], zbot=[2891.0])
+       tomo_model.write_grid_file('S362WMANI.grid', dv, ztop, zbot, grid)
+       model = tomo_model.TomoModel.from_files('ak135.1D_vp', 'S362WMANI.grid')
+
+   or from the command line, to convert a vdh3D_1999 format file:
+
+       $ python tomo_model.py vdh3D_1999 vdh3D_1999.grid
+"""
+
+import struct
+import sys
+
+import numpy as np
+
+import tomo_predict
+
+# The grid of the vdh3D_1999 format (see read_3d_model in
+# tomo_predict.f90): first latitude, latitude spacing, first
+# longitude, longitude spacing, and the number of each
+VDH_GRID = (-88.0, 2.0, -178.0, 2.0)
+NLAT = 89
+NLON = 180
+
+# Earth radius used by the Fortran
+RMAX = 6370.0
+
+# Binary grid files start with a fixed size header holding
+# GRID_MAGIC, the number of latitudes, longitudes and layers
+# and the grid. This is followed by the top and bottom depths
+# of the layers and the model, all little endian float32, with
+# latitude varying fastest and then longitude.
+GRID_MAGIC = b'TOMOGRD1'
+_GRID_HEADER = struct.Struct('<8s3i4x4d')
+
+
+class TomoModel(object):
+    """A 3D model of velocity perturbations and the 1D model it perturbs
+
+       dv is an array of shape (number of latitudes, number of longitudes,
+       number of layers) of velocity perturbations in %. grid is the
+       latitude of dv[0,:,:], the latitude spacing, the longitude of
+       dv[:,0,:] and the longitude spacing, in degrees; the default is
+       the grid of vdh3D_1999. Outside the grid in latitude the value
+       at the nearest edge is used, and if the longitudes cover 360
+       degrees they wrap around. ztop and zbot are the depths in km to
+       the top and bottom of each layer, and v1d is the velocity in km/s
+       of the 1D model at 1, 2, 3... km depth. The arrays are copied
+       (to float32, in the layout the Fortran wants) unless they are
+       already read only, and made read only, so a model cannot change
+       once it is made.
+    """
+
+    def __init__(self, dv, ztop, zbot, v1d, grid=VDH_GRID):
+        self.dv = np.asfortranarray(dv, dtype=np.float32)
+        self.ztop = np.array(ztop, dtype=np.float32)
+        self.zbot = np.array(zbot, dtype=np.float32)
+        self.v1d = np.array(v1d, dtype=np.float32)
+        self.grid = np.array(grid, dtype=np.float64)
+        if self.dv.ndim != 3 or self.dv.size == 0:
+            raise ValueError("3D model must be a non-empty 3D array")
+        if self.ztop.shape != (self.dv.shape[2],) or \
+                self.zbot.shape != self.ztop.shape:
+            raise ValueError("Need a top and bottom depth for each layer")
+        if self.v1d.ndim != 1 or self.v1d.size == 0:
+            raise ValueError("1D model must be a non-empty 1D array")
+        if self.grid.shape != (4,) or self.grid[1] <= 0 or self.grid[3] <= 0:
+            raise ValueError("grid must be first latitude, latitude spacing, "
+                             "first longitude and longitude spacing")
+        if self.dv.flags.writeable and np.may_share_memory(self.dv, dv):
+            self.dv = self.dv.copy(order='F')
+        for array in (self.dv, self.ztop, self.zbot, self.v1d, self.grid):
+            array.flags.writeable = False
+
+    @classmethod
+    def from_files(cls, file_1d, file_3d, mmap=True):
+        """Read a model from a 1D model file and a 3D model file
+
+           file_1d has lines of integer depth (1, 2, 3... km) and velocity,
+           as read by tomo_predict.setup. file_3d is either a binary grid
+           file (see write_grid_file), which is memory mapped unless mmap
+           is False, or a file in the vdh3D_1999 format (see read_vdh_file).
+        """
+        if is_grid_file(file_3d):
+            dv, ztop, zbot, grid = read_grid_file(file_3d, mmap=mmap)
+        else:
+            dv, ztop, zbot, grid = read_vdh_file(file_3d)
+        return cls(dv, ztop, zbot, read_1d_file(file_1d), grid)
+
+    def delay(self, lat, lon, dep):
+        """Travel time perturbation (s) for one path given by arrays of
+           latitude, longitude (degrees) and depth (km) of its points"""
+        lat, lon, dep = [np.atleast_1d(x) for x in (lat, lon, dep)]
+        return float(self.delay_batch(lat, lon, dep, [0, lat.size])[0])
+
+    def delay_batch(self, lat, lon, dep, offsets):
+        """Travel time perturbations for many paths
+
+           The points of all paths are concatenated in lat, lon and dep,
+           and path i is made of points offsets[i] to offsets[i+1]-1, as
+           for tomo_predict.tomo_delay_batch. Returns an array with one
+           perturbation per path.
+        """
+        lat = np.asarray(lat, dtype=np.float32)
+        lon = np.asarray(lon, dtype=np.float32)
+        dep = np.asarray(dep, dtype=np.float32)
+        offsets = np.asarray(offsets, dtype=np.int32)
+        # The Fortran stops the program on bad input, so check first
+        if not lat.shape == lon.shape == dep.shape or lat.ndim != 1:
+            raise ValueError("lat, lon and dep must be 1D and the same length")
+        if offsets.ndim != 1 or offsets.size < 1 or offsets[0] != 0 or \
+                offsets[-1] != lat.size or np.any(np.diff(offsets) < 0):
+            raise ValueError("offsets must increase from 0 to the number "
+                             "of points")
+        if np.any(np.abs(lat) > 90.0):
+            raise ValueError("Latitude must be in range -90 to 90 degrees")
+        if np.any(dep > RMAX):
+            raise ValueError("Maximum depth is Earth radius ({} km)"
+                             .format(RMAX))
+        return tomo_predict.tomo_predict.path_delay_batch(self.dv, self.grid,
+                    self.ztop, self.zbot, self.v1d, lat, lon, dep, offsets)
+
+    def path_delays(self, paths):
+        """Travel time perturbations for a list of ray paths
+
+           Each path is an array with lat, lon and depth fields (such as
+           the path of an arrival from tomocorr2.TauPyModelGeo), and the
+           perturbations for all of them are found in one call to the
+           Fortran. Returns an array of the perturbation for each path.
+        """
+        offsets = np.zeros(len(paths) + 1, dtype=np.int32)
+        np.cumsum([len(path) for path in paths], out=offsets[1:])
+        if len(paths) == 0:
+            return np.zeros(0, dtype=np.float32)
+        points = np.concatenate(paths)
+        return self.delay_batch(points['lat'], points['lon'],
+                                points['depth'], offsets)
+
+    def save(self, filename):
+        """Write the 3D part of the model to a binary grid file"""
+        write_grid_file(filename, self.dv, self.ztop, self.zbot, self.grid)
+
+
+def read_1d_file(filename):
+    """Velocities of a 1D model in the format read by tomo_predict.setup,
+       which has lines of depth (1, 2, 3... km) and velocity (km/s)"""
+    model_1d = np.loadtxt(filename, ndmin=2)
+    if model_1d.shape[0] == 0 or model_1d.shape[1] < 2:
+        raise ValueError("Error reading 1D velocity file " + filename)
+    if np.any(model_1d[:,0] != np.arange(1, model_1d.shape[0] + 1)):
+        raise ValueError("1D velocity file " + filename +
+                         " must have depths 1, 2, 3... km")
+    return model_1d[:,1]
+
+
+def read_vdh_file(filename):
+    """Read a 3D model in the vdh3D_1999 format
+
+       For each layer, the file has a line with the top and bottom
+       depths followed by one value per line of the perturbation at
+       each point of the VDH_GRID, longitude varying fastest, from the
+       north (see read_3d_model in tomo_predict.f90). Any number of
+       layers may be given. Returns dv, ztop, zbot and grid, as taken
+       by TomoModel.
+    """
+    with open(filename, 'r') as fh:
+        values = np.array(fh.read().split(), dtype=np.float32)
+    layer_size = 2 + NLAT*NLON
+    if values.size == 0 or values.size % layer_size != 0:
+        raise ValueError("3D model file " + filename +
+                         " does not have whole layers")
+    layers = values.reshape(-1, layer_size)
+    dv = layers[:,2:].reshape(-1, NLAT, NLON)[:,::-1,:].transpose(1, 2, 0)
+    return dv, layers[:,0], layers[:,1], VDH_GRID
+
+
+def _regular_axis(values, name, periodic=False):
+    """The start, spacing and indices of a set of coordinates which
+       should lie on a regular grid"""
+    nodes = np.unique(values)
+    if periodic and nodes.size > 1 and \
+            np.isclose(nodes[-1] - nodes[0], 360.0):
+        # The first longitude is repeated at the end
+        nodes = nodes[:-1]
+        values = np.where(np.isclose(values, nodes[0] + 360.0),
+                          nodes[0], values)
+    if nodes.size == 1:
+        return nodes[0], 1.0, np.zeros(values.shape, dtype=int)
+    step = (nodes[-1] - nodes[0])/(nodes.size - 1)
+    if not np.allclose(np.diff(nodes), step):
+        raise ValueError(name + " values are not regularly spaced")
+    return nodes[0], step, np.rint((values - nodes[0])/step).astype(int)
+
+
+def read_point_file(filename, columns=('lat', 'lon', 'depth', 'value'),
+                    ztop=None, zbot=None, **kwargs):
+    """Read a 3D model from a text file with one point per line
+
+       columns names the columns of the file, as 'lat', 'lon', 'depth'
+       or 'radius' (km), 'value' (the perturbation in %) or None for
+       columns to ignore. For example S362WMANI-Xipercent.txt has
+       columns ('lon', 'lat', 'value') and
+       TX2008.V2.T9.6.topo.pretexture.P100.Xi.dat has columns
+       ('lat', 'lon', 'radius', 'value'). The points may be in any
+       order, but must cover a regular grid. If the last longitude is
+       the first plus 360 degrees it is dropped. Each depth is a layer,
+       extending half way to the next (and to the surface and centre
+       of the Earth at the ends), unless ztop and zbot are given.
+       Other arguments are passed to numpy.loadtxt. Returns dv, ztop,
+       zbot and grid, as taken by TomoModel.
+    """
+    data = np.loadtxt(filename, ndmin=2, **kwargs)
+    if data.shape[1] != len(columns):
+        raise ValueError("File " + filename + " has {} columns, not {}"
+                         .format(data.shape[1], len(columns)))
+    columns = list(columns)
+    for name in ('lat', 'lon', 'value'):
+        if name not in columns:
+            raise ValueError("Need a " + name + " column")
+    lat0, dlat, ilat = _regular_axis(data[:,columns.index('lat')], 'Latitude')
+    lon0, dlon, ilon = _regular_axis(data[:,columns.index('lon')],
+                                     'Longitude', periodic=True)
+    if 'depth' in columns:
+        depth = data[:,columns.index('depth')]
+    elif 'radius' in columns:
+        depth = RMAX - data[:,columns.index('radius')]
+    else:
+        depth = np.zeros(data.shape[0])
+    depths, idepth = np.unique(depth, return_inverse=True)
+
+    shape = (ilat.max() + 1, ilon.max() + 1, depths.size)
+    dv = np.empty(shape, dtype=np.float32, order='F')
+    dv.fill(np.nan)
+    dv[ilat,ilon,idepth] = data[:,columns.index('value')]
+    if np.any(np.isnan(dv)):
+        raise ValueError("File " + filename + " does not have a value at "
+                         "every grid point")
+    if ztop is None:
+        ztop = np.concatenate([[0.0], (depths[1:] + depths[:-1])/2.0])
+    if zbot is None:
+        zbot = np.concatenate([(depths[1:] + depths[:-1])/2.0, [RMAX]])
+    if len(ztop) != depths.size or len(zbot) != depths.size:
+        raise ValueError("Need a top and bottom depth for each of the {} "
+                         "layers".format(depths.size))
+    return dv, np.asarray(ztop), np.asarray(zbot), (lat0, dlat, lon0, dlon)
+
+
+def is_grid_file(filename):
+    """Whether a file is a binary grid file written by write_grid_file"""
+    with open(filename, 'rb') as fh:
+        return fh.read(len(GRID_MAGIC)) == GRID_MAGIC
+
+
+def write_grid_file(filename, dv, ztop, zbot, grid):
+    """Write a 3D model to a binary grid file"""
+    dv = np.asarray(dv, dtype='<f4')
+    if dv.ndim != 3 or len(ztop) != dv.shape[2] or len(zbot) != dv.shape[2]:
+        raise ValueError("Need a 3D model with a top and bottom depth for "
+                         "each layer")
+    with open(filename, 'wb') as fh:
+        fh.write(_GRID_HEADER.pack(GRID_MAGIC, dv.shape[0], dv.shape[1],
+                                   dv.shape[2], *[float(x) for x in grid]))
+        fh.write(np.asarray(ztop, dtype='<f4').tobytes())
+        fh.write(np.asarray(zbot, dtype='<f4').tobytes())
+        fh.write(dv.tobytes(order='F'))
+
+
+def read_grid_file(filename, mmap=True):
+    """Read a 3D model written by write_grid_file
+
+       Unless mmap is False, the model is memory mapped (read only), so
+       reading it takes no time and the pages are shared with any other
+       process using the same file. Returns dv, ztop, zbot and grid, as
+       taken by TomoModel.
+    """
+    with open(filename, 'rb') as fh:
+        header = fh.read(_GRID_HEADER.size)
+        if len(header) != _GRID_HEADER.size or \
+                header[:len(GRID_MAGIC)] != GRID_MAGIC:
+            raise ValueError("File " + filename + " is not a grid file")
+        _, nlat, nlon, nlayers, lat0, dlat, lon0, dlon = \
+            _GRID_HEADER.unpack(header)
+        depths = np.fromfile(fh, dtype='<f4', count=2*nlayers)
+        if not mmap:
+            dv = np.fromfile(fh, dtype='<f4', count=nlat*nlon*nlayers)
+    if depths.size != 2*nlayers or (not mmap and dv.size != nlat*nlon*nlayers):
+        raise ValueError("Grid file " + filename + " is truncated")
+    if mmap:
+        dv = np.memmap(filename, dtype='<f4', mode='r', order='F',
+                       offset=_GRID_HEADER.size + 8*nlayers,
+                       shape=(nlat, nlon, nlayers))
+    else:
+        dv = dv.reshape((nlat, nlon, nlayers), order='F')
+    return dv, depths[:nlayers], depths[nlayers:], (lat0, dlat, lon0, dlon)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("Usage: tomo_model.py vdh_format_file grid_file")
+    write_grid_file(sys.argv[2], *read_vdh_file(sys.argv[1]))
@@ -9,7 +9,8 @@ module tomo_predict
    logical :: debug = .false.
 
    ! 1D and 3D models
-   ! TODO: Make model more flexible
+   ! The model read by setup has a fixed size and grid; models passed to
+   ! path_delay can have any regular grid (see below)
    integer, parameter :: nlat = 89, nlon = 180, nz = 20
    integer, parameter :: nr1dmax = 10000
    real, parameter :: rmax = 6370.
@@ -23,14 +24,19 @@ module tomo_predict
    !          latitude, -178 to 180 longitude, with 20 radial layers which have
    !          their bottom depth and top depths respectively in arrays bot and top.
    !          (NB: I'm not entirely sure this is correct!)
+   ! vdh_lat0, vdh_dlat, vdh_lon0, vdh_dlon: The grid of tomo: first latitude,
+   !          latitude spacing, first longitude and longitude spacing (degrees)
    real, save :: tomo(nlat,nlon,nz), top_layer(nz), bot_layer(nz), v1d(nr1dmax), &
                  z1d(nr1dmax)
+   real, parameter :: vdh_lat0 = -88., vdh_dlat = 2., vdh_lon0 = -178., vdh_dlon = 2.
    integer, save :: nr1d
    ! Once this is set to .true., the model is fixed and cannot be replaced.
-   ! TODO: Add ability to change model
+   ! To use other models, or several at once, pass the model arrays to
+   ! path_delay or path_delay_batch instead (see tomo_model.py).
    logical, save :: setup_done = .false.
 
-   public :: predict, read_taup_time_file, setup, tomo_delay
+   public :: predict, read_taup_time_file, setup, tomo_delay, tomo_delay_batch, &
+             path_delay, path_delay_batch
 
 contains
 
@@ -81,6 +87,7 @@ subroutine tomo_delay(lat, lon, dep, dt)
 ! subroutine tomo_delay gives the travel time perturbation for a predefined
 ! ray path within a 3D model of velocity perturbations with respect to a 1D model.
 ! Positive times mean the phase arrives later in time than expected in the 1D model.
+! This uses the model read by setup; see path_delay to pass a model explicitly.
 ! INPUT:
 !     lat         : Array of latitudes (degrees)
 !     lon         : Array of longitudes (degrees)
@@ -90,28 +97,118 @@ subroutine tomo_delay(lat, lon, dep, dt)
    ! IO
    real, intent(in) :: lat(:), lon(:), dep(:)
    real, intent(out) :: dt
-   real :: path_len, dt_segment, resid
-   integer :: i, iz
 
    if (.not.setup_done) error stop 'tomo_delay: Must call setup() first'
+   call path_delay(tomo, [real(8) :: vdh_lat0, vdh_dlat, vdh_lon0, vdh_dlon], &
+                   top_layer, bot_layer, v1d(1:nr1d), lat, lon, dep, dt)
+end subroutine tomo_delay
+
+
+subroutine path_delay(dv, grid, ztop, zbot, v, lat, lon, dep, dt)
+! subroutine path_delay gives the travel time perturbation for a ray path, like
+! tomo_delay, but for the model given in the arguments rather than the one
+! read by setup.  It uses no module variables (apart from debug), so it can
+! be called for different models, and from several threads at once.
+! INPUT:
+!     dv          : 3D model velocity perturbations (%), dv(i,j,k) being at
+!                   latitude grid(1) + (i-1)*grid(2), longitude
+!                   grid(3) + (j-1)*grid(4), in layer k
+!     grid        : First latitude, latitude spacing, first longitude and
+!                   longitude spacing of dv (degrees)
+!     ztop, zbot  : Depths to the top and bottom of each layer of dv (km)
+!     v           : 1D model velocity at 1, 2, 3, ... km depth (km/s)
+!     lat         : Array of latitudes (degrees)
+!     lon         : Array of longitudes (degrees)
+!     dep         : Array of depths (km)
+! OUTPUT:
+!     dt          : Traveltime perturbation (s)
+   real, intent(in) :: dv(:,:,:), ztop(:), zbot(:), v(:)
+   real(8), intent(in) :: grid(4)
+   real, intent(in) :: lat(:), lon(:), dep(:)
+   real, intent(out) :: dt
+   real :: path_len, dt_segment, resid, x1(3), x2(3)
+   integer :: i, iz
 
    if (size(lat) /= size(lon) .or. size(lon) /= size(dep)) &
       error stop 'tomo_delay: lat, lon and dep arrays must be the same length'
    if (any(dep > rmax)) error stop 'tomo_delay: maximum depth is Earth radius (6370 km)'
+   if (any(abs(lat) > 90.)) error stop 'tomo_delay: Latitude must be in range -90 to 90 degrees'
 
    dt = 0.
+   if (size(lat) == 0) return
 
+   ! Segment lengths as in function distance, but only converting each
+   ! point to cartesian coordinates once
+   x1 = lon_lat_r2vec(lon(1), lat(1), rmax - dep(1))
    do i = 2, size(lat)
-      path_len = distance(lon(i), lat(i), rmax - dep(i), &
-                          lon(i-1), lat(i-1), rmax - dep(i-1))
+      x2 = lon_lat_r2vec(lon(i), lat(i), rmax - dep(i))
+      path_len = sqrt(sum((x2 - x1)**2))
+      x1 = x2
       ! Where we assume that the 1D model has z(i) == i
-      iz = min(max(nint(dep(i)), 1), nr1d)
-      call get_dt(lat(i), lon(i), dep(i), v1d(iz), path_len, dt_segment, resid)
+      iz = min(max(nint(dep(i)), 1), size(v))
+      call get_dt_model(dv, grid, ztop, zbot, lat(i), lon(i), dep(i), v(iz), path_len, &
+                        dt_segment, resid)
       dt = dt + dt_segment
       if (debug) write(0,'(a,6(1x,f7.2),2(1x,f9.4))') &
-         'tomo_delay:', dep(i), path_len, v1d(iz), resid,  lat(i), lon(i), dt_segment, dt
+         'tomo_delay:', dep(i), path_len, v(iz), resid,  lat(i), lon(i), dt_segment, dt
    enddo
-end subroutine tomo_delay
+end subroutine path_delay
+
+
+subroutine tomo_delay_batch(lat, lon, dep, offsets, dt)
+! subroutine tomo_delay_batch gives the travel time perturbations for many ray
+! paths in one call, to avoid the overhead of calling tomo_delay from Python
+! once per path.  The points of all the paths are concatenated into single
+! arrays, and offsets says where each path starts: path i runs from point
+! offsets(i)+1 to offsets(i+1).  (That is, offsets are zero-based as in Python,
+! start at 0 and end with the total number of points.)
+! INPUT:
+!     lat         : Array of latitudes of all path points (degrees)
+!     lon         : Array of longitudes of all path points (degrees)
+!     dep         : Array of depths of all path points (km)
+!     offsets     : Array of the number of points before each path, plus the
+!                   total number of points (length number of paths + 1)
+! OUTPUT:
+!     dt          : Traveltime perturbation for each path (s)
+   real, intent(in) :: lat(:), lon(:), dep(:)
+   integer, intent(in) :: offsets(:)
+   real, intent(out) :: dt(size(offsets) - 1)
+
+   if (.not.setup_done) error stop 'tomo_delay_batch: Must call setup() first'
+   call path_delay_batch(tomo, [real(8) :: vdh_lat0, vdh_dlat, vdh_lon0, vdh_dlon], &
+                         top_layer, bot_layer, v1d(1:nr1d), lat, lon, dep, offsets, dt)
+end subroutine tomo_delay_batch
+
+
+subroutine path_delay_batch(dv, grid, ztop, zbot, v, lat, lon, dep, offsets, dt)
+! subroutine path_delay_batch is tomo_delay_batch for the model given in the
+! arguments (see path_delay).  The Python wrapper releases the GIL while
+! this runs, so many batches can be computed at once from a thread pool.
+!f2py threadsafe
+   real, intent(in) :: dv(:,:,:), ztop(:), zbot(:), v(:)
+   real(8), intent(in) :: grid(4)
+   real, intent(in) :: lat(:), lon(:), dep(:)
+   integer, intent(in) :: offsets(:)
+   real, intent(out) :: dt(size(offsets) - 1)
+   integer :: i
+
+   if (size(dv) == 0 .or. size(dv, 3) /= size(ztop) .or. size(ztop) /= size(zbot)) &
+      error stop 'tomo_delay_batch: 3D model arrays have the wrong shape'
+   if (grid(2) <= 0. .or. grid(4) <= 0.) &
+      error stop 'tomo_delay_batch: Grid spacing must be positive'
+   if (size(v) < 1) error stop 'tomo_delay_batch: 1D model is empty'
+   if (size(offsets) < 1) error stop 'tomo_delay_batch: offsets must not be empty'
+   if (offsets(1) /= 0 .or. offsets(size(offsets)) /= size(lat)) &
+      error stop 'tomo_delay_batch: offsets must run from 0 to the number of points'
+   if (any(offsets(2:) < offsets(:size(offsets)-1))) &
+      error stop 'tomo_delay_batch: offsets must not decrease'
+
+   do i = 1, size(offsets) - 1
+      call path_delay(dv, grid, ztop, zbot, v, lat(offsets(i)+1:offsets(i+1)), &
+                      lon(offsets(i)+1:offsets(i+1)), dep(offsets(i)+1:offsets(i+1)), &
+                      dt(i))
+   enddo
+end subroutine path_delay_batch
 
 
 function distance(lon1, lat1, r1, lon2, lat2, r2) result(d)
@@ -143,6 +240,7 @@ function lon_lat_r2vec(lon, lat, r) result(x)
 end function lon_lat_r2vec
 
 
+
 subroutine read_1d_model(file, nmax, z, v, n)
    ! subroutine read_1d_model returns the depths and velocities of a 1D model
    ! File must contain:
@@ -214,9 +312,9 @@ subroutine get_dt(lat1, lon1, dep, VPREM, sddp, dt, resid)
 !       which can be linearly interpolated between points
 !     - The point supplied experiences a uniform velocity along its path length
 !       (despite the first assumption!)
-!     The implementation assumes:
-!     - The 3D model has 180 longitude points, 89 latitude points, and 20 layers,
-!       where point tomo(1,2,3) is at (lat,lon) = (2,4), and so on.
+!     - Outside the grid in latitude, the value at the nearest edge applies;
+!       the grid wraps around in longitude if it covers 360 degrees.
+!     This uses the model read by setup; see get_dt_model for other grids.
 ! Written by Edward J. Garnero
 ! Modified by Andy Nowacki, University of Leeds (a.nowacki@leeds.ac.uk)
 ! to avoid implicit variables and declare intents, and reformat.
@@ -231,54 +329,94 @@ subroutine get_dt(lat1, lon1, dep, VPREM, sddp, dt, resid)
 !
    real, intent(in) :: lat1, lon1, dep, VPREM, sddp
    real, intent(out) :: dt, resid
-   integer :: izi, layer, lathi, latlo, lonhi, lonlo, ilatlo, ilathi, ilonlo, ilonhi
-   real :: fact, vlatlo, vlathi, Tprem, Tanom
+
+   call get_dt_model(tomo, [real(8) :: vdh_lat0, vdh_dlat, vdh_lon0, vdh_dlon], &
+                     top_layer, bot_layer, lat1, lon1, dep, VPREM, sddp, dt, resid)
+end subroutine get_dt
+
+
+subroutine get_dt_model(dv, grid, ztop, zbot, lat1, lon1, dep, VPREM, sddp, dt, resid)
+! subroutine get_dt_model is get_dt for the 3D model given in the arguments,
+! with velocity perturbations dv on the grid described by grid, and layer
+! depths ztop and zbot (see path_delay).
+   real, intent(in) :: dv(:,:,:), ztop(:), zbot(:)
+   real(8), intent(in) :: grid(4)
+   real, intent(in) :: lat1, lon1, dep, VPREM, sddp
+   real, intent(out) :: dt, resid
+   integer :: izi, layer, ilatlo, ilathi, ilonlo, ilonhi
+   real :: fact_lat, fact_lon, vlatlo, vlathi, Tprem, Tanom
+   logical :: periodic
 
    ! get VDH model depth index
-   do izi = 1, 20
-      if (dep >= top_layer(izi) .and. dep <= bot_layer(izi)) then
+   layer = size(ztop)
+   do izi = 1, size(ztop)
+      if (dep >= ztop(izi) .and. dep <= zbot(izi)) then
          layer = izi
          exit
       endif
-      if (izi == 20) layer = izi
    enddo
 
-   ! get VDH grid pt coords surrounding lat,lon
-   lathi = int(lat1/2.)*2
-   if (lat1 > 0.) then
-       latlo = lathi
-       lathi = lathi + 2
-   else
-       latlo = lathi - 2
-   endif
-   if (latlo < -88) latlo = -88
-   if (lathi > 88) lathi = 88
-   lonhi = int(lon1/2.)*2
-   if (lon1.gt.0 ) then
-       lonlo = lonhi
-       lonhi = lonhi + 2
-   else
-       lonlo = lonhi - 2
-   endif
-   lonlo = lonhi - 2
-   ilatlo = 45 + latlo/2
-   ilathi = ilatlo + 1
-   ilonlo = 90 + lonlo/2
-   ilonhi = ilonlo + 1
+   ! get grid pt coords surrounding lat,lon
+   periodic = abs(size(dv, 2)*grid(4) - 360._8) < 1.e-6_8
+   call grid_index(lat1, grid(1), grid(2), size(dv, 1), .false., ilatlo, ilathi, fact_lat)
+   call grid_index(lon1, grid(3), grid(4), size(dv, 2), periodic, ilonlo, ilonhi, fact_lon)
 
    ! get resids @ corners, then @ lat1,lon1 (all in %)
-   fact = (lat1 - real(latlo)) / 2.
-   vlatlo = tomo(ilatlo,ilonlo,layer)*(1-fact) + fact*tomo(ilathi,ilonlo,layer)
-   vlathi = tomo(ilatlo,ilonhi,layer)*(1-fact) + fact*tomo(ilathi,ilonhi,layer)
-   fact = (lon1 - real(lonlo)) / 2.
-   resid = vlatlo + fact*(vlathi - vlatlo)
+   vlatlo = dv(ilatlo,ilonlo,layer)*(1-fact_lat) + fact_lat*dv(ilathi,ilonlo,layer)
+   vlathi = dv(ilatlo,ilonhi,layer)*(1-fact_lat) + fact_lat*dv(ilathi,ilonhi,layer)
+   resid = vlatlo + fact_lon*(vlathi - vlatlo)
    ! get time delay assoc. with resid
    Tprem = sddp/VPREM
    Tanom = sddp/(VPREM*(1 + resid/100.))
    dt = Tanom - Tprem
 
    if (debug) write(0,'(a,f0.4,a)') 'get_dt: ', dt, ' s'
-end subroutine get_dt
+end subroutine get_dt_model
+
+
+subroutine grid_index(x, x0, dx, n, periodic, ilo, ihi, fact)
+! subroutine grid_index finds the points of the grid x0, x0 + dx, ...,
+! x0 + (n-1)*dx either side of x, and how far x is from the first to the
+! second.  Off the end of the grid both points are the end point, unless the
+! grid is periodic (in longitude, so n*dx = 360), when it wraps around.
+! INPUT:
+!     x         : Coordinate (degrees)
+!     x0, dx    : First grid point and spacing (degrees)
+!     n         : Number of grid points
+!     periodic  : Whether the grid wraps around
+! OUTPUT:
+!     ilo, ihi  : Indices (from 1) of grid points below and above x
+!     fact      : Fraction of the way from point ilo to ihi
+   real, intent(in) :: x
+   real(8), intent(in) :: x0, dx
+   integer, intent(in) :: n
+   logical, intent(in) :: periodic
+   integer, intent(out) :: ilo, ihi
+   real, intent(out) :: fact
+   real(8) :: xrel
+
+   xrel = real(x, 8) - x0
+   if (periodic) xrel = modulo(xrel, 360._8)
+   ilo = floor(xrel/dx)
+   if (periodic) then
+      fact = real((xrel - ilo*dx)/dx)
+      ilo = modulo(ilo, n)
+      ihi = modulo(ilo + 1, n)
+   else if (ilo < 0) then
+      ilo = 0
+      ihi = 0
+      fact = 0.
+   else if (ilo >= n - 1) then
+      ilo = n - 1
+      ihi = n - 1
+      fact = 0.
+   else
+      ihi = ilo + 1
+      fact = real((xrel - ilo*dx)/dx)
+   endif
+   ilo = ilo + 1
+   ihi = ihi + 1
+end subroutine grid_index
 
 
 subroutine read_taup_time_file(file, lat, lon, r, n)
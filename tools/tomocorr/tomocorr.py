@@ -1,9 +1,14 @@
 # python script tomocorr.py
-# Python script to call c-shell script and fortran code to generate travel time
-# corrections of a raypath through the 3D velocity model Van der Hilst et al (1999).
+# Python function to generate travel time corrections of a raypath through
+# the 3D velocity model Van der Hilst et al (1999).
 # Travel time corrections are produced for phases P and PcP.
 
 # Written by H Bentham Aug 2015
+# This used to write input.latlon_tomo_predict and run c.tomo_predict_vdh
+# (once for each phase), which meant it had to change directory and could
+# not be run twice at once in the same directory. It now traces the rays
+# with TauP and finds the corrections with the tomo_predict module, in this
+# process, using tomocorr2.
 
 # Requires:
 # station lat and lon (slat, slon) earthquake lat, lon, depth (elat, elon, edep)
@@ -11,45 +16,59 @@
 # Output parameters:
 # dtP and dtPcP (travel time variations for dtP and dtPcP)
 
-# Other scripts and files required:
-# c.tomo_predict_vdh	(c-shell script)
-# tomo_predict_vdh.f	(fortran code)
+# Other files required:
+# tomo_predict		(python module built from tomo_predict.f90)
 # ak135.1D_vp		(1D velocity model ak135)
 # vdh3D_1999		(3D velocity model Van der Hilst et al (1999))
 
+import os
+import threading
+
+import numpy
+import obspy.taup
+import geographiclib.geodesic as geod
+
+import tomocorr2
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# As in c.tomo_predict_vdh: rays from taup_path in ak135 on a sphere. The
+# model is given by file name, as TauP looks for a file called 'ak135' in
+# the current directory first.
+_AK135 = os.path.join(os.path.dirname(os.path.abspath(obspy.taup.__file__)),
+	'data', 'ak135.npz')
+_corrector = None
+_corrector_lock = threading.Lock()
+
+def _get_corrector():
+	global _corrector
+	with _corrector_lock:
+		if _corrector is None:
+			_corrector = tomocorr2.TomographicCorrection(
+				os.path.join(_SCRIPT_DIR, 'ak135.1D_vp'),
+				os.path.join(_SCRIPT_DIR, 'vdh3D_1999'),
+				ellipsoid=geod.Geodesic(6371000.0, 0.0), taup_model=_AK135)
+	return _corrector
 
 # function run_tomocorr
 def run_tomocorr(slat, slon, elat, elon, edep, statn):
-	import csv
-	import numpy
-	import subprocess
-        import os
-
-        startdir = os.getcwd()
-        scriptdir = os.path.dirname(os.path.abspath(__file__))
-        os.chdir(scriptdir)
-	
-	# produce a 2D array containing station and earthquake coordinate & identifier
-	# information. Write array out as input file for fortran code
-	TCinfo = numpy.column_stack([slat,slon,elat,elon,edep,statn])
-	numpy.savetxt('input.latlon_tomo_predict', TCinfo, delimiter=" ", fmt='%s' )
-
-	## Run shell scripts to call fortran code
-	# For P
-	subprocess.call(["./c.tomo_predict_vdh", "P"])
-	f = open('vdh1999.P.dt','r')
-	dtPf = f.read()
-	f.close()
-	
-	# For PcP
-	subprocess.call(["./c.tomo_predict_vdh", "PcP"])
-	f = open('vdh1999.PcP.dt','r')
-	dtPcPf = f.read()
-	f.close()
+	"""Travel time corrections (s) for P and PcP for each path
+
+	   Arguments are lists or arrays with one element per path. statn
+	   (the station or path identifier) is only used to check the
+	   number of paths. Returns two float arrays, dtP and dtPcP, with
+	   NaN where a phase does not arrive.
+	"""
+	slat, slon, elat, elon, edep = [numpy.atleast_1d(numpy.asarray(x,
+		dtype=float)) for x in (slat, slon, elat, elon, edep)]
+	if not (len(slat) == len(slon) == len(elat) == len(elon) ==
+			len(edep) == len(statn)):
+		raise ValueError("Need the same number of each argument")
 
-	os.chdir(startdir)	
+	dt = _get_corrector().calculate_many(elat, elon, edep, slat, slon,
+		['P', 'PcP'])
 
-	return (dtPf, dtPcPf)
+	return (dt[:,0], dt[:,1])
 	
 if __name__ == "__main__":	
 	################################################
@@ -93,22 +93,8 @@ class TauPyModelGeo(taup.TauPyModel):
         # arrival object - everything else stays the same.
         arrivals = self.get_ray_paths(source_depth_in_km, distance_in_deg, 
                                       phase_list)
-        line = self.ellipsoid.Line(source_latitude_in_deg, 
-                                   source_longitude_in_deg, azimuth)
-       
-        pathList = []
-        for arrival in arrivals:
-            for path_point in arrival.path:
-                pos = line.ArcPosition(np.degrees(path_point['dist']))
-                diffTDG = np.array([(
-                    path_point['p'],
-                    path_point['time'],
-                    path_point['dist'],
-                    path_point['depth'],
-                    pos['lat2'],
-                    pos['lon2'])], dtype=TimeDistLoc)
-                pathList.append(diffTDG)
-            arrival.path = np.concatenate(pathList)
+        self._add_locations(arrivals, 'path', source_latitude_in_deg,
+                            source_longitude_in_deg, azimuth)
 
         return arrivals
 
@@ -150,62 +136,227 @@ class TauPyModelGeo(taup.TauPyModel):
         # arrival object - everything else stays the same.
         arrivals = self.get_pierce_points(source_depth_in_km, distance_in_deg, 
                                       phase_list)
-        line = self.ellipsoid.Line(source_latitude_in_deg, 
-                                   source_longitude_in_deg, azimuth)
-       
-        pathList = []
-        for arrival in arrivals:
-            for path_point in arrival.pierce:
-                pos = line.ArcPosition(np.degrees(path_point['dist']))
-                diffTDG = np.array([(
-                    path_point['p'],
-                    path_point['time'],
-                    path_point['dist'],
-                    path_point['depth'],
-                    pos['lat2'],
-                    pos['lon2'])], dtype=TimeDistLoc)
-                pathList.append(diffTDG)
-            arrival.pierce = np.concatenate(pathList)
+        self._add_locations(arrivals, 'pierce', source_latitude_in_deg,
+                            source_longitude_in_deg, azimuth)
 
         return arrivals
 
+    def _add_locations(self, arrivals, attribute, source_latitude_in_deg,
+                       source_longitude_in_deg, azimuth):
+        """Replace the path (or pierce) attribute of each arrival by a
+           TimeDistLoc array with the latitude and longitude of each point
+
+           The points of all the arrivals are put into one array, and
+           their locations found in one go by arc_positions; each
+           arrival gets a slice of the array.
+        """
+        points = [getattr(arrival, attribute) for arrival in arrivals]
+        offsets = np.zeros(len(points) + 1, dtype=int)
+        np.cumsum([len(p) for p in points], out=offsets[1:])
+        geo = np.empty(offsets[-1], dtype=TimeDistLoc)
+        for i, p in enumerate(points):
+            for field in ('p', 'time', 'dist', 'depth'):
+                geo[field][offsets[i]:offsets[i+1]] = p[field]
+        lat, lon = arc_positions(source_latitude_in_deg, 
+                                 source_longitude_in_deg, azimuth,
+                                 np.degrees(geo['dist']), self.ellipsoid.f)
+        geo['lat'] = lat
+        geo['lon'] = lon
+        for i, arrival in enumerate(arrivals):
+            setattr(arrival, attribute, geo[offsets[i]:offsets[i+1]])
+
+
+def arc_positions(lat1, lon1, azi1, arc, f=0.0):
+    """Latitudes and longitudes of points along a geodesic
+
+       Finds the location of points at an array of arc lengths, arc
+       (degrees, on the auxiliary sphere, as for the ArcPosition method 
+       of a geographiclib GeodesicLine), along the geodesic leaving
+       (lat1, lon1) with azimuth azi1 (degrees) on an ellipsoid with
+       flattening f. Given the arc length, Vincenty's solution of the
+       direct problem needs no iteration; on a sphere (f == 0) it is just
+       the great circle formula, and for the Earth it agrees with 
+       geographiclib to about 1e-9 degrees. Returns arrays of latitude
+       and longitude (in the range -180 to 180) in degrees.
+    """
+    phi1, alpha1 = np.radians(lat1), np.radians(azi1)
+    sigma = np.radians(arc)
+    u1 = np.arctan((1.0 - f)*np.tan(phi1))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_alpha1, cos_alpha1 = np.sin(alpha1), np.cos(alpha1)
+    sigma1 = np.arctan2(sin_u1, cos_u1*cos_alpha1)
+    sin_alpha = cos_u1*sin_alpha1
+    cos2_alpha = 1.0 - sin_alpha**2
+    sin_sigma, cos_sigma = np.sin(sigma), np.cos(sigma)
+
+    x = sin_u1*sin_sigma - cos_u1*cos_sigma*cos_alpha1
+    lat2 = np.arctan2(sin_u1*cos_sigma + cos_u1*sin_sigma*cos_alpha1,
+                      (1.0 - f)*np.hypot(sin_alpha, x))
+    lam = np.arctan2(sin_sigma*sin_alpha1, 
+                     cos_u1*cos_sigma - sin_u1*sin_sigma*cos_alpha1)
+    c = f/16.0*cos2_alpha*(4.0 + f*(4.0 - 3.0*cos2_alpha))
+    cos_2sigma_m = np.cos(2.0*sigma1 + sigma)
+    dlon = lam - (1.0 - c)*f*sin_alpha*(sigma + c*sin_sigma*(cos_2sigma_m 
+                                 + c*cos_sigma*(2.0*cos_2sigma_m**2 - 1.0)))
+    lon2 = np.mod(lon1 + np.degrees(dlon) + 180.0, 360.0) - 180.0
+    return np.degrees(lat2), lon2
+
+
+
+def unique_paths(*coordinates):
+    """The distinct paths among arrays (broadcast together) of their
+       coordinates, e.g. event latitude, longitude and depth and station
+       latitude and longitude. Returns the index of the first of each
+       distinct path, and the index into those of every path, so that
+       c.ravel()[first][inverse] is c.ravel() for each coordinate c.
+    """
+    coordinates = np.broadcast_arrays(*[np.asarray(c, dtype=float) 
+                                        for c in coordinates])
+    rows = np.column_stack([c.ravel() for c in coordinates])
+    if len(rows) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    _, first, inverse = np.unique(rows, axis=0, return_index=True, 
+                                  return_inverse=True)
+    return first, inverse.ravel()
 
 
 # Tomographic correction...
 # =========================
 #
 # Given this has some one-time setup, it seems sensible
-# to also give this an OO interface. However, we can only have
-# one instance (see line 25 of tomo_predict.f90. What fun. 
+# to also give this an OO interface. Each instance has
+# its own copy of the model (see tomo_model.py), so 
+# different models can be compared in one process.
 
-import tomo_predict
+import tomo_model
 
 class TomographicCorrection(object):
 
     def __init__(self, file_1d, file_3d, ellipsoid=geod.Geodesic.WGS84, 
-                    taup_model="iasp91"):
+                    taup_model="iasp91", cache=None):
 
         # Something to calculate the path
         self.earth_model = TauPyModelGeo(ellipsoid=ellipsoid,model=taup_model)
 
-        # Setup the Fortran...
-        assert not tomo_predict.tomo_predict.setup_done, \
-            "Only one instance is permitted by the Fortran"
-        tomo_predict.tomo_predict.setup(file_1d, file_3d)
+        # And the model to calculate the corrections in
+        self.model = tomo_model.TomoModel.from_files(file_1d, file_3d)
+
+        # Optionally, somewhere to keep corrections between runs (a
+        # correction_cache.CorrectionCache), used by calculate and
+        # calculate_many
+        self.cache = cache
+        if cache is not None:
+            self.fingerprint = cache.fingerprint('tomography', file_1d,
+                file_3d, taup_model, ellipsoid.a, ellipsoid.f)
 
     def calculate(self, evtlat, evtlon, evtdep, stalat, stalon, phase_list):
+        """Tomographic corrections for one event-station path, as a 
+           list with one for each arrival of the phases in phase_list, 
+           in order of arrival time. If the corrector has a cache, the
+           whole list is kept in it: its length, and each correction 
+           under its position in the list.
+        """
+        if self.cache is None:
+            return self._calculate(evtlat, evtlon, evtdep, stalat, stalon,
+                                   phase_list)
+        geometry = [np.array([c], dtype=float) for c in 
+                    (evtlat, evtlon, evtdep, stalat, stalon)]
+        key = 'arrivals:' + ','.join(phase_list)
+        count, found = self.cache.lookup(self.fingerprint, key + ':n', 
+                                         geometry)
+        if found[0]:
+            dts = []
+            for i in range(int(count[0])):
+                dt, found = self.cache.lookup(self.fingerprint, 
+                                              key + ':' + str(i), geometry)
+                if not found[0]:
+                    # Partly removed from the cache
+                    break
+                dts.append(dt[0])
+            else:
+                return dts
+        dts = self._calculate(evtlat, evtlon, evtdep, stalat, stalon, 
+                              phase_list)
+        for i, dt in enumerate(dts):
+            self.cache.store(self.fingerprint, key + ':' + str(i), geometry,
+                             dt)
+        # The length last, so the list is only found once it is all there
+        self.cache.store(self.fingerprint, key + ':n', geometry, len(dts))
+        return dts
 
+    def _calculate(self, evtlat, evtlon, evtdep, stalat, stalon, phase_list):
+        """calculate, without the cache"""
         arrivals = self.earth_model.get_ray_paths_geo(evtdep, evtlat, evtlon,
                     stalat, stalon, phase_list)
 
         dts = []
         for arrival in arrivals:
-            dts.append(tomo_predict.tomo_predict.tomo_delay(arrival.path['lat'], 
+            dts.append(self.model.delay(arrival.path['lat'], 
                                   arrival.path['lon'], arrival.path['depth']))
 
         return dts
 
-
+    def calculate_many(self, evtlat, evtlon, evtdep, stalat, stalon, 
+                       phase_list):
+        """Tomographic corrections for many event-station paths
+
+           Arguments are arrays (or anything numpy can turn into one) of 
+           event latitude, longitude and depth and station latitude and
+           longitude, with one element per path, and a list of phases.
+           A ray path is found for each path and phase and then the 
+           corrections for all of them are found in one call to the 
+           Fortran. An array of shape (number of paths, number of phases)
+           is returned holding the correction for the first arrival of 
+           each phase, or NaN if the phase does not arrive.
+
+           Each distinct path is only traced once, however many times
+           it appears. If the corrector has a cache, corrections are taken from it
+           where possible, and only those for the other paths are 
+           calculated (and then added to the cache).
+        """
+        evtlat, evtlon, evtdep, stalat, stalon = [a.ravel() for a in 
+            np.broadcast_arrays(evtlat, evtlon, evtdep, stalat, stalon)]
+        # Picks reported by several agencies share a path, so only
+        # trace each distinct path once
+        first, inverse = unique_paths(evtlat, evtlon, evtdep, stalat, stalon)
+        geometry = [a[first] for a in (evtlat, evtlon, evtdep, stalat, 
+                                       stalon)]
+        if self.cache is None:
+            return self._calculate_many(*(geometry + [phase_list]))[inverse]
+        dt = np.empty((len(first), len(phase_list)))
+        found = np.ones(dt.shape, dtype=bool)
+        for j, phase in enumerate(phase_list):
+            dt[:,j], found[:,j] = self.cache.lookup(self.fingerprint, phase,
+                                                    geometry)
+        missing = ~found.all(axis=1)
+        if missing.any():
+            dt[missing] = self._calculate_many(*([a[missing] for a in 
+                                                  geometry] + [phase_list]))
+            for j, phase in enumerate(phase_list):
+                self.cache.store(self.fingerprint, phase, [a[missing] for a
+                                 in geometry], dt[missing,j])
+        return dt[inverse]
+
+    def _calculate_many(self, evtlat, evtlon, evtdep, stalat, stalon,
+                        phase_list):
+        """calculate_many for 1D arrays, without the cache"""
+        paths = []
+        found = np.zeros((evtlat.size, len(phase_list)), dtype=bool)
+        for i in range(evtlat.size):
+            arrivals = self.earth_model.get_ray_paths_geo(evtdep.flat[i], 
+                evtlat.flat[i], evtlon.flat[i], stalat.flat[i], 
+                stalon.flat[i], phase_list)
+            for j, phase in enumerate(phase_list):
+                for arrival in arrivals:
+                    if arrival.name == phase:
+                        paths.append(arrival.path)
+                        found[i,j] = True
+                        break
+
+        dt = np.empty(found.shape)
+        dt.fill(np.nan)
+        dt[found] = self.model.path_delays(paths)
+        return dt
 
 
 if __name__ == "__main__":      
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""Tables of travel times for quick predictions
+
+   Calling TauPyModel.get_travel_times for every pick (as the
+   notebooks do to predict PcP - P times) solves the tau-p problem
+   again each time, which takes about 10 ms. This module tabulates
+   the travel time, slowness and bounce point distance of the first
+   arrival of some phases on a grid of distance and source depth,
+   once, and then finds them for any number of paths by bicubic
+   interpolation of the table:
+
+       table = ttime_table.cached_table('iasp91_P_PcP.npz', ('P', 'PcP'))
+       dtime = (table.time('PcP', distances, depths) -
+                table.time('P', distances, depths))
+
+   A table is only as good as its grid; accuracy_report compares a
+   table with direct TauP calculations. The distance of the bounce
+   point is that of the deepest point of the ray (the reflection
+   point for PcP, the turning point for P) from the source.
+"""
+
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import scipy.interpolate
+from obspy.taup import TauPyModel
+from obspy.taup.helper_classes import TauModelError
+from obspy.taup.seismic_phase import SeismicPhase
+
+# What is tabulated: travel time (s), slowness (s/degree) and distance of
+# the bounce point from the source (degrees)
+QUANTITIES = ('time', 'slowness', 'bounce')
+
+# The first arrival of P has kinks at short distances (from the upper mantle
+# triplications), so the default grid is finer there
+DEFAULT_DISTANCES = np.concatenate([np.arange(0.0, 30.0, 0.5),
+                                    np.arange(30.0, 180.5, 1.0)])
+# Likewise in depth there are kinks at the crustal discontinuities of
+# iasp91 and ak135, at 20 and 35 km
+DEFAULT_DEPTHS = np.concatenate([[0.0, 10.0, 20.0, 35.0],
+                                 np.arange(50.0, 701.0, 25.0)])
+
+
+def _tabulate_depth(args):
+    """The values of QUANTITIES for the first arrival of each phase at
+       each distance, for one source depth. Returns an array of shape
+       (number of quantities, number of phases, number of distances),
+       NaN where a phase does not arrive."""
+    model, phases, distances, depth = args
+    tau_model = TauPyModel(model=model).model.depth_correct(depth)
+    tau_model = tau_model.split_branch(0.0)
+    values = np.empty((len(QUANTITIES), len(phases), len(distances)))
+    values.fill(np.nan)
+    for j, phase in enumerate(phases):
+        try:
+            seismic_phase = SeismicPhase(phase, tau_model, 0.0)
+        except TauModelError:
+            continue
+        for i, distance in enumerate(distances):
+            arrivals = seismic_phase.calc_time(distance)
+            if len(arrivals) == 0:
+                continue
+            arrival = min(arrivals, key=lambda a: a.time)
+            seismic_phase.calc_pierce_from_arrival(arrival)
+            deepest = np.argmax(arrival.pierce['depth'])
+            values[:,j,i] = (arrival.time, arrival.ray_param_sec_degree,
+                             np.degrees(arrival.pierce['dist'][deepest]))
+    return values
+
+
+def _fill_gaps(values):
+    """Copy of a 2D array with NaNs replaced by linear interpolation (and
+       extrapolation from the last two values) along the first axis, so a
+       spline can be fitted to it without bending too much where a phase
+       stops arriving"""
+    filled = np.zeros(values.shape)
+    index = np.arange(values.shape[0])
+    for j in range(values.shape[1]):
+        valid = np.flatnonzero(~np.isnan(values[:,j]))
+        if valid.size == 0:
+            continue
+        filled[:,j] = np.interp(index, valid, values[valid,j])
+        if valid.size > 1:
+            for end, (a, b) in ((index < valid[0], valid[:2]),
+                                (index > valid[-1], valid[-2:])):
+                slope = (values[b,j] - values[a,j])/(b - a)
+                filled[end,j] = values[a,j] + slope*(index[end] - a)
+    return filled
+
+
+class TravelTimeTable(object):
+    """Travel times, slownesses and bounce point distances of some phases
+
+       values is a dictionary mapping (quantity, phase) to an array of
+       shape (len(distances), len(depths)) giving the quantity (one of
+       QUANTITIES) for the first arrival of the phase at each distance
+       (degrees) and source depth (km) in model, or NaN where the phase
+       does not arrive. Usually a table is made by build or read by load.
+    """
+
+    def __init__(self, model, phases, distances, depths, values):
+        self.model = model
+        self.phases = tuple(phases)
+        self.distances = np.asarray(distances, dtype=float)
+        self.depths = np.asarray(depths, dtype=float)
+        if len(self.distances) < 2 or len(self.depths) < 2:
+            raise ValueError("Need at least two distances and depths")
+        self.values = values
+        self._splines = {}
+
+    @classmethod
+    def build(cls, phases, model='iasp91', distances=DEFAULT_DISTANCES,
+              depths=DEFAULT_DEPTHS, processes=1):
+        """Make a table by running TauP at every point of the grid
+
+           This takes some time (about a minute for two phases on the
+           default grid), so processes > 1 runs that many processes,
+           each doing some of the depths.
+        """
+        jobs = [(model, list(phases), list(distances), depth)
+                for depth in depths]
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_tabulate_depth, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_tabulate_depth(job) for job in jobs]
+        results = np.stack(results, axis=-1)
+        values = {}
+        for i, quantity in enumerate(QUANTITIES):
+            for j, phase in enumerate(phases):
+                values[(quantity, phase)] = results[i,j]
+        return cls(model, phases, distances, depths, values)
+
+    def save(self, filename):
+        """Write the table to a numpy .npz file"""
+        arrays = {'model': np.array(self.model),
+                  'phases': np.array(self.phases),
+                  'distances': self.distances, 'depths': self.depths}
+        for j, phase in enumerate(self.phases):
+            for quantity in QUANTITIES:
+                arrays['{}_{}'.format(quantity, j)] = \
+                    self.values[(quantity, phase)]
+        with open(filename, 'wb') as fh:
+            np.savez(fh, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a table written by save"""
+        with np.load(filename) as data:
+            phases = [str(phase) for phase in data['phases']]
+            values = {}
+            for j, phase in enumerate(phases):
+                for quantity in QUANTITIES:
+                    values[(quantity, phase)] = \
+                        data['{}_{}'.format(quantity, j)]
+            return cls(str(data['model']), phases, data['distances'],
+                       data['depths'], values)
+
+    def _spline(self, quantity, phase):
+        """Bicubic spline through the table of quantity for phase (made
+           the first time it is needed) and which cells of the table have
+           valid values at all four corners"""
+        key = (quantity, phase)
+        if key not in self._splines:
+            if key not in self.values:
+                raise ValueError("No " + quantity + " for phase " + phase +
+                                 " in table")
+            values = self.values[key]
+            spline = scipy.interpolate.RectBivariateSpline(
+                self.distances, self.depths, _fill_gaps(values),
+                kx=min(3, len(self.distances) - 1),
+                ky=min(3, len(self.depths) - 1))
+            valid = ~np.isnan(values)
+            valid = valid[:-1,:-1] & valid[1:,:-1] & valid[:-1,1:] & valid[1:,1:]
+            self._splines[key] = (spline, valid)
+        return self._splines[key]
+
+    def evaluate(self, quantity, phase, distance, depth):
+        """Interpolate the table of quantity for phase at arrays (or
+           scalars) of distance (degrees) and source depth (km)
+
+           The result is NaN outside the grid, and in any cell of the grid
+           where the phase does not arrive at one of the corners.
+        """
+        spline, valid = self._spline(quantity, phase)
+        distance, depth = np.broadcast_arrays(np.asarray(distance, float),
+                                              np.asarray(depth, float))
+        result = spline.ev(distance.ravel(), depth.ravel())
+
+        # Which cell of the grid each point is in
+        i = np.searchsorted(self.distances, distance.ravel()) - 1
+        j = np.searchsorted(self.depths, depth.ravel()) - 1
+        ok = valid[np.clip(i, 0, valid.shape[0] - 1),
+                   np.clip(j, 0, valid.shape[1] - 1)]
+        # Points on the first grid line are in the first cell
+        ok &= ((i >= 0) | (distance.ravel() == self.distances[0])) & \
+              ((j >= 0) | (depth.ravel() == self.depths[0])) & \
+              (i < valid.shape[0]) & (j < valid.shape[1])
+        result[~ok] = np.nan
+        return result.reshape(distance.shape)
+
+    def time(self, phase, distance, depth):
+        """Travel time (s) of phase at distance (degrees) from a source at
+           depth (km), for arrays or scalars"""
+        return self.evaluate('time', phase, distance, depth)
+
+    def slowness(self, phase, distance, depth):
+        """Slowness (s/degree) of phase, as for time"""
+        return self.evaluate('slowness', phase, distance, depth)
+
+    def bounce_distance(self, phase, distance, depth):
+        """Distance (degrees) from the source of the deepest point of
+           the ray of phase, as for time"""
+        return self.evaluate('bounce', phase, distance, depth)
+
+
+def cached_table(filename, phases, model='iasp91', distances=DEFAULT_DISTANCES,
+                 depths=DEFAULT_DEPTHS, processes=1):
+    """Read a table from filename, or build it and save it there first if
+       the file does not exist or holds a different table"""
+    if os.path.exists(filename):
+        table = TravelTimeTable.load(filename)
+        if table.model == model and set(phases) <= set(table.phases) and \
+                np.array_equal(table.distances, distances) and \
+                np.array_equal(table.depths, depths):
+            return table
+    table = TravelTimeTable.build(phases, model, distances, depths, processes)
+    table.save(filename)
+    return table
+
+
+def accuracy_report(table, npoints=200, seed=0):
+    """Compare a table with TauP at random points within its grid
+
+       Returns a dictionary mapping (quantity, phase) to a dictionary of
+       the number of points compared ('n', leaving out any where only one
+       of the table and TauP has the phase), the number where only one
+       has it ('mismatch'), and the maximum, root mean square and 99th
+       percentile absolute difference ('max', 'rms' and 'p99').
+    """
+    rng = np.random.RandomState(seed)
+    distances = rng.uniform(table.distances[0], table.distances[-1], npoints)
+    depths = rng.uniform(table.depths[0], table.depths[-1], npoints)
+    direct = np.empty((len(QUANTITIES), len(table.phases), npoints))
+    for k in range(npoints):
+        direct[:,:,k] = _tabulate_depth((table.model, list(table.phases),
+                                         [distances[k]], depths[k]))[:,:,0]
+    report = {}
+    for i, quantity in enumerate(QUANTITIES):
+        for j, phase in enumerate(table.phases):
+            predicted = table.evaluate(quantity, phase, distances, depths)
+            both = ~np.isnan(predicted) & ~np.isnan(direct[i,j])
+            error = np.abs(predicted[both] - direct[i,j][both])
+            stats = {'n': int(both.sum()),
+                     'mismatch': int((np.isnan(predicted) !=
+                                      np.isnan(direct[i,j])).sum())}
+            if error.size > 0:
+                stats.update({'max': error.max(),
+                              'rms': np.sqrt(np.mean(error**2)),
+                              'p99': np.percentile(error, 99)})
+            report[(quantity, phase)] = stats
+    return report
+
+
+if __name__ == "__main__":
+    # Build a table and report how good it is, e.g.
+    # python ttime_table.py iasp91_P_PcP.npz P PcP
+    if len(sys.argv) < 3:
+        sys.exit("Usage: ttime_table.py table_file phase [phase...]")
+    table = cached_table(sys.argv[1], sys.argv[2:],
+                         processes=multiprocessing.cpu_count())
+    report = accuracy_report(table)
+    for phase in table.phases:
+        for quantity in QUANTITIES:
+            stats = report[(quantity, phase)]
+            print("{:8s} {:8s} n={:4d} mismatch={:3d} max={:.4f} "
+                  "rms={:.4f} p99={:.4f}".format(phase, quantity, stats['n'],
+                  stats['mismatch'], stats.get('max', np.nan),
+                  stats.get('rms', np.nan), stats.get('p99', np.nan)))